@@ -77,17 +77,46 @@ WSGI_APPLICATION = "app.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# connections are kept in a per process pool (core/backends/pooled), closing
+# one at the end of a request gives it back. `MAX_SIZE` connections at most,
+# a checkout waits `TIMEOUT` seconds for a free one and connections older
+# than `MAX_AGE` seconds are replaced.
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": "core.backends.pooled",
         "NAME": "django_search",
         "USER": "sheikhhariszahid",
         "PASSWORD": "",
         "HOST": "127.0.0.1",
         "PORT": "5432",
+        "POOL": {
+            "MAX_SIZE": 20,
+            "TIMEOUT": 5.0,
+            "MAX_AGE": 3600,
+        },
     }
 }
 
+# searches read from a replica when its host is given, see core/routers.py.
+if os.environ.get("DATABASE_REPLICA_HOST"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "HOST": os.environ["DATABASE_REPLICA_HOST"],
+        "PORT": os.environ.get("DATABASE_REPLICA_PORT", "5432"),
+        "TEST": {"MIRROR": "default"},
+    }
+
+# products are hash partitioned by id across several databases when their
+# names are given e.g. `DATABASE_SHARDS=search_0,search_1`, see
+# core/routers.py. the default database still hands out the product ids.
+SEARCH_SHARDS = []
+for i, name in enumerate(os.environ.get("DATABASE_SHARDS", "").split(",")):
+    if name.strip():
+        DATABASES[f"shard_{i}"] = {**DATABASES["default"], "NAME": name.strip()}
+        SEARCH_SHARDS.append(f"shard_{i}")
+
+DATABASE_ROUTERS = ["core.routers.ShardRouter", "core.routers.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -133,3 +162,36 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 if not os.path.exists(OUTPUT_DIR):
     os.mkdir(OUTPUT_DIR)
+
+# keep `Product.search_vector` up to date with a database trigger
+# (see search/migrations/0006) instead of preparing it from python.
+SEARCH_VECTOR_TRIGGER = True
+
+# with the trigger, writes only flag the changed products as dirty and they are
+# indexed in batches by `python manage.py process_search_queue`, or by a
+# background thread of the process which wrote them when `SEARCH_INDEX_WORKER`
+# is set. dirty products are still found meanwhile through vectors built on
+# the fly. changing this needs the trigger to be re-created by
+# `python manage.py create_search_trigger`.
+SEARCH_INDEX_DEFERRED = True
+SEARCH_INDEX_WORKER = True
+
+# result cache in front of the `SearchService` a*_search methods, results
+# are kept in a per process LRU and in the django cache `BACKEND` (`None`
+# to disable that tier) for `TIMEOUT` seconds.
+SEARCH_CACHE = {
+    "ENABLED": True,
+    "MAXSIZE": 1024,
+    "TIMEOUT": 60,
+    "BACKEND": "default",
+}
+
+# plain search pages are read through server side prepared statements (see
+# search/prepared.py). they live in the database session, turn this off
+# behind a transaction pooler such as pgbouncer in transaction mode.
+SEARCH_PREPARED_STATEMENTS = True
+
+# snapshot of the in memory index of the `bm25` search, written by
+# `index_products --snapshot`. the workers map it instead of reading every
+# product, the index is built from the database when there is none.
+SEARCH_ENGINE_SNAPSHOT = os.path.join(OUTPUT_DIR, "search_engine.idx")
@@ -16,7 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from core.views import MetricsView
+from search.urls import root_urlpatterns
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", MetricsView.as_view()),
     path("search/", include("search.urls")),
+    path("", include(root_urlpatterns)),
 ]
@@ -0,0 +1,32 @@
+from django.db.backends.postgresql import base
+
+from .creation import DatabaseCreation
+from .pool import get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    # postgresql backend whose connections are borrowed from a per process
+    # pool (`POOL` of the database settings) instead of being opened for
+    # every request, closing one gives it back to the pool.
+    creation_class = DatabaseCreation
+
+    @property
+    def pool(self):
+        return get_pool(
+            self.alias, self.settings_dict["NAME"], self.settings_dict.get("POOL", {})
+        )
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.getconn(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params)
+        )
+        # a reused connection still has to tell its isolation level.
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection)
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, Tuple
+
+from django.db import OperationalError, connections
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection
+
+from core.metrics import Sample, metrics
+
+
+class ConnectionPool:
+    def __init__(
+        self, max_size: int = 20, timeout: float = 5.0, max_age: float = 3600
+    ) -> None:
+        self.max_size = max_size
+        # seconds a checkout waits for a free connection.
+        self.timeout = timeout
+        # seconds before a connection is replaced, `0` keeps them forever.
+        self.max_age = max_age
+        # idle connections and the time they were opened at, most recently
+        # returned last so the warm ones are reused first.
+        self.idle: Deque[Tuple[connection, float]] = deque()
+        self.opened_at: Dict[int, float] = {}
+        self.size = 0
+        self.condition = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.opened = 0
+        self.discarded = 0
+
+    def is_expired(self, opened_at: float) -> bool:
+        return bool(self.max_age) and time.monotonic() - opened_at > self.max_age
+
+    def getconn(self, connect: Callable[[], connection]) -> connection:
+        start_time = time.monotonic()
+        waited = False
+        with self.condition:
+            while True:
+                while self.idle:
+                    conn, opened_at = self.idle.pop()
+                    if not conn.closed and not self.is_expired(opened_at):
+                        self.checked_out(conn, opened_at, start_time, waited)
+                        return conn
+                    self.discard(conn)
+
+                if self.size < self.max_size:
+                    # reserved before connecting, outside of the lock.
+                    self.size += 1
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise OperationalError(
+                        f"No database connection was free in {self.timeout} secs."
+                    )
+                waited = True
+                self.condition.wait(remaining)
+
+        try:
+            conn = connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.opened += 1
+            self.checked_out(conn, time.monotonic(), start_time, waited)
+        return conn
+
+    def checked_out(
+        self, conn: connection, opened_at: float, start_time: float, waited: bool
+    ) -> None:
+        wait_time = time.monotonic() - start_time
+        self.opened_at[id(conn)] = opened_at
+        self.checkouts += 1
+        self.waits += waited
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def putconn(self, conn: connection) -> None:
+        # the session goes back as it is, e.g. its prepared statements stay.
+        # only an open transaction is rolled back.
+        try:
+            if not conn.closed and conn.info.transaction_status != (
+                TRANSACTION_STATUS_IDLE
+            ):
+                conn.rollback()
+        except Exception:
+            conn.close()
+
+        with self.condition:
+            opened_at = self.opened_at.pop(id(conn), 0.0)
+            if conn.closed or self.is_expired(opened_at):
+                self.discard(conn)
+            else:
+                self.idle.append((conn, opened_at))
+            self.condition.notify()
+
+    def discard(self, conn: connection) -> None:
+        # called with the lock held.
+        self.size -= 1
+        self.discarded += 1
+        if not conn.closed:
+            conn.close()
+
+    def close(self) -> None:
+        # the idle connections, e.g. before their database is dropped.
+        with self.condition:
+            while self.idle:
+                conn, _ = self.idle.pop()
+                self.discard(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            idle = len(self.idle)
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "idle": idle,
+                "in_use": self.size - idle,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+                "timeouts": self.timeouts,
+                "opened": self.opened,
+                "discarded": self.discarded,
+            }
+
+
+# pools by alias and database name, the test runner points the aliases to
+# the test databases and their connections must not be mixed up.
+pools: Dict[Tuple[str, str], ConnectionPool] = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, name: str, options: Dict[str, Any]) -> ConnectionPool:
+    with pools_lock:
+        if (alias, name) not in pools:
+            pools[alias, name] = ConnectionPool(
+                max_size=options.get("MAX_SIZE", 20),
+                timeout=options.get("TIMEOUT", 5.0),
+                max_age=options.get("MAX_AGE", 3600),
+            )
+        return pools[alias, name]
+
+
+def close_pools(name: str) -> None:
+    with pools_lock:
+        for (_, pool_name), pool in pools.items():
+            if pool_name == name:
+                pool.close()
+
+
+def get_pool_stats() -> Dict[str, Dict[str, Any]]:
+    with pools_lock:
+        return {
+            alias: pool.stats()
+            for (alias, name), pool in pools.items()
+            # the pools of the databases the aliases currently point to.
+            if connections.settings.get(alias, {}).get("NAME") == name
+        }
+
+
+def collect_pool_metrics() -> Iterator[Sample]:
+    for alias, stats in get_pool_stats().items():
+        labels = (("database", alias),)
+        for key in ("size", "idle", "in_use"):
+            yield f"db_pool_{key}", "gauge", labels, stats[key]
+        for key in ("checkouts", "waits", "timeouts", "opened", "discarded"):
+            yield f"db_pool_{key}_total", "counter", labels, stats[key]
+        yield "db_pool_wait_seconds_total", "counter", labels, stats["wait_time"]
+        yield "db_pool_max_wait_seconds", "gauge", labels, stats["max_wait_time"]
+
+
+metrics.register(collect_pool_metrics)
@@ -0,0 +1,112 @@
+import threading
+from contextlib import nullcontext
+from contextvars import ContextVar
+from queue import Full, Queue
+from typing import Any, Awaitable, Callable, Iterator, Optional, Tuple
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    DatabaseError,
+    close_old_connections,
+    connections,
+)
+from psycopg2 import errorcodes
+
+
+def is_statement_timeout(error: DatabaseError) -> bool:
+    # the query cancelled by `statement_timeout`, not a lost connection or a
+    # failed pool checkout.
+    return getattr(error.__cause__, "pgcode", None) == errorcodes.QUERY_CANCELED
+
+
+# timeout and recorder of the running `run_isolated`, the ones it starts
+# (e.g. a query per shard) inherit them.
+isolation: ContextVar[
+    Tuple[Optional[float], Optional[Callable[..., Any]]]
+] = ContextVar("isolation", default=(None, None))
+
+
+async def run_isolated(
+    method: Callable[..., Awaitable[Any]],
+    *args,
+    timeout: Optional[float] = None,
+    using: str = DEFAULT_DB_ALIAS,
+    recorder: Optional[Callable[..., Any]] = None,
+    **kwargs,
+) -> Any:
+    # the async ORM runs every query on one shared thread, running the
+    # coroutine from its own thread gives it its own connection so several
+    # of them can hit the database concurrently.
+    inherited_timeout, inherited_recorder = isolation.get()
+    timeout = timeout if timeout is not None else inherited_timeout
+    recorder = recorder or inherited_recorder
+
+    def run() -> Any:
+        isolation.set((timeout, recorder))
+        try:
+            if timeout:
+                # let postgres give up as well, not only the caller. `using`
+                # is the database the coroutine queries.
+                with connections[using].cursor() as cursor:
+                    cursor.execute(
+                        "SET statement_timeout = %s", [max(int(timeout * 1000), 1)]
+                    )
+            # `recorder` is an execute wrapper of the queries of the method.
+            wrapper = connections[using].execute_wrapper(recorder)
+            with wrapper if recorder else nullcontext():
+                return async_to_sync(method)(*args, **kwargs)
+        finally:
+            if timeout:
+                try:
+                    with connections[using].cursor() as cursor:
+                        cursor.execute("RESET statement_timeout")
+                except DatabaseError:
+                    pass
+            close_old_connections()
+
+    return await sync_to_async(run, thread_sensitive=False)()
+
+
+def iterate_in_thread(
+    make_iterator: Callable[[], Iterator[Any]], maxsize: int = 8
+) -> Iterator[Any]:
+    # consumes a database backed iterator from its own thread, so it can be
+    # streamed from async code as well. the bounded queue keeps the memory
+    # constant whatever the size of the result is.
+    items: Queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in make_iterator():
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            connections.close_all()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # the consumer went away e.g. the client disconnected.
+        stop.set()
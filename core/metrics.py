@@ -0,0 +1,176 @@
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+# name, type, labels and value of a sample added by a collector.
+Sample = Tuple[str, str, Labels, float]
+# upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# recent observations the quantiles are computed from.
+WINDOW_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # rolling window, the buckets count every observation since start.
+        self.window: Deque[float] = deque(maxlen=WINDOW_SIZE)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.window.append(value)
+
+    def quantile(self, q: float) -> float:
+        values = sorted(self.window)
+        if not values:
+            return 0.0
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class QueryRecorder:
+    # django execute wrapper counting the queries of a connection, their
+    # time and the rows they returned. the connections of several threads
+    # may share it e.g. one per shard.
+    def __init__(self) -> None:
+        self.queries = 0
+        self.rows = 0
+        self.db_ns = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter_ns()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            rows = max(context["cursor"].rowcount, 0)
+            with self.lock:
+                self.db_ns += elapsed
+                self.queries += 1
+                self.rows += rows
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.help: Dict[str, str] = {}
+        # callables adding the gauges of other components e.g. the pools.
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def describe(self, name: str, help: str) -> None:
+        self.help[name] = help
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self.get_labels(labels)
+        with self.lock:
+            samples = self.counters.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self.get_labels(labels)
+        with self.lock:
+            samples = self.histograms.setdefault(name, {})
+            if key not in samples:
+                samples[key] = Histogram()
+            samples[key].observe(value)
+
+    def register(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        self.collectors.append(collector)
+
+    @staticmethod
+    def format_sample(
+        name: str, labels: Labels, value: float, extra: Optional[Labels] = None
+    ) -> str:
+        labels = labels + (extra or ())
+        text = ",".join(f'{key}="{label}"' for key, label in labels)
+        value = Metrics.format_value(value)
+        return f"{name}{{{text}}} {value}" if text else f"{name} {value}"
+
+    @staticmethod
+    def format_value(value: float) -> str:
+        # every digit, `:g` would round a large counter to 6 of them.
+        if isinstance(value, int):
+            return str(int(value))
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(float(value))
+
+    def render(self) -> str:
+        # prometheus text exposition format.
+        lines: List[str] = []
+
+        def header(name: str, type: str) -> None:
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {type}")
+
+        with self.lock:
+            for name, samples in sorted(self.counters.items()):
+                header(name, "counter")
+                for labels, value in sorted(samples.items()):
+                    lines.append(self.format_sample(name, labels, value))
+
+            for name, samples in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for labels, histogram in sorted(samples.items()):
+                    cumulative = 0
+                    bounds = [f"{b:g}" for b in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            self.format_sample(
+                                f"{name}_bucket", labels, cumulative, (("le", bound),)
+                            )
+                        )
+                    lines.append(
+                        self.format_sample(f"{name}_sum", labels, histogram.sum)
+                    )
+                    lines.append(
+                        self.format_sample(f"{name}_count", labels, histogram.count)
+                    )
+
+                recent = f"{name}_recent"
+                header(recent, "gauge")
+                for labels, histogram in sorted(samples.items()):
+                    for q in QUANTILES:
+                        lines.append(
+                            self.format_sample(
+                                recent,
+                                labels,
+                                histogram.quantile(q),
+                                (("quantile", f"{q:g}"),),
+                            )
+                        )
+
+        collected: Dict[Tuple[str, str], List[str]] = {}
+        for collector in self.collectors:
+            for name, type, labels, value in collector():
+                collected.setdefault((name, type), []).append(
+                    self.format_sample(name, labels, value)
+                )
+        for (name, type), samples in sorted(collected.items()):
+            header(name, type)
+            lines.extend(samples)
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,22 @@
+import base64
+import json
+from typing import Any, List
+
+
+def encode_cursor(values: List[Any]) -> str:
+    cursor = base64.urlsafe_b64encode(json.dumps(values).encode())
+    return cursor.decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    # binascii, unicode and json errors are all ValueErrors.
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(f"{cursor}{padding}"))
+    except ValueError as e:
+        raise ValueError("Invalid cursor.") from e
+
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor.")
+
+    return values
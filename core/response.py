@@ -1,7 +1,16 @@
+import json
 from http import HTTPStatus
-from typing import Any, Dict, List, Optional, TypedDict
+from typing import Any, Callable, Dict, List, Optional, TypedDict
 
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+Encoder = Callable[[Any], bytes]
 
 
 class ResponseType(TypedDict):
@@ -36,12 +45,31 @@ def make_failed_response(
     return {"errors": errors, "message": message}
 
 
+def json_default(value: Any) -> Any:
+    # types orjson doesn't know (Decimal, lazy strings, ...) are encoded the
+    # way `JsonResponse` would, datetimes as well since orjson formats them
+    # differently (microseconds, "+00:00" instead of "Z").
+    return DjangoJSONEncoder().default(value)
+
+
+def dumps(value: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(
+            value,
+            default=json_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+
+    return json.dumps(value, cls=DjangoJSONEncoder).encode()
+
+
 def make_response(
     data: Dict[str, Any] | List[Dict[str, Any]] = {},
     errors: List[Dict[str, Any]] | Dict[str, Any] = [],
     message: str = "",
     status: HTTPStatus | int = HTTPStatus.OK.value,
-) -> JsonResponse:
+    encoder: Optional[Encoder] = None,
+) -> HttpResponse:
     if isinstance(status, HTTPStatus):
         status = status.value
 
@@ -50,4 +78,8 @@ def make_response(
     else:
         responseData = make_success_response(data, message)
 
-    return JsonResponse(data=responseData, status=status, safe=False)
+    return HttpResponse(
+        (encoder or dumps)(responseData),
+        content_type="application/json",
+        status=status,
+    )
@@ -0,0 +1,73 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_DB_ALIAS = "replica"
+
+
+def get_shards() -> List[str]:
+    # database aliases the products are partitioned across, none by default.
+    return list(getattr(settings, "SEARCH_SHARDS", []))
+
+
+def get_shard(pk: int) -> str:
+    # fibonacci hashing, consecutive ids are spread evenly over the shards.
+    shards = get_shards()
+    hash = ((pk * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32
+    return shards[hash % len(shards)]
+
+
+class ShardRouter:
+    # products are hash partitioned by id across the `SEARCH_SHARDS`, a
+    # product with an id is read and written on its own shard. the searches
+    # query every shard (see `SearchService.scatter`), the other queries go
+    # on to the next router.
+    APPS = ("search",)
+
+    def get_instance_shard(self, model, hints) -> Optional[str]:
+        instance = hints.get("instance")
+        if (
+            model._meta.app_label in self.APPS
+            and get_shards()
+            and instance is not None
+            and instance.pk is not None
+        ):
+            return get_shard(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.get_instance_shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.get_instance_shard(model, hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the shards only hold the products.
+        if db in get_shards():
+            return app_label in self.APPS
+        return None
+
+
+class ReplicaRouter:
+    # reads of the searched apps go to the `replica` database when one is
+    # configured, writes and migrations always to the primary. reads which
+    # have to see the latest writes ask for `router.db_for_write` explicitly.
+    APPS = ("search",)
+
+    def db_for_read(self, model, **hints):
+        if (
+            model._meta.app_label in self.APPS
+            and REPLICA_DB_ALIAS in settings.DATABASES
+        ):
+            return REPLICA_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -1,7 +1,12 @@
 import asyncio
 
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.http.request import HttpRequest
 from django.views import View
 
+from .metrics import metrics
+
 
 class BaseAsyncView(View):
     @classmethod
@@ -9,3 +14,12 @@ class BaseAsyncView(View):
         view = super().as_view(**initkwargs)
         view._is_coroutine = asyncio.coroutines._is_coroutine
         return view
+
+
+class MetricsView(BaseAsyncView):
+    async def get(self, request: HttpRequest):
+        # collectors may query the database.
+        return HttpResponse(
+            await sync_to_async(metrics.render)(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -6,6 +6,6 @@ class SearchConfig(AppConfig):
     name = "search"
 
     def ready(self) -> None:
-        from .signals import product_pre_save_actions
+        from .signals import product_changed_actions, product_pre_save_actions
 
         return super().ready()
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.db import transaction
+
+from core.metrics import Sample, metrics
+
+MISSING = object()
+
+
+class SearchCache:
+    # shared between the processes through the django cache backend, bumping
+    # it makes every cached result unreachable.
+    VERSION_KEY = "search:version"
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 60,
+        backend: Optional[str] = "default",
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.version = 1
+        self.entries: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        # searches run from several threads, see `core.db.run_isolated`.
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls) -> Optional["SearchCache"]:
+        options: Dict[str, Any] = getattr(settings, "SEARCH_CACHE", {})
+        if not options.get("ENABLED", True):
+            return None
+
+        return cls(
+            maxsize=options.get("MAXSIZE", 1024),
+            ttl=options.get("TIMEOUT", 60),
+            backend=options.get("BACKEND", "default"),
+        )
+
+    @property
+    def backend_cache(self) -> Optional[BaseCache]:
+        return caches[self.backend] if self.backend else None
+
+    def make_key(self, version: int, strategy: str, *args, **kwargs) -> str:
+        key = json.dumps([strategy, args, kwargs], sort_keys=True, default=str)
+        return f"search:{version}:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    async def get_version(self) -> int:
+        cache = self.backend_cache
+        if not cache:
+            return self.version
+
+        version = await cache.aget(self.VERSION_KEY)
+        if version is None:
+            # never restart from an old number, those keys may still exist.
+            await cache.aadd(self.VERSION_KEY, time.time_ns(), timeout=None)
+            version = await cache.aget(self.VERSION_KEY)
+
+        return version
+
+    def bump_version(self) -> None:
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+        cache = self.backend_cache
+        if cache:
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                cache.set(self.VERSION_KEY, time.time_ns(), timeout=None)
+
+    def get_local(self, key: str) -> Any:
+        with self.lock:
+            expires, value = self.entries.get(key, (0, MISSING))
+            if value is MISSING or expires < time.monotonic():
+                return MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set_local(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get_or_call(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get_local(key)
+        if value is not MISSING:
+            return value
+
+        cache = self.backend_cache
+        if cache:
+            value = await cache.aget(key, MISSING)
+            if value is not MISSING:
+                with self.lock:
+                    self.backend_hits += 1
+                self.set_local(key, value)
+                return value
+
+        with self.lock:
+            self.misses += 1
+        value = await call()
+        self.set_local(key, value)
+        if cache:
+            await cache.aset(key, value, timeout=self.ttl)
+
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "backend_hits": self.backend_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
+
+
+def cached(method):
+    # caches the results of a `SearchService` method by its arguments.
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        cache: Optional[SearchCache] = self.cache
+        if not cache:
+            return await method(self, *args, **kwargs)
+
+        key = cache.make_key(
+            await cache.get_version(), method.__name__, *args, **kwargs
+        )
+        return await cache.get_or_call(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
+
+
+search_cache = SearchCache.from_settings()
+
+
+def invalidate_search_cache(using: Optional[str] = None) -> None:
+    # for the writes which send no signals (bulk_create, update, raw sql).
+    # bumped once they are committed, a search running meanwhile would cache
+    # the old rows again.
+    if search_cache:
+        transaction.on_commit(search_cache.bump_version, using=using)
+
+
+def collect_cache_metrics() -> Iterator[Sample]:
+    if search_cache:
+        stats = search_cache.stats()
+        for key in ("hits", "backend_hits", "misses", "evictions"):
+            yield f"search_cache_{key}_total", "counter", (), stats[key]
+        for key in ("size", "maxsize"):
+            yield f"search_cache_{key}", "gauge", (), stats[key]
+
+
+metrics.register(collect_cache_metrics)
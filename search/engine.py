@@ -0,0 +1,699 @@
+import heapq
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from django.conf import settings
+from django.db import connections
+
+from core.routers import get_shards
+
+from .models import Product
+from .stopwords import STOP_WORDS
+
+WORD_RE = re.compile(r"\w+")
+# a websearch like query: "quoted phrases", -negations and `or`.
+QUERY_TOKEN_RE = re.compile(r'(-?)(?:"([^"]*)"?|([^\s"]+))')
+
+
+def encode_varints(values: Iterable[int]) -> bytearray:
+    # 7 bits per byte, the high bit tells another byte follows.
+    data = bytearray()
+    for value in values:
+        while value > 0x7F:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+    return data
+
+
+def decode_varints(data: Sequence[int], start: int, end: int) -> List[int]:
+    values = []
+    value = shift = 0
+    for i in range(start, end):
+        byte = data[i]
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_deltas(values: Sequence[int]) -> bytearray:
+    # sorted values are stored as the gaps between them, small gaps take a
+    # single byte.
+    return encode_varints(b - a for a, b in zip([0, *values], values))
+
+
+def decode_deltas(data: Sequence[int], start: int, end: int) -> List[int]:
+    values = decode_varints(data, start, end)
+    for i in range(1, len(values)):
+        values[i] += values[i - 1]
+    return values
+
+
+class StringTable(Sequence[str]):
+    # strings packed in a single buffer, `offsets` has one more item than the
+    # strings. sorted tables are searched in place by `find`.
+    def __init__(self, data: Sequence[int], offsets: Sequence[int]) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "StringTable":
+        data = bytearray()
+        offsets = array("Q", [0])
+        for string in strings:
+            data += string.encode()
+            offsets.append(len(data))
+        return cls(bytes(data), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i] : self.offsets[i + 1]]).decode()
+
+    def find(self, string: str) -> int:
+        i = bisect_left(self, string)
+        return i if i < len(self) and self[i] == string else -1
+
+
+class Doc(NamedTuple):
+    pk: int
+    name: str
+    slug: str
+    price: float
+    # lexemes of the weighted search vector, their positions and weights.
+    lexemes: List[Tuple[str, List[int], str]]
+
+
+class Segment:
+    # an immutable part of the index. the documents are numbered in pk order,
+    # the postings of a term are the compressed gaps between the numbers of
+    # its documents, along with their weighted term frequencies and
+    # compressed positions.
+    def __init__(
+        self,
+        ids: Sequence[int],
+        names: StringTable,
+        slugs: StringTable,
+        prices: Sequence[float],
+        lengths: Sequence[float],
+        terms: StringTable,
+        term_offsets: Sequence[int],
+        postings: Sequence[int],
+        posting_starts: Sequence[int],
+        frequencies: Sequence[float],
+        position_offsets: Sequence[int],
+        positions: Sequence[int],
+        words: StringTable,
+        word_lexemes: StringTable,
+    ) -> None:
+        self.ids = ids
+        self.names = names
+        self.slugs = slugs
+        self.prices = prices
+        self.lengths = lengths
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.postings = postings
+        self.posting_starts = posting_starts
+        self.frequencies = frequencies
+        self.position_offsets = position_offsets
+        self.positions = positions
+        # words of the documents and their lexemes, queries are stemmed
+        # through them without asking postgres.
+        self.words = words
+        self.word_lexemes = word_lexemes
+
+    @classmethod
+    def build(
+        cls, docs: Iterable[Doc], vocabulary: Dict[str, str], weights: Dict[str, float]
+    ) -> "Segment":
+        ids, prices, lengths = array("q"), array("d"), array("f")
+        names: List[str] = []
+        slugs: List[str] = []
+        term_postings: Dict[str, List[Tuple[int, float, List[int]]]] = {}
+        for doc in docs:
+            number = len(ids)
+            ids.append(doc.pk)
+            names.append(doc.name)
+            slugs.append(doc.slug)
+            prices.append(doc.price)
+            length = 0.0
+            for lexeme, positions, lexeme_weights in doc.lexemes:
+                frequency = sum(weights[weight] for weight in lexeme_weights)
+                term_postings.setdefault(lexeme, []).append(
+                    (number, frequency, positions)
+                )
+                length += frequency
+            lengths.append(length)
+
+        terms = sorted(term_postings)
+        postings, positions = bytearray(), bytearray()
+        term_offsets, position_offsets = array("Q", [0]), array("Q", [0])
+        posting_starts, frequencies = array("I", [0]), array("f")
+        for term in terms:
+            items = term_postings[term]
+            postings += encode_deltas([number for number, _, _ in items])
+            term_offsets.append(len(postings))
+            for _, frequency, term_positions in items:
+                frequencies.append(frequency)
+                positions += encode_deltas(term_positions)
+                position_offsets.append(len(positions))
+            posting_starts.append(len(frequencies))
+
+        words = sorted(vocabulary)
+        return cls(
+            ids,
+            StringTable.from_strings(names),
+            StringTable.from_strings(slugs),
+            prices,
+            lengths,
+            StringTable.from_strings(terms),
+            term_offsets,
+            bytes(postings),
+            posting_starts,
+            frequencies,
+            position_offsets,
+            bytes(positions),
+            StringTable.from_strings(words),
+            StringTable.from_strings(vocabulary[word] for word in words),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def lexeme(self, word: str) -> Optional[str]:
+        i = self.words.find(word)
+        return self.word_lexemes[i] if i >= 0 else None
+
+    def get_docs(self, term: int) -> List[int]:
+        return decode_deltas(
+            self.postings, self.term_offsets[term], self.term_offsets[term + 1]
+        )
+
+    def get_positions(self, term: int, docs: List[int], number: int) -> List[int]:
+        posting = self.posting_starts[term] + bisect_left(docs, number)
+        return decode_deltas(
+            self.positions,
+            self.position_offsets[posting],
+            self.position_offsets[posting + 1],
+        )
+
+
+class IndexState(NamedTuple):
+    base: Segment
+    # products changed since the base was built, their base documents are
+    # masked by `deleted`.
+    delta: Optional[Segment]
+    deleted: FrozenSet[int]
+    doc_count: int
+    average_length: float
+
+
+# a query word and its position in its phrase.
+Clause = List[Tuple[str, int]]
+
+
+class Group(NamedTuple):
+    # the groups of a query are OR'ed, their clauses AND'ed.
+    clauses: List[Clause]
+    negated: List[Clause]
+
+
+def parse_query(query: str) -> List[Group]:
+    groups = [Group([], [])]
+    for negated, phrase, word in QUERY_TOKEN_RE.findall(query.lower()):
+        if word == "or" and not negated:
+            if groups[-1].clauses:
+                groups.append(Group([], []))
+            continue
+
+        # unquoted words split by punctuation are a phrase as well.
+        words = WORD_RE.findall(phrase if phrase else word)
+        if words:
+            clause = [(w, offset) for offset, w in enumerate(words)]
+            (groups[-1].negated if negated else groups[-1].clauses).append(clause)
+
+    return [group for group in groups if group.clauses]
+
+
+class SearchEngine:
+    # BM25 parameters, term frequency saturation and length normalization.
+    K1 = 1.2
+    B = 0.75
+    # seconds before the index is rebuilt even without a local change, the
+    # products may have been changed by other processes.
+    REFRESH_INTERVAL = 300
+    # changed products kept in the delta segment, past it the whole index is
+    # rebuilt.
+    MAX_DELTA = 5000
+    # products read from the database at a time while building.
+    CHUNK_SIZE = 2000
+
+    def __init__(self, config: str = "english", snapshot: Optional[str] = None) -> None:
+        self.config = config
+        self.stop_words = STOP_WORDS.get(config, frozenset())
+        # file written by `index_products --snapshot`, mapped instead of
+        # building the index when it's there.
+        self.snapshot = snapshot
+        self.snapshot_mtime = 0
+        self.state: Optional[IndexState] = None
+        self.built_at = 0.0
+        self.changed: Set[int] = set()
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def get_sql(self, pks: Optional[List[int]] = None) -> Tuple[str, List]:
+        # services import this module.
+        from .utils import get_search_vector_sql
+
+        # the stored vectors are read as they are, the stale ones are built on
+        # the fly like the searches do.
+        qn = connections[Product.objects.db].ops.quote_name
+        table = qn(Product._meta.db_table)
+        where = "WHERE product.id = ANY(%s)" if pks is not None else ""
+        sql = f"""
+            SELECT product.id, product.name, product.slug, product.price,
+                product.description, lexemes.lexemes, lexemes.positions,
+                lexemes.weights
+            FROM {table} AS product, LATERAL (
+                SELECT
+                    array_agg(lexeme) AS lexemes,
+                    array_agg(array_to_string(positions, ' ')) AS positions,
+                    array_agg(array_to_string(weights, '')) AS weights
+                FROM unnest(
+                    CASE
+                        WHEN product.search_index_dirty
+                            OR product.search_vector IS NULL
+                        THEN {get_search_vector_sql("product")}
+                        ELSE product.search_vector
+                    END
+                )
+            ) AS lexemes
+            {where}
+            ORDER BY product.id
+        """
+        return sql, [pks] if pks is not None else []
+
+    def read_docs(
+        self, pks: Optional[List[int]], words: Set[str], using: str
+    ) -> Iterator[Doc]:
+        # `words` collects the words of the documents for the vocabulary.
+        sql, params = self.get_sql(pks)
+        connection = connections[using]
+        with connection.chunked_cursor() as cursor:
+            cursor.itersize = self.CHUNK_SIZE
+            cursor.execute(sql, params)
+            for (
+                pk,
+                name,
+                slug,
+                price,
+                description,
+                lexemes,
+                positions,
+                weights,
+            ) in cursor:
+                words.update(WORD_RE.findall(f"{name} {description}".lower()))
+                yield Doc(
+                    pk,
+                    name,
+                    slug,
+                    price,
+                    [
+                        (lexeme, [int(p) for p in lexeme_positions.split()], w)
+                        for lexeme, lexeme_positions, w in zip(
+                            lexemes or [], positions or [], weights or []
+                        )
+                    ],
+                )
+
+    def get_vocabulary(self, words: Set[str]) -> Dict[str, str]:
+        # postgres stems the words once, a stop word maps to "".
+        connection = connections[Product.objects.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT word, COALESCE(
+                    (tsvector_to_array(to_tsvector(%s::regconfig, word)))[1], ''
+                )
+                FROM unnest(%s::text[]) AS word
+                """,
+                [self.config, sorted(words)],
+            )
+            return dict(cursor.fetchall())
+
+    def build_segment(self, pks: Optional[List[int]] = None) -> Segment:
+        words: Set[str] = set()
+        try:
+            # the products of every shard, in pk order.
+            databases = get_shards() or [Product.objects.db]
+            docs = list(
+                heapq.merge(
+                    *(self.read_docs(pks, words, using) for using in databases),
+                    key=lambda doc: doc.pk,
+                )
+            )
+            vocabulary = self.get_vocabulary(words)
+        finally:
+            # may run from a background thread with its own connection.
+            connections.close_all()
+
+        from .services import SearchService
+
+        # a term frequency counts the weights of its occurrences.
+        return Segment.build(docs, vocabulary, SearchService.WEIGHTS)
+
+    def set_state(
+        self, base: Segment, delta: Optional[Segment], deleted: FrozenSet[int]
+    ) -> IndexState:
+        segments = [base, *([delta] if delta else [])]
+        masked = sum(1 for pk in deleted if self.find_doc(base, pk) >= 0)
+        lengths = sum(sum(segment.lengths) for segment in segments)
+        count = sum(len(segment) for segment in segments)
+        self.state = IndexState(
+            base, delta, deleted, max(count - masked, 0), lengths / max(count, 1)
+        )
+        return self.state
+
+    @staticmethod
+    def find_doc(segment: Segment, pk: int) -> int:
+        i = bisect_left(segment.ids, pk)
+        return i if i < len(segment.ids) and segment.ids[i] == pk else -1
+
+    def build(self) -> IndexState:
+        with self.lock:
+            self.changed.clear()
+        state = self.set_state(self.build_segment(), None, frozenset())
+        self.built_at = time.monotonic()
+        return state
+
+    def load(self) -> IndexState:
+        if self.snapshot and os.path.exists(self.snapshot):
+            # any snapshot beats reading the whole catalog at startup, later
+            # on one older than the refresh interval misses the changes of the
+            # other processes.
+            max_age = None if self.state is None else self.REFRESH_INTERVAL
+            try:
+                state = self.load_snapshot(max_age)
+            except (OSError, ValueError, KeyError, TypeError):
+                # e.g. a snapshot of an older format, built from the database.
+                state = None
+            if state is not None:
+                return state
+
+        return self.build()
+
+    def load_snapshot(self, max_age: Optional[float] = None) -> Optional[IndexState]:
+        # snapshot imports this module.
+        from .snapshot import read_snapshot
+
+        mtime = os.stat(self.snapshot).st_mtime_ns
+        age = max(time.time() - mtime / 1e9, 0)
+        if max_age is not None and age > max_age:
+            return None
+
+        # mapped again only once it was replaced, the products changed since
+        # stay in the delta segment.
+        state = self.state
+        if state is None or mtime != self.snapshot_mtime:
+            base, _ = read_snapshot(self.snapshot, self.config)
+            state = self.set_state(
+                base,
+                state.delta if state else None,
+                state.deleted if state else frozenset(),
+            )
+            self.snapshot_mtime = mtime
+
+        # refreshed once the snapshot itself is too old.
+        self.built_at = time.monotonic() - age
+        return state
+
+    def save_snapshot(self, path: str) -> int:
+        from .snapshot import write_snapshot
+
+        state = self.state or self.build()
+        return write_snapshot(path, state.base, self.config)
+
+    def refresh(self, pks: Set[int]) -> IndexState:
+        # the changed products are indexed again into the delta segment, the
+        # deleted ones simply aren't found there anymore.
+        state = self.state
+        if state is None:
+            return self.build()
+        if not pks:
+            return state
+
+        if state.delta:
+            pks = pks | set(state.delta.ids)
+        if len(pks) > self.MAX_DELTA:
+            return self.build()
+
+        delta = self.build_segment(sorted(pks))
+        return self.set_state(state.base, delta, state.deleted | frozenset(pks))
+
+    def mark_changed(self, pk: int) -> None:
+        with self.lock:
+            self.changed.add(pk)
+
+    def needs_refresh(self) -> bool:
+        return bool(self.changed) or (
+            time.monotonic() - self.built_at > self.REFRESH_INTERVAL
+        )
+
+    def refresh_in_background(self) -> None:
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            changed, self.changed = self.changed, set()
+
+        def refresh():
+            try:
+                if time.monotonic() - self.built_at > self.REFRESH_INTERVAL:
+                    self.load()
+                self.refresh(changed)
+            except Exception:
+                with self.lock:
+                    self.changed |= changed
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_lexeme(self, state: IndexState, word: str) -> str:
+        if word in self.stop_words:
+            return ""
+
+        # a word of no document can only match through its stem, plurals are
+        # looked up by their singular (the stemmer isn't at hand).
+        for variant in (word, *self.get_singulars(word)):
+            for segment in (state.delta, state.base):
+                lexeme = segment.lexeme(variant) if segment else None
+                if lexeme:
+                    return lexeme
+
+        return word
+
+    @staticmethod
+    def get_singulars(word: str) -> List[str]:
+        if not word.endswith("s") or word.endswith("ss"):
+            return []
+        singulars = [word[:-1]]
+        if word.endswith("es"):
+            singulars.append(word[:-2])
+        if word.endswith("ies"):
+            singulars.append(word[:-3] + "y")
+        return singulars
+
+    def match_clause(
+        self,
+        segment: Segment,
+        clause: List[Tuple[str, int]],
+        postings: Dict[str, List[int]],
+    ) -> Set[int]:
+        # documents having every lexeme of the clause, at the same distances
+        # from each other for a phrase.
+        terms = []
+        for lexeme, offset in clause:
+            term = segment.terms.find(lexeme)
+            if term < 0:
+                return set()
+            if lexeme not in postings:
+                postings[lexeme] = segment.get_docs(term)
+            terms.append((term, lexeme, offset))
+
+        docs = set.intersection(*(set(postings[lexeme]) for _, lexeme, _ in terms))
+        if len(terms) == 1:
+            return docs
+
+        first, first_lexeme, first_offset = terms[0]
+        matches = set()
+        for number in docs:
+            others = [
+                (
+                    set(segment.get_positions(term, postings[lexeme], number)),
+                    offset - first_offset,
+                )
+                for term, lexeme, offset in terms[1:]
+            ]
+            for position in segment.get_positions(
+                first, postings[first_lexeme], number
+            ):
+                if all(position + gap in positions for positions, gap in others):
+                    matches.add(number)
+                    break
+        return matches
+
+    def search_segment(
+        self,
+        state: IndexState,
+        segment: Segment,
+        groups: List[Group],
+        frequencies: Dict[str, int],
+    ) -> Iterator[Tuple[float, int, Segment, int]]:
+        # `frequencies` are the document frequencies of the query lexemes
+        # over the whole index, the same idf scores every segment.
+        postings: Dict[str, List[int]] = {}
+        matches: Set[int] = set()
+        for group in groups:
+            docs: Optional[Set[int]] = None
+            for clause in group.clauses:
+                clause_docs = self.match_clause(segment, clause, postings)
+                docs = clause_docs if docs is None else docs & clause_docs
+                if not docs:
+                    break
+            for clause in group.negated:
+                if docs:
+                    docs -= self.match_clause(segment, clause, postings)
+            matches |= docs or set()
+
+        if segment is state.base and state.deleted:
+            matches = {n for n in matches if segment.ids[n] not in state.deleted}
+        if not matches:
+            return
+
+        scores = dict.fromkeys(matches, 0.0)
+        for lexeme, df in frequencies.items():
+            term = segment.terms.find(lexeme)
+            if term < 0:
+                continue
+            docs = postings.get(lexeme) or segment.get_docs(term)
+            idf = math.log(1 + (state.doc_count - df + 0.5) / (df + 0.5))
+            start = segment.posting_starts[term]
+            for i, number in enumerate(docs):
+                if number in scores:
+                    frequency = segment.frequencies[start + i]
+                    norm = (
+                        1
+                        - self.B
+                        + self.B * (segment.lengths[number] / state.average_length)
+                    )
+                    scores[number] += (
+                        idf * frequency * (self.K1 + 1) / (frequency + self.K1 * norm)
+                    )
+
+        for number, score in scores.items():
+            yield score, segment.ids[number], segment, number
+
+    @staticmethod
+    def get_frequencies(state: IndexState, lexemes: Iterable[str]) -> Dict[str, int]:
+        # documents having each lexeme, the base ones deleted or replaced by
+        # the delta aren't counted.
+        frequencies = dict.fromkeys(lexemes, 0)
+        for lexeme in frequencies:
+            for segment in (state.base, state.delta):
+                term = segment.terms.find(lexeme) if segment else -1
+                if term < 0:
+                    continue
+                if segment is state.base and state.deleted:
+                    frequencies[lexeme] += sum(
+                        1
+                        for number in segment.get_docs(term)
+                        if segment.ids[number] not in state.deleted
+                    )
+                else:
+                    frequencies[lexeme] += (
+                        segment.posting_starts[term + 1] - segment.posting_starts[term]
+                    )
+        return frequencies
+
+    def search(self, query: str) -> List[Tuple[float, int, Segment, int]]:
+        # every match as (score, pk, segment, document number), the caller
+        # picks its page with `top`.
+        state = self.state
+        if state is None:
+            return []
+
+        groups = []
+        lexemes: Set[str] = set()
+        for group in parse_query(query):
+            clauses = []
+            for clause in group.clauses:
+                # stop words are dropped but still count in phrase distances.
+                stemmed = [(self.get_lexeme(state, w), o) for w, o in clause]
+                stemmed = [(lexeme, o) for lexeme, o in stemmed if lexeme]
+                if stemmed:
+                    clauses.append(stemmed)
+                    lexemes.update(lexeme for lexeme, _ in stemmed)
+            negated = [
+                [(lexeme, o) for lexeme, o in stemmed if lexeme]
+                for stemmed in (
+                    [(self.get_lexeme(state, w), o) for w, o in clause]
+                    for clause in group.negated
+                )
+            ]
+            if clauses:
+                groups.append(Group(clauses, [c for c in negated if c]))
+
+        if not groups:
+            return []
+
+        frequencies = self.get_frequencies(state, sorted(lexemes))
+        return [
+            match
+            for segment in (state.base, state.delta)
+            if segment
+            for match in self.search_segment(state, segment, groups, frequencies)
+        ]
+
+    @staticmethod
+    def top(
+        matches: Iterable[Tuple[float, int, Segment, int]], limit: int
+    ) -> List[Tuple[float, int, Segment, int]]:
+        return heapq.nlargest(limit, matches, key=lambda match: match[:2])
+
+    @staticmethod
+    def get_row(match: Tuple[float, int, Segment, int]) -> Tuple:
+        score, pk, segment, number = match
+        return (
+            pk,
+            segment.names[number],
+            segment.slugs[number],
+            segment.prices[number],
+            score,
+        )
+
+
+search_engine = SearchEngine(snapshot=getattr(settings, "SEARCH_ENGINE_SNAPSHOT", None))
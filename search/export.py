@@ -0,0 +1,93 @@
+import csv
+import heapq
+import io
+import json
+import tempfile
+from itertools import islice
+from operator import itemgetter
+from typing import IO, Any, Iterable, Iterator, List, Sequence
+
+from django.db import models
+
+from .models import Product
+
+EXPORT_COLUMNS = ["id", "name", "slug", "price", "rank", "description"]
+# rows fetched per round trip of the server side cursor.
+CHUNK_SIZE = 2000
+
+
+def get_export_columns(
+    queryset: models.QuerySet[Product], columns: List[str] = EXPORT_COLUMNS
+) -> List[str]:
+    # `rank` only exists on the ranked searches.
+    available = {"pk"}
+    available.update(f.attname for f in Product._meta.concrete_fields)
+    available.update(queryset.query.annotations)
+    return [c for c in columns if c in available]
+
+
+def iter_row_chunks(
+    queryset: models.QuerySet[Product], columns: List[str]
+) -> Iterator[List[Sequence[Any]]]:
+    # a server side cursor, only a chunk of rows is in memory at a time.
+    rows = queryset.values_list(*columns).iterator(chunk_size=CHUNK_SIZE)
+    while chunk := list(islice(rows, CHUNK_SIZE)):
+        yield chunk
+
+
+def merge_rows(
+    shards: List[Iterable[Sequence[Any]]], columns: List[str]
+) -> Iterator[Sequence[Any]]:
+    # rows of every shard, each one already in the search order i.e. by rank
+    # or newest first.
+    key = columns.index("rank" if "rank" in columns else "id")
+    return heapq.merge(*shards, key=itemgetter(key), reverse=True)
+
+
+def iter_csv(
+    rows: Iterable[Sequence[Any]], columns: List[str], delimiter: str = ","
+) -> Iterator[str]:
+    # rows are buffered and handed out a chunk at a time.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows: Iterable[Sequence[Any]], columns: List[str]) -> Iterator[str]:
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), default=str))
+        if len(lines) == CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def spool_export(chunks: Iterable[str]) -> IO[bytes]:
+    # the whole export in a temporary file, only a chunk is in memory.
+    file = tempfile.TemporaryFile()
+    try:
+        for chunk in chunks:
+            file.write(chunk.encode())
+        file.seek(0)
+    except BaseException:
+        file.close()
+        raise
+
+    return file
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", iter_csv),
+    "ndjson": ("application/x-ndjson", iter_ndjson),
+}
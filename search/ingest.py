@@ -0,0 +1,297 @@
+import csv
+import io
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import NOT_PROVIDED
+
+from .models import Product
+from .utils import SEARCH_VECTOR_TRIGGER, get_search_document_sql, get_search_vector_sql
+
+INGEST_FORMATS = ("json", "ndjson", "csv")
+INGEST_TABLE = "search_product_ingest"
+# characters read from the input and handed to COPY at a time.
+CHUNK_SIZE = 1 << 16
+
+# id, name, description and price of an ingested product.
+IngestRow = Tuple[Optional[int], str, str, Optional[float]]
+
+
+def iter_json_array(file: TextIO) -> Iterator[Any]:
+    # the items of a top level array one at a time, the document is never
+    # loaded whole.
+    decoder = json.JSONDecoder()
+    buffer, pos, opened = "", 0, False
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        buffer, pos = buffer[pos:] + chunk, 0
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not opened:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array.")
+                opened, pos = True, pos + 1
+                continue
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                # the item goes on in the next chunk.
+                break
+            yield item
+            pos = end
+
+        if not chunk:
+            raise ValueError("Unterminated JSON array.")
+
+
+def iter_records(file: TextIO, format: str) -> Iterator[Dict[str, Any]]:
+    if format == "json":
+        yield from iter_json_array(file)
+    elif format == "ndjson":
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    elif format == "csv":
+        yield from csv.DictReader(file)
+    else:
+        raise ValueError("Invalid format.")
+
+
+def get_ingest_row(record: Any) -> Optional[IngestRow]:
+    # flat products ({"id", "name", ...}, e.g. an export) or fixtures
+    # ({"model", "pk", "fields"}) as loaddata reads them. `None` skips the
+    # fixtures of other models.
+    if not isinstance(record, dict):
+        raise ValueError("Expected an object.")
+    if "fields" in record:
+        if record.get("model", "search.product") != "search.product":
+            return None
+        fields, pk = record["fields"], record.get("pk")
+    else:
+        fields, pk = record, record.get("id", record.get("pk"))
+
+    if not fields.get("name"):
+        raise ValueError("Missing name.")
+    price = fields.get("price")
+    return (
+        int(pk) if pk not in (None, "") else None,
+        str(fields["name"]),
+        str(fields.get("description") or ""),
+        float(price) if price not in (None, "") else None,
+    )
+
+
+class CopyStream(io.TextIOBase):
+    # file like view of the rows as COPY csv text, psycopg2 reads it a chunk
+    # at a time so only a chunk of the input is in memory.
+    def __init__(self, rows: Iterable[IngestRow]) -> None:
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.pending = ""
+        # raised while reading the input, postgres only sees a failed COPY.
+        self.error: Optional[Exception] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        size = size if size and size > 0 else CHUNK_SIZE
+        while len(self.pending) < size:
+            try:
+                row = next(self.rows, None)
+            except Exception as e:
+                self.error = e
+                raise
+            if row is None:
+                break
+            self.writer.writerow(row)
+            if self.buffer.tell() >= CHUNK_SIZE:
+                self.pending += self.buffer.getvalue()
+                self.buffer.seek(0)
+                self.buffer.truncate()
+
+        if len(self.pending) < size:
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def get_slug_sql(alias: str, max_length: int, unicode: bool) -> str:
+    # `django.utils.text.slugify` in sql, accents are folded when the server
+    # can normalize unicode (postgres 13 and UTF8) and dropped otherwise like
+    # any other non ascii character.
+    name = f"{alias}.name"
+    if unicode:
+        name = f"normalize({name}, NFKD)"
+    ascii_name = f"regexp_replace({name}, '[^\\x01-\\x7f]', '', 'g')"
+    words = f"regexp_replace(lower({ascii_name}), '[^\\w\\s-]', '', 'g')"
+    slug = f"trim(BOTH '-_' FROM regexp_replace({words}, '[-\\s]+', '-', 'g'))"
+    return f"left({slug}, {max_length})"
+
+
+class ProductIngest:
+    # bulk load of products: the rows are copied into a temporary staging
+    # table, then inserted or updated with a couple of set based statements
+    # computing the slugs, documents and vectors, instead of a save per row.
+    def __init__(self, using: Optional[str] = None) -> None:
+        self.using = using or router.db_for_write(Product)
+        self.connection = connections[self.using]
+        self.table = self.connection.ops.quote_name(Product._meta.db_table)
+
+    def create_staging_table(self, cursor) -> None:
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE {INGEST_TABLE} (
+                line bigserial,
+                id bigint,
+                name text,
+                description text,
+                price double precision
+            ) ON COMMIT DROP
+            """
+        )
+
+    def copy(self, cursor, rows: Iterable[IngestRow]) -> int:
+        stream = CopyStream(rows)
+        try:
+            cursor.copy_expert(
+                f"COPY {INGEST_TABLE} (id, name, description, price) "
+                "FROM STDIN WITH (FORMAT csv)",
+                stream,
+            )
+        except Exception:
+            # psycopg2 errors, the cursor's copy isn't wrapped by django.
+            if stream.error:
+                raise stream.error
+            raise
+        copied = cursor.rowcount
+        cursor.execute(f"ANALYZE {INGEST_TABLE}")
+        return copied
+
+    def get_trigger(self, cursor) -> Optional[str]:
+        cursor.execute(
+            "SELECT tgname FROM pg_trigger WHERE tgrelid = %s::regclass "
+            "AND tgname = %s",
+            [Product._meta.db_table, SEARCH_VECTOR_TRIGGER],
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_gin_indexes(self, cursor) -> List[Tuple[str, str]]:
+        # names and definitions of the text search indexes.
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = %s AND indexdef ILIKE '%% USING gin %%'",
+            [Product._meta.db_table],
+        )
+        return cursor.fetchall()
+
+    def upsert(self, cursor) -> Tuple[int, int]:
+        # the staged products with an id replace the existing ones (the last
+        # one wins within the input), unchanged rows aren't written again.
+        # `normalize` needs postgres 13 and a UTF8 server.
+        cursor.execute("SHOW server_encoding")
+        unicode = (
+            cursor.fetchone()[0] == "UTF8" and self.connection.pg_version >= 130000
+        )
+        slug_field = Product._meta.get_field("slug")
+        price_field = Product._meta.get_field("price")
+        price = price_field.default if price_field.default is not NOT_PROVIDED else 0
+        select = f"""
+            COALESCE(ingest.name, ''),
+            {get_slug_sql("ingest", slug_field.max_length, unicode)},
+            COALESCE(ingest.description, ''),
+            COALESCE(ingest.price, {float(price)}),
+            {get_search_document_sql("ingest")},
+            {get_search_vector_sql("ingest")},
+            false,
+            NULL
+        """
+        columns = [
+            "name",
+            "slug",
+            "description",
+            "price",
+            "search_document",
+            "search_vector",
+            "search_index_dirty",
+            "search_index_dirty_since",
+        ]
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns)
+
+        cursor.execute(
+            f"""
+            INSERT INTO {self.table} (id, {", ".join(columns)})
+            SELECT DISTINCT ON (ingest.id) ingest.id, {select}
+            FROM {INGEST_TABLE} AS ingest
+            WHERE ingest.id IS NOT NULL
+            ORDER BY ingest.id, ingest.line DESC
+            ON CONFLICT (id) DO UPDATE SET {updates}
+            WHERE {self.table}.name IS DISTINCT FROM EXCLUDED.name
+                OR {self.table}.description IS DISTINCT FROM EXCLUDED.description
+                OR {self.table}.price IS DISTINCT FROM EXCLUDED.price
+                OR {self.table}.search_index_dirty
+                OR {self.table}.search_vector IS NULL
+            """
+        )
+        upserted = cursor.rowcount
+
+        cursor.execute(
+            f"""
+            INSERT INTO {self.table} ({", ".join(columns)})
+            SELECT {select}
+            FROM {INGEST_TABLE} AS ingest
+            WHERE ingest.id IS NULL
+            ORDER BY ingest.line
+            """
+        )
+        return upserted, cursor.rowcount
+
+    def reset_sequence(self, cursor) -> None:
+        # explicit ids don't move the sequence, same as loaddata.
+        for sql in self.connection.ops.sequence_reset_sql(no_style(), [Product]):
+            cursor.execute(sql)
+
+    def run(
+        self, rows: Iterable[IngestRow], rebuild_indexes: bool = False
+    ) -> Dict[str, int]:
+        # a single transaction, a failed load leaves the table as it was.
+        with transaction.atomic(using=self.using), self.connection.cursor() as cursor:
+            self.create_staging_table(cursor)
+            copied = self.copy(cursor, rows)
+
+            # the vectors are computed here, the per row trigger would only
+            # compute them again or flag the rows for the queue.
+            trigger = self.get_trigger(cursor)
+            if trigger:
+                cursor.execute(f"ALTER TABLE {self.table} DISABLE TRIGGER {trigger}")
+
+            # a GIN index is much cheaper built once than updated per row,
+            # worth it when the load is a large part of the table.
+            indexes = self.get_gin_indexes(cursor) if rebuild_indexes else []
+            for name, _ in indexes:
+                cursor.execute(f"DROP INDEX {self.connection.ops.quote_name(name)}")
+
+            upserted, inserted = self.upsert(cursor)
+
+            for _, definition in indexes:
+                cursor.execute(definition)
+            if trigger:
+                cursor.execute(f"ALTER TABLE {self.table} ENABLE TRIGGER {trigger}")
+            self.reset_sequence(cursor)
+
+        return {"copied": copied, "upserted": upserted, "inserted": inserted}
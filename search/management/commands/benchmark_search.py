@@ -0,0 +1,266 @@
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import time
+from typing import Dict, List
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.text import slugify
+
+from core.backends.pooled.pool import get_pool_stats
+from core.db import run_isolated
+from search.models import Product
+from search.services import SearchService
+
+# generated products are told apart from the real catalog by their slug,
+# slugify (and the slugs of ingest_products) strip the leading underscores.
+SLUG_PREFIX = "_bench-"
+
+
+class ExplainRecorder:
+    # execute wrapper running EXPLAIN (ANALYZE, BUFFERS) of every query on
+    # the same connection, a prepared statement only exists there.
+    def __init__(self) -> None:
+        self.plans: List[str] = []
+        self.explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if not self.explaining and sql.lstrip("( ").upper().startswith(
+            ("SELECT", "WITH", "EXECUTE")
+        ):
+            self.explaining = True
+            try:
+                with context["connection"].cursor() as cursor:
+                    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params)
+                    plan = "\n".join(row[0] for row in cursor.fetchall())
+            finally:
+                self.explaining = False
+            self.plans.append(f"{sql}\n{plan}")
+        return result
+
+
+class Command(BaseCommand):
+    help = "Benchmark the search strategies against a synthetic catalog"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--generate",
+            type=int,
+            default=0,
+            help="Number of synthetic products to add before the benchmark.",
+        )
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Delete the synthetic products of previous runs first.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Number of products inserted per batch.",
+        )
+        parser.add_argument(
+            "--queries",
+            help='JSON lines file of {"query": ..., "type": ...} to replay, '
+            "a mix of catalog words is used by default.",
+        )
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=200,
+            help="Number of queries run per strategy.",
+        )
+        parser.add_argument(
+            "--strategies",
+            default="normal,vector,ranking,trigram",
+            help="Comma separated search types to benchmark.",
+        )
+        parser.add_argument("--limit", type=int, default=20, help="Page size.")
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print EXPLAIN (ANALYZE, BUFFERS) of every strategy.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def get_vocabulary(self) -> List[str]:
+        with open(os.path.join(settings.BASE_DIR, "fixtures.json")) as f:
+            fixtures = json.load(f)
+
+        words = set()
+        for fixture in fixtures:
+            text = " ".join(
+                fixture["fields"].get(f, "") for f in ("name", "description")
+            )
+            words.update(w.lower() for w in re.findall(r"[A-Za-z]{3,}", text))
+
+        return sorted(words)
+
+    def generate(self, count: int, batch_size: int, rng: random.Random):
+        vocabulary = self.get_vocabulary()
+        start = (
+            Product.objects.order_by("-pk").values_list("pk", flat=True).first()
+        ) or 0
+        start_time = time.perf_counter()
+        for offset in range(0, count, batch_size):
+            products = []
+            for i in range(offset, min(offset + batch_size, count)):
+                name = " ".join(rng.choices(vocabulary, k=rng.randint(2, 4))).title()
+                products.append(
+                    Product(
+                        name=name,
+                        slug=f"{SLUG_PREFIX}{start + i}-{slugify(name)[:30]}",
+                        description=" ".join(
+                            rng.choices(vocabulary, k=rng.randint(8, 30))
+                        ).capitalize(),
+                        price=round(rng.uniform(1, 500), 2),
+                    )
+                )
+            # the search vectors are filled by the database trigger.
+            Product.objects.bulk_create(products)
+            self.stdout.write(f"{offset + len(products)} / {count} Products generated.")
+
+        elapsed = time.perf_counter() - start_time
+        self.stdout.write(
+            f"Generated in {elapsed:.2f} secs ({count / elapsed:.0f} rows/sec)."
+        )
+        if not getattr(settings, "SEARCH_VECTOR_TRIGGER", True):
+            self.stdout.write("Run index_products before the benchmark.")
+
+    def get_queries(
+        self, path: str, strategies: List[str], rng: random.Random
+    ) -> Dict[str, List[str]]:
+        if not path:
+            vocabulary = self.get_vocabulary()
+            queries = [
+                " ".join(rng.choices(vocabulary, k=rng.choice((1, 1, 2, 3))))
+                for _ in range(100)
+            ]
+            return {strategy: queries for strategy in strategies}
+
+        mix: Dict[str, List[str]] = {strategy: [] for strategy in strategies}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                types = [item["type"]] if item.get("type") else strategies
+                for type in types:
+                    if type in mix:
+                        mix[type].append(item["query"])
+
+        return mix
+
+    async def benchmark(
+        self,
+        service: SearchService,
+        strategy: str,
+        queries: List[str],
+        iterations: int,
+        limit: int,
+    ) -> Dict[str, float]:
+        method = getattr(service, f"a{strategy}_search")
+        latencies = []
+        start_time = time.perf_counter()
+        try:
+            for i in range(iterations):
+                query_start = time.perf_counter()
+                await method(queries[i % len(queries)], limit=limit)
+                latencies.append((time.perf_counter() - query_start) * 1000)
+        finally:
+            # the connection of the thread the async orm runs its queries on.
+            await sync_to_async(connections.close_all)()
+
+        elapsed = time.perf_counter() - start_time
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        return {
+            "p50": percentiles[49],
+            "p95": percentiles[94],
+            "p99": percentiles[98],
+            "qps": iterations / elapsed,
+        }
+
+    async def explain(
+        self, service: SearchService, strategy: str, query: str, limit: int
+    ) -> str:
+        # the plans of the queries of the page the benchmark timed (keyset
+        # order, fields, prepared statements), not of a query built for it.
+        recorder = ExplainRecorder()
+        await run_isolated(
+            getattr(service, f"a{strategy}_search"),
+            query,
+            limit=limit,
+            using=Product.objects.db,
+            recorder=recorder,
+        )
+        return "\n\n".join(recorder.plans) or "No queries."
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        strategies = [s.strip() for s in options["strategies"].split(",") if s.strip()]
+        service = SearchService()
+        # measure the database, not the result cache.
+        service.cache = None
+
+        for strategy in strategies:
+            if strategy not in service.STRATEGIES:
+                raise CommandError(f"Unknown search strategy {strategy}.")
+
+        if options["clear"]:
+            deleted, _ = Product.objects.filter(slug__startswith=SLUG_PREFIX).delete()
+            self.stdout.write(f"{deleted} synthetic Products deleted.")
+
+        if options["generate"]:
+            self.generate(options["generate"], max(options["batch_size"], 1), rng)
+
+        mix = self.get_queries(options["queries"], strategies, rng)
+        self.stdout.write(f"\n{Product.objects.count()} Products in the catalog.\n")
+        self.stdout.write(
+            f"{'strategy':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'qps':>10}"
+        )
+        for strategy in strategies:
+            queries = mix[strategy]
+            if not queries:
+                continue
+
+            report = asyncio.run(
+                self.benchmark(
+                    service,
+                    strategy,
+                    queries,
+                    max(options["iterations"], 2),
+                    options["limit"],
+                )
+            )
+            self.stdout.write(
+                f"{strategy:<10}{report['p50']:>10.2f}{report['p95']:>10.2f}"
+                f"{report['p99']:>10.2f}{report['qps']:>10.1f}"
+            )
+
+        for alias, stats in get_pool_stats().items():
+            self.stdout.write(
+                f"\n{alias} pool: {stats['opened']} opened, {stats['checkouts']} "
+                f"checkouts, {stats['waits']} waits "
+                f"({stats['max_wait_time'] * 1000:.2f} ms max), "
+                f"{stats['timeouts']} timeouts."
+            )
+
+        if options["explain"]:
+            for strategy in strategies:
+                if mix[strategy]:
+                    self.stdout.write(f"\n{strategy} search: {mix[strategy][0]}")
+                    self.stdout.write(
+                        asyncio.run(
+                            self.explain(
+                                service, strategy, mix[strategy][0], options["limit"]
+                            )
+                        )
+                    )
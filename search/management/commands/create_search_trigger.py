@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from search.utils import (
+    create_search_vector_trigger,
+    drop_search_vector_trigger,
+    get_product_databases,
+)
+
+
+class Command(BaseCommand):
+    help = "Create the search vector trigger from the current settings"
+
+    def handle(self, *args, **options):
+        # the migrations install the trigger of their time, it's created again
+        # here after a change of the search fields, their weights or of
+        # `SEARCH_VECTOR_TRIGGER` and `SEARCH_INDEX_DEFERRED`.
+        enabled = getattr(settings, "SEARCH_VECTOR_TRIGGER", True)
+        deferred = getattr(settings, "SEARCH_INDEX_DEFERRED", False)
+        for using in get_product_databases(write=True):
+            with connections[using].schema_editor() as schema_editor:
+                if enabled:
+                    create_search_vector_trigger(schema_editor, deferred=deferred)
+                else:
+                    drop_search_vector_trigger(schema_editor)
+
+        if not enabled:
+            self.stdout.write("Search vector trigger dropped.")
+        else:
+            self.stdout.write(
+                f"{'Deferred' if deferred else 'Search vector'} trigger created, "
+                "run `index_products --full` to index the products again."
+            )
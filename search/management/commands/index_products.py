@@ -1,18 +1,146 @@
-import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Optional
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
+from core.routers import get_shards
+from search.engine import SearchEngine
 from search.services import SearchService
-from search.utils import prep_product_search_vector_index
+from search.utils import get_pk_ranges, get_products_to_index, index_product_range
 
 
 class Command(BaseCommand):
     help = "Index Products"
 
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Index all products instead of only the dirty ones.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of products updated per batch.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of batches indexed in parallel, each one uses its own "
+            "database connection.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=os.path.join(settings.OUTPUT_DIR, "index_products.checkpoint"),
+            help="File to store the last completed pk in, an interrupted run "
+            "resumes from it.",
+        )
+        parser.add_argument(
+            "--snapshot",
+            metavar="PATH",
+            help="Write a snapshot of the in memory search index to PATH once "
+            "the products are indexed, the workers map it on startup "
+            "(`SEARCH_ENGINE_SNAPSHOT`).",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint of a previous interrupted run.",
+        )
+
+    def read_checkpoint(self, path: str, full: bool) -> int:
+        if not os.path.exists(path):
+            return 0
+
+        with open(path) as f:
+            checkpoint: Dict[str, Any] = json.load(f)
+
+        if checkpoint.get("full") != full:
+            return 0
+
+        return checkpoint.get("last_pk", 0)
+
+    def write_checkpoint(self, path: str, full: bool, last_pk: int):
+        with open(path, "w") as f:
+            json.dump({"full": full, "last_pk": last_pk}, f)
+
     def handle(self, *args, **options):
-        service = SearchService()
-        products = asyncio.run(service.get_products())
+        # the shards are indexed by the queue (process_search_queue), only
+        # their snapshot is written here.
+        if not get_shards():
+            self.index(options)
+        elif not options["snapshot"]:
+            raise CommandError(
+                "The products are sharded (SEARCH_SHARDS), index them with "
+                "process_search_queue."
+            )
+
+        if options["snapshot"]:
+            engine = SearchEngine(SearchService.CONFIG)
+            engine.build()
+            size = engine.save_snapshot(options["snapshot"])
+            self.stdout.write(
+                f"Snapshot of {engine.state.doc_count} Products written to "
+                f"{options['snapshot']} ({size / 1024 / 1024:.1f} MB)."
+            )
+
+    def index(self, options: Dict[str, Any]) -> None:
+        full: bool = options["full"]
+        batch_size: int = max(options["batch_size"], 1)
+        workers: int = max(options["workers"], 1)
+        checkpoint: str = options["checkpoint"]
+
+        if options["restart"] and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        start = self.read_checkpoint(checkpoint, full)
+        if start:
+            self.stdout.write(f"Resuming after product # {start}.")
+
+        ranges = get_pk_ranges(get_products_to_index(full), batch_size, start)
+        # batches in submission order, the checkpoint only moves past a batch
+        # once every batch before it has completed as well.
+        pending: deque = deque()
+        running = set()
+        indexed = 0
+        start_time = time.perf_counter()
+        last_pk: Optional[int] = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(running) < workers * 2:
+                    pk_range = next(ranges, None)
+                    if pk_range is None:
+                        break
+                    future = executor.submit(index_product_range, *pk_range, full)
+                    pending.append((pk_range, future))
+                    running.add(future)
+
+                if not running:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indexed += future.result()
+
+                while pending and pending[0][1].done():
+                    (_, last_pk), _ = pending.popleft()
+                    self.write_checkpoint(checkpoint, full, last_pk)
+
+                elapsed = time.perf_counter() - start_time
+                self.stdout.write(
+                    f"{indexed} Products are indexed "
+                    f"({indexed / elapsed:.0f} rows/sec), last pk {last_pk}."
+                )
 
-        prep_product_search_vector_index(products)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
 
-        self.stdout.write(f"{products.count()} Products are indexed.")
+        self.stdout.write(f"{indexed} Products are indexed.")
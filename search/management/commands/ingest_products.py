@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+from typing import Iterator, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.routers import get_shards
+from search.cache import search_cache
+from search.ingest import (
+    INGEST_FORMATS,
+    IngestRow,
+    ProductIngest,
+    get_ingest_row,
+    iter_records,
+)
+
+# rows between two progress lines.
+PROGRESS_INTERVAL = 100000
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingest Products. The search trigger is disabled during the load "
+        "(ALTER TABLE ... DISABLE TRIGGER), the other writes to the products "
+        "table wait until it's committed."
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "path",
+            help="JSON (a list of products or fixtures), NDJSON or CSV file, "
+            "`-` reads the standard input.",
+        )
+        parser.add_argument(
+            "--format",
+            choices=INGEST_FORMATS,
+            help="Format of the input, guessed from the file extension by default.",
+        )
+        parser.add_argument(
+            "--rebuild-indexes",
+            action="store_true",
+            help="Drop the GIN indexes during the load and build them again "
+            "afterwards, faster when the load is a large part of the table. "
+            "The table is locked meanwhile, reads included.",
+        )
+
+    def get_format(self, path: str, format: Optional[str]) -> str:
+        if format:
+            return format
+
+        extension = os.path.splitext(path)[1].lower().lstrip(".")
+        extension = "ndjson" if extension == "jsonl" else extension
+        if extension not in INGEST_FORMATS:
+            raise CommandError("Unknown input format, use --format.")
+
+        return extension
+
+    def iter_rows(self, file, format: str) -> Iterator[IngestRow]:
+        count = 0
+        for i, record in enumerate(iter_records(file, format), 1):
+            try:
+                row = get_ingest_row(record)
+            except (ValueError, TypeError) as e:
+                raise CommandError(f"Invalid product #{i}: {e}") from e
+
+            if row is not None:
+                count += 1
+                if count % PROGRESS_INTERVAL == 0:
+                    self.stdout.write(f"{count} Products read.")
+                yield row
+
+    def handle(self, *args, **options):
+        if get_shards():
+            raise CommandError(
+                "The products are sharded (SEARCH_SHARDS), load every shard "
+                "on its own."
+            )
+
+        path: str = options["path"]
+        format = self.get_format(path, options["format"])
+        start_time = time.perf_counter()
+
+        file = sys.stdin if path == "-" else open(path, newline="")
+        try:
+            counts = ProductIngest().run(
+                self.iter_rows(file, format), options["rebuild_indexes"]
+            )
+        except ValueError as e:
+            raise CommandError(f"Invalid input: {e}") from e
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        # cached results may miss the new products. the version only reaches
+        # the serving processes through a shared cache backend, with the
+        # default per process one they catch up once their results expire
+        # (SEARCH_CACHE TIMEOUT). their in memory indexes (bm25 and the
+        # suggestions) catch up on their periodic rebuild.
+        if search_cache:
+            search_cache.bump_version()
+
+        elapsed = time.perf_counter() - start_time
+        self.stdout.write(
+            f"{counts['copied']} Products ingested in {elapsed:.2f} secs "
+            f"({counts['copied'] / elapsed:.0f} rows/sec), "
+            f"{counts['upserted']} inserted or updated by id, "
+            f"{counts['inserted']} inserted."
+        )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from search.queue import SearchIndexQueue
+from search.utils import get_index_backlog
+
+
+class Command(BaseCommand):
+    help = "Index the dirty Products in batches as they are written"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=SearchIndexQueue.BATCH_SIZE,
+            help="Number of products indexed per UPDATE.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=SearchIndexQueue.INTERVAL,
+            help="Seconds between two looks at the dirty products.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the dirty products are indexed instead of waiting "
+            "for new ones.",
+        )
+
+    def report(self, indexed: int) -> None:
+        backlog, lag = get_index_backlog()
+        self.stdout.write(
+            f"{indexed} Products are indexed, {backlog} left "
+            f"(oldest dirty since {lag or 0:.1f} secs)."
+        )
+
+    def handle(self, *args, **options):
+        queue = SearchIndexQueue(
+            batch_size=max(options["batch_size"], 1),
+            interval=max(options["interval"], 0.1),
+        )
+        if options["once"]:
+            self.stdout.write(f"{queue.drain(self.report)} Products are indexed.")
+            return
+
+        try:
+            queue.run(self.report)
+        except KeyboardInterrupt:
+            queue.stop()
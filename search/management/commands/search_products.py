@@ -1,11 +1,13 @@
 import asyncio
 import os
-from typing import Dict, List, Tuple
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import models
 
+from search.export import EXPORT_FORMATS, get_export_columns, iter_row_chunks
 from search.models import Product
 from search.services import SearchService
 from search.utils import prep_product_search_vector_index
@@ -20,6 +22,12 @@ class Command(BaseCommand):
             action="store_true",
             help="Index all products first before performing search.",
         )
+        parser.add_argument(
+            "--format",
+            choices=list(EXPORT_FORMATS),
+            default="csv",
+            help="Format of the results file written to the output directory.",
+        )
 
     def print_products(self, products: models.QuerySet[Product]):
         for i, p in enumerate(products):
@@ -44,19 +52,32 @@ class Command(BaseCommand):
         print("\nEND ", "+" * 28)
 
     def print_result_to_file(
-        self, products: models.QuerySet[Product], colums: List[str], sep: str = "\t"
-    ):
-        with open(os.path.join(settings.OUTPUT_DIR, "results.csv"), "w") as f:
-            for i, c in enumerate(colums):
-                if i != 0:
-                    f.write(sep)
-                f.write(c)
-            for p in products:
-                f.write("\n")
-                for i, c in enumerate(colums):
-                    if i != 0:
-                        f.write(sep)
-                    f.write(str(getattr(p, c, "")))
+        self,
+        products: models.QuerySet[Product],
+        colums: List[str],
+        sep: str = "\t",
+        format: str = "csv",
+    ) -> int:
+        colums = get_export_columns(products, colums)
+        _, write = EXPORT_FORMATS[format]
+        found = 0
+
+        def count(rows: Iterable[Sequence[Any]]):
+            # the count comes from the stream instead of a second query.
+            nonlocal found
+            for found, row in enumerate(rows, 1):
+                yield row
+
+        rows = count(chain.from_iterable(iter_row_chunks(products, colums)))
+        chunks = (
+            write(rows, colums, delimiter=sep)
+            if format == "csv"
+            else write(rows, colums)
+        )
+        with open(os.path.join(settings.OUTPUT_DIR, f"results.{format}"), "w") as f:
+            f.writelines(chunks)
+
+        return found
 
     def menu(self) -> Tuple[int, Dict[int, str]]:
         choices: Dict[int, str] = {
@@ -76,7 +97,7 @@ class Command(BaseCommand):
 
     def input_query(self) -> str:
         while True:
-            query = input("Enter the Search query: ")
+            query = SearchService.normalize_query(input("Enter the Search query: "))
             if query:
                 return query
 
@@ -121,8 +142,10 @@ class Command(BaseCommand):
                     continue
 
             products = asyncio.run(products)
-            print(f"{products.count()} products were found.")
             # self.print_result(choices[choice], products)
-            self.print_result_to_file(products, colums)
+            found = self.print_result_to_file(
+                products, colums, format=options["format"]
+            )
+            print(f"{found} products were found.")
 
             self.print_interrupt_message()
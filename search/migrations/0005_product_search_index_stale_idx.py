@@ -0,0 +1,17 @@
+# Generated by Django 4.1.2 on 2026-10-18 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0004_alter_product_options_product_search_document_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('search_index_dirty', True), ('search_vector__isnull', True), _connector='OR'), fields=['id'], name='search_index_stale_idx'),
+        ),
+    ]
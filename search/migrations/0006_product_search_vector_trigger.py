@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.db import migrations
+
+# the sql is frozen as it was when the migration was written, later changes
+# of the search fields or weights re-create the trigger with
+# `python manage.py create_search_trigger`.
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', COALESCE(NEW."name", '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(NEW."description", '')), 'A');
+        NEW.search_index_dirty := false;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGER = """
+DROP TRIGGER IF EXISTS search_product_search_vector_update ON "search_product";
+CREATE TRIGGER search_product_search_vector_update
+BEFORE INSERT OR UPDATE OF "name", "description" ON "search_product"
+FOR EACH ROW EXECUTE FUNCTION search_product_search_vector();
+"""
+
+# the rows written before the trigger existed.
+BACKFILL = """
+UPDATE "search_product" SET
+    search_vector =
+        setweight(to_tsvector('english', COALESCE("name", '')), 'B')
+        || setweight(to_tsvector('english', COALESCE("description", '')), 'A'),
+    search_index_dirty = false;
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS search_product_search_vector_update ON "search_product";
+DROP FUNCTION IF EXISTS search_product_search_vector();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if getattr(settings, 'SEARCH_VECTOR_TRIGGER', True):
+        schema_editor.execute(CREATE_FUNCTION)
+        schema_editor.execute(CREATE_TRIGGER)
+        schema_editor.execute(BACKFILL)
+
+
+def drop_trigger(apps, schema_editor):
+    schema_editor.execute(DROP_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0005_product_search_index_stale_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.db import migrations
+
+# replaces the function of 0006, it now fills `search_document` as well. the
+# sql is frozen as it was when the migration was written.
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', COALESCE(NEW."name", '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(NEW."description", '')), 'A');
+        NEW.search_document := concat_ws(' ', NEW."name", NEW."description");
+        NEW.search_index_dirty := false;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGER = """
+DROP TRIGGER IF EXISTS search_product_search_vector_update ON "search_product";
+CREATE TRIGGER search_product_search_vector_update
+BEFORE INSERT OR UPDATE OF "name", "description" ON "search_product"
+FOR EACH ROW EXECUTE FUNCTION search_product_search_vector();
+"""
+
+# the rows written before the trigger filled the document.
+BACKFILL = """
+UPDATE "search_product" SET
+    search_vector =
+        setweight(to_tsvector('english', COALESCE("name", '')), 'B')
+        || setweight(to_tsvector('english', COALESCE("description", '')), 'A'),
+    search_document = concat_ws(' ', "name", "description"),
+    search_index_dirty = false;
+"""
+
+# the function of 0006.
+REVERSE_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', COALESCE(NEW."name", '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(NEW."description", '')), 'A');
+        NEW.search_index_dirty := false;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if getattr(settings, 'SEARCH_VECTOR_TRIGGER', True):
+        schema_editor.execute(CREATE_FUNCTION)
+        schema_editor.execute(CREATE_TRIGGER)
+        schema_editor.execute(BACKFILL)
+
+
+def reverse_trigger(apps, schema_editor):
+    if getattr(settings, 'SEARCH_VECTOR_TRIGGER', True):
+        schema_editor.execute(REVERSE_FUNCTION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0006_product_search_vector_trigger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigger, reverse_trigger),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 4.1.2 on 2026-10-18 18:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+# replaces the function of 0007, it clears `search_index_dirty_since` as well.
+# the sql is frozen as it was when the migration was written.
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', COALESCE(NEW."name", '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(NEW."description", '')), 'A');
+        NEW.search_document := concat_ws(' ', NEW."name", NEW."description");
+        NEW.search_index_dirty := false;
+        NEW.search_index_dirty_since := NULL;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+# writes only flag the products as dirty when the indexing is deferred, a
+# product keeps the time it was first flagged at until it's indexed.
+CREATE_DEFERRED_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_index_dirty := true;
+        NEW.search_index_dirty_since := CASE
+            WHEN TG_OP = 'UPDATE' AND OLD.search_index_dirty
+            THEN OLD.search_index_dirty_since ELSE clock_timestamp()
+        END;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+# the function of 0007.
+REVERSE_FUNCTION = """
+CREATE OR REPLACE FUNCTION search_product_search_vector() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT'
+        OR NEW."name" IS DISTINCT FROM OLD."name"
+        OR NEW."description" IS DISTINCT FROM OLD."description" THEN
+        NEW.search_vector :=
+            setweight(to_tsvector('english', COALESCE(NEW."name", '')), 'B')
+            || setweight(to_tsvector('english', COALESCE(NEW."description", '')), 'A');
+        NEW.search_document := concat_ws(' ', NEW."name", NEW."description");
+        NEW.search_index_dirty := false;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def create_trigger(apps, schema_editor):
+    # the trigger of 0007 stays in place, only its function is replaced.
+    if getattr(settings, 'SEARCH_VECTOR_TRIGGER', True):
+        if getattr(settings, 'SEARCH_INDEX_DEFERRED', False):
+            schema_editor.execute(CREATE_DEFERRED_FUNCTION)
+        else:
+            schema_editor.execute(CREATE_FUNCTION)
+
+
+def reverse_trigger(apps, schema_editor):
+    # before `search_index_dirty_since` is dropped, the function writes it.
+    if getattr(settings, 'SEARCH_VECTOR_TRIGGER', True):
+        schema_editor.execute(REVERSE_FUNCTION)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0008_product_price_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_index_dirty_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(create_trigger, reverse_trigger),
+    ]
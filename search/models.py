@@ -1,8 +1,35 @@
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connections, models
 from django.utils.text import slugify
 
+from core.routers import get_shards
+
+from .cache import invalidate_search_cache
+
+
+class ProductQuerySet(models.QuerySet):
+    # bulk writes skip the save and delete signals, see `search.signals`.
+    def bulk_create(self, *args, **kwargs):
+        products = super().bulk_create(*args, **kwargs)
+        invalidate_search_cache(self.db)
+        return products
+
+    def bulk_update(self, *args, **kwargs):
+        rows = super().bulk_update(*args, **kwargs)
+        invalidate_search_cache(self.db)
+        return rows
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        invalidate_search_cache(self.db)
+        return rows
+
+    def delete(self):
+        deleted = super().delete()
+        invalidate_search_cache(self.db)
+        return deleted
+
 
 class Product(models.Model):
     name = models.CharField(max_length=255)
@@ -12,14 +39,19 @@ class Product(models.Model):
     search_document = models.TextField(blank=True, default="")
     search_vector = SearchVectorField(blank=True, null=True)
     search_index_dirty = models.BooleanField(default=False)
+    # when the product was flagged dirty, tells how far behind the index is.
+    search_index_dirty_since = models.DateTimeField(blank=True, null=True)
 
-    SEARCH_VECTOR_FIELDS = ["name", "description"]
+    objects = ProductQuerySet.as_manager()
 
     def __str__(self) -> str:
         return f"{self.name} {self.price}$"
 
     def save(self, *args, **kwargs) -> None:
         self.slug = slugify(self.name)
+        # the id picks the shard, it has to be known before the insert.
+        if self.pk is None and get_shards():
+            self.pk = get_next_product_id()
         return super().save(*args, **kwargs)
 
     class Meta:
@@ -41,4 +73,25 @@ class Product(models.Model):
                 name="search_vector_idx",
                 fields=["search_vector"],
             ),
+            # rows which are not indexed yet are searched through their
+            # on the fly vectors, keep them cheap to find.
+            models.Index(
+                name="search_index_stale_idx",
+                fields=["id"],
+                condition=models.Q(search_index_dirty=True)
+                | models.Q(search_vector__isnull=True),
+            ),
+            # price range filters of the searches.
+            models.Index(name="price_idx", fields=["price"]),
         ]
+
+
+def get_next_product_id() -> int:
+    # the sequence of the default database numbers the products of all the
+    # shards, the ids stay unique across them.
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id'))",
+            [Product._meta.db_table],
+        )
+        return cursor.fetchone()[0]
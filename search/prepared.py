@@ -0,0 +1,127 @@
+import itertools
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models
+
+# stands for the searched text while a statement is compiled, bound to $1.
+QUERY_PLACEHOLDER = "__prepared_search_query__"
+# every compiled statement gets its own name, a session never sees two
+# different statements under the same one.
+statement_ids = itertools.count(1)
+
+
+class PreparedSearch:
+    def __init__(
+        self,
+        name: str,
+        sql: str,
+        fields: List[str],
+        keys: List[str],
+        using: str = DEFAULT_DB_ALIAS,
+    ) -> None:
+        self.name = name
+        # database the statement is run on.
+        self.using = using
+        self.sql = sql
+        self.fields = fields
+        self.keys = keys
+        self.columns = fields + [key for key in keys if key not in fields]
+        # database sessions the statement is prepared in, it lives as long as
+        # the session does.
+        self.sessions: weakref.WeakSet = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def compile(
+        cls,
+        name: str,
+        queryset: models.QuerySet,
+        fields: List[str],
+        keys: List[str],
+        after: bool = False,
+    ) -> "PreparedSearch":
+        # the orm compiles the search once, its constants are inlined and the
+        # searched text becomes $1. the page is read from it by the keys.
+        columns = fields + [key for key in keys if key not in fields]
+        sql, params = queryset.order_by().values_list(*columns).query.sql_with_params()
+        connection = connections[queryset.db]
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(sql, params).decode()
+            placeholder = cursor.mogrify("%s", [QUERY_PLACEHOLDER]).decode()
+        if placeholder not in sql:
+            raise ValueError(f"{name} doesn't search the query.")
+
+        qn = connection.ops.quote_name
+        sql = f"SELECT * FROM ({sql.replace(placeholder, '$1')}) AS search"
+        position = 2
+        if after:
+            values = ", ".join(f"${position + i}" for i in range(len(keys)))
+            sql += f" WHERE ({', '.join(qn(key) for key in keys)}) < ({values})"
+            position += len(keys)
+
+        order = ", ".join(f"{qn(key)} DESC" for key in keys)
+        return cls(
+            name,
+            f"{sql} ORDER BY {order} LIMIT ${position}",
+            fields,
+            keys,
+            using=queryset.db,
+        )
+
+    def execute(self, params: Sequence[Any]) -> List[Tuple[Any, ...]]:
+        connection = connections[self.using]
+        connection.ensure_connection()
+        session = connection.connection
+        with self.lock:
+            prepared = session in self.sessions
+        if not prepared:
+            # in a round trip of its own, prepared statements outlive a failed
+            # EXECUTE (and a rolled back transaction), the session must know
+            # it has it whatever comes next. without params the `%` of the
+            # statement aren't placeholders.
+            with connection.cursor() as cursor:
+                cursor.execute(f"PREPARE {self.name} AS {self.sql}")
+            with self.lock:
+                self.sessions.add(session)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"EXECUTE {self.name} ({', '.join(['%s'] * len(params))})", params
+            )
+            return cursor.fetchall()
+
+
+class PreparedSearches:
+    def __init__(self) -> None:
+        self.statements: Dict[Tuple[str, bool], PreparedSearch] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> Optional["PreparedSearches"]:
+        if not getattr(settings, "SEARCH_PREPARED_STATEMENTS", False):
+            return None
+
+        return cls()
+
+    def get(self, strategy: str, after: bool) -> Optional[PreparedSearch]:
+        return self.statements.get((strategy, after))
+
+    def add(
+        self,
+        strategy: str,
+        after: bool,
+        queryset: models.QuerySet,
+        fields: List[str],
+        keys: List[str],
+    ) -> PreparedSearch:
+        name = f"{strategy}_{next(statement_ids)}"
+        search = PreparedSearch.compile(name, queryset, fields, keys, after=after)
+        with self.lock:
+            # a concurrent compilation of the same search wins, they're equal.
+            return self.statements.setdefault((strategy, after), search)
+
+
+prepared_searches = PreparedSearches.from_settings()
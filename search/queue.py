@@ -0,0 +1,112 @@
+import threading
+from typing import Callable, Iterator, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from core.metrics import Sample, metrics
+
+from .cache import invalidate_search_cache
+from .utils import get_index_backlog, get_product_databases, index_dirty_products
+
+metrics.describe("search_index_indexed_total", "Dirty products indexed by the queue.")
+metrics.describe(
+    "search_index_lag_seconds",
+    "Longest time a product of an indexed batch waited since it was written.",
+)
+
+
+class SearchIndexQueue:
+    # the dirty products are the queue, the triggers flag them and the
+    # partial `search_index_stale_idx` index finds them in pk order.
+    BATCH_SIZE = 1000
+    # seconds between two looks at the dirty products when nothing woke the
+    # worker up, writes which send no signals (bulk_create, update) are only
+    # noticed by them.
+    INTERVAL = 5.0
+
+    def __init__(
+        self, batch_size: Optional[int] = None, interval: Optional[float] = None
+    ) -> None:
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.interval = interval or self.INTERVAL
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def process_batch(self) -> int:
+        # a batch of every shard when the products are sharded.
+        lags = []
+        for using in get_product_databases(write=True):
+            indexed = index_dirty_products(self.batch_size, using)
+            if indexed:
+                # the ranks of the cached results change with the vectors.
+                invalidate_search_cache(using)
+            lags.extend(indexed)
+
+        if lags:
+            metrics.inc("search_index_indexed_total", len(lags))
+            waited = [lag for lag in lags if lag is not None]
+            if waited:
+                metrics.observe("search_index_lag_seconds", max(waited))
+
+        return len(lags)
+
+    def drain(self, callback: Optional[Callable[[int], None]] = None) -> int:
+        indexed = 0
+        try:
+            while not self.stopped.is_set():
+                count = self.process_batch()
+                if not count:
+                    break
+                indexed += count
+                if callback:
+                    callback(indexed)
+        finally:
+            # may run from the worker thread, each one holds its connection.
+            connections.close_all()
+
+        return indexed
+
+    def run(self, callback: Optional[Callable[[int], None]] = None) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.drain(callback)
+            except DatabaseError:
+                # e.g. the database restarted, retried after the interval.
+                pass
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def wake(self) -> None:
+        # starts the in process worker on the first write.
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def collect_queue_metrics() -> Iterator[Sample]:
+    try:
+        backlogs = [
+            get_index_backlog(using) for using in get_product_databases(write=True)
+        ]
+    finally:
+        connections.close_all()
+
+    yield "search_index_backlog", "gauge", (), sum(count for count, _ in backlogs)
+    yield "search_index_oldest_dirty_seconds", "gauge", (), max(
+        lag or 0 for _, lag in backlogs
+    )
+
+
+search_index_queue = SearchIndexQueue()
+if getattr(settings, "SEARCH_INDEX_DEFERRED", False):
+    metrics.register(collect_queue_metrics)
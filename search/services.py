@@ -1,9 +1,49 @@
+import asyncio
+import heapq
+import math
+import re
+import unicodedata
 from functools import reduce
-from typing import List
+from itertools import islice
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypedDict
 
-from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from asgiref.sync import sync_to_async
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+    TrigramWordSimilarity,
+)
 from django.db import models
+from django.db.models.functions import Cast
+
+from core.db import run_isolated
+from core.pagination import decode_cursor, encode_cursor
+from core.routers import get_shards
+from search.cache import SearchCache, cached, search_cache
+from search.engine import SearchEngine, Segment, search_engine
 from search.models import Product
+from search.prepared import QUERY_PLACEHOLDER, PreparedSearches, prepared_searches
+from search.stopwords import STOP_WORDS
+from search.suggest import TermIndex, term_index
+
+
+class SearchResult(TypedDict):
+    # rows, or {"columns": [...], "rows": [[...]]} for the columnar layout.
+    result: List[Dict[str, Any]] | Dict[str, List[Any]]
+    next_cursor: Optional[str]
+    # e.g. "1000+" when an estimated count passed `COUNT_LIMIT`.
+    count: Optional[int | str]
+    # product counts per price band.
+    facets: Optional[Dict[str, int] | List[int]]
+
+
+class BatchSearchResult(TypedDict):
+    # pages by the ids of the batch items.
+    result: Dict[str, SearchResult]
 
 
 class SearchService:
@@ -22,18 +62,724 @@ class SearchService:
         "name": "B",
         "description": "A",
     }
+    # search types, each one has an `a<type>_search` method returning a page
+    # of its results and, but for the in memory `bm25` one, a `<type>_search`
+    # method returning their queryset.
+    STRATEGIES = ("normal", "vector", "ranking", "trigram", "bm25")
+    # strategies matching lexemes, a query of stop words only matches nothing
+    # there and isn't sent to the database.
+    TEXT_SEARCH_STRATEGIES = ("normal", "vector", "ranking")
+    # text search configuration used to build the stored search vectors.
+    CONFIG = "english"
+    # match against the precomputed (GIN indexed) `Product.search_vector`
+    # column instead of building the vectors for every row on each query.
+    USE_SEARCH_INDEX = True
+    # page size of the a*_search methods, the results are never unbounded.
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+    PAGE_OPTIONS = ("limit", "cursor", "count", "fields", "columnar")
+    # `count` modes, an estimated count stops counting past `COUNT_LIMIT`
+    # matches, an exact one scans all of them.
+    COUNT_MODES = ("exact", "estimate")
+    COUNT_LIMIT = 1000
+    # searches of a batch, run together in a single statement.
+    MAX_BATCH_SIZE = 50
+    FILTER_OPTIONS = ("min_price", "max_price", "facets", "price_bands")
+    # lower bounds of the price facets, the last band is open ended.
+    PRICE_BANDS = [0, 10, 25, 50, 100, 250, 500]
+    # lean rows by default, `description` and the search columns are wide.
+    DEFAULT_FIELDS = ["id", "name", "slug", "price", "rank", "headline"]
+    # fields of the search annotations, skipped when a search has none.
+    OPTIONAL_FIELDS = ("rank", "headline")
+    # fields of the batch search pages, besides the rank.
+    BATCH_COLUMNS = ["id", "name", "slug", "price"]
+    # defaults of the highlighted snippets of the ranking search.
+    HEADLINE_OPTIONS = {
+        "max_words": 35,
+        "min_words": 15,
+        "start_sel": "<b>",
+        "stop_sel": "</b>",
+    }
+    # results of the a*_search methods, `None` disables caching.
+    cache: Optional[SearchCache] = search_cache
+    # plain pages (default fields, no filters) are read through server side
+    # prepared statements compiled once per process, `None` disables them.
+    prepared: Optional[PreparedSearches] = prepared_searches
+    # in memory term dictionary behind the suggestions.
+    terms: TermIndex = term_index
+    # databases the products are partitioned across, every search queries
+    # all of them and merges their pages.
+    shards: List[str] = get_shards()
+    # in memory inverted index of the `bm25` search.
+    engine: SearchEngine = search_engine
+    # fields of the `bm25` search pages, all of them are held by the index.
+    ENGINE_COLUMNS = ["id", "name", "slug", "price", "rank"]
+
+    @classmethod
+    def get_search_vector(cls, config: Optional[str] = None) -> SearchVector:
+        vectors = [
+            SearchVector(field, weight=weight, config=config)
+            for field, weight in cls.PRODUCT_SEARCH_FIELDS.items()
+        ]
+        return reduce(lambda v1, v2: v1 + v2, vectors)
+
+    @classmethod
+    def get_search_document(cls) -> models.Func:
+        # plain text of the searched fields, matched by trigrams.
+        return models.Func(
+            models.Value(" "),
+            *cls.PRODUCT_SEARCH_FIELDS,
+            function="concat_ws",
+            output_field=models.TextField(),
+        )
+
+    @classmethod
+    def get_headline(
+        cls, query: SearchQuery, config: str, options: Dict[str, Any]
+    ) -> SearchHeadline:
+        if any(key not in cls.HEADLINE_OPTIONS for key in options):
+            raise ValueError("Invalid highlight options.")
+
+        # ts_headline errors out otherwise, checked with the defaults applied.
+        options = {**cls.HEADLINE_OPTIONS, **options}
+        if not 0 < options["min_words"] < options["max_words"]:
+            raise ValueError("Invalid highlight options.")
+
+        # ts_headline is costly, postgres only evaluates it after the sort and
+        # limit i.e. for the returned page, not for every matched row.
+        return SearchHeadline(
+            cls.get_search_document(),
+            query,
+            config=config,
+            **options,
+        )
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        # canonical form of a query, the text search configurations fold the
+        # case anyway but compatibility characters (e.g. ligatures or full
+        # width letters) would be split into different lexemes.
+        return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+    @classmethod
+    def has_lexemes(cls, query: str, config: Optional[str] = None) -> bool:
+        stop_words = STOP_WORDS.get(config or cls.CONFIG, frozenset())
+        return any(word not in stop_words for word in re.findall(r"\w+", query))
+
+    @staticmethod
+    def get_stale_filter() -> models.Q:
+        # rows whose stored vector can't be trusted yet.
+        return models.Q(search_index_dirty=True) | models.Q(search_vector__isnull=True)
 
     async def get_weights(self) -> List[float]:
         weights = list(self.WEIGHTS.values())
         weights.sort()
         return weights
 
-    async def sync_to_async(self, queryset: models.QuerySet[Product]) -> List[Product]:
-        return [p async for p in queryset.values()]
+    async def sync_to_async(
+        self, queryset: models.QuerySet[Product], fields: List[str]
+    ) -> List[Tuple[Any, ...]]:
+        return [p async for p in queryset.values_list(*fields)]
+
+    @staticmethod
+    async def fetch_rows(queryset: models.QuerySet[Product]) -> List[Tuple[Any, ...]]:
+        return [row async for row in queryset]
+
+    @staticmethod
+    def pop_options(kwargs: Dict[str, Any], keys: Tuple[str, ...]) -> Dict[str, Any]:
+        return {key: kwargs.pop(key) for key in keys if key in kwargs}
+
+    def filter_price(
+        self,
+        queryset: models.QuerySet[Product],
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> models.QuerySet[Product]:
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+
+        return queryset
+
+    def get_price_bands(
+        self, price_bands: Optional[List[float]] = None
+    ) -> List[Tuple[str, float, Optional[float]]]:
+        bands = sorted(price_bands or self.PRICE_BANDS)
+        return [
+            (f"{low:g}+" if high is None else f"{low:g}-{high:g}", low, high)
+            for low, high in zip(bands, bands[1:] + [None])
+        ]
+
+    def get_price_facets(
+        self,
+        queryset: models.QuerySet[Product],
+        price_bands: Optional[List[float]] = None,
+    ) -> Tuple[List[str], models.QuerySet[Product]]:
+        # a single row of product counts per price band over all the matches,
+        # the price filters aren't applied so the other bands stay visible.
+        labels: List[str] = []
+        counts: List[models.Count] = []
+        for label, low, high in self.get_price_bands(price_bands):
+            band = models.Q(price__gte=low)
+            if high is not None:
+                band &= models.Q(price__lt=high)
+            labels.append(label)
+            counts.append(models.Count("pk", filter=band))
+
+        return labels, (
+            queryset.order_by()
+            .annotate(matches=models.Value(1))
+            .values("matches")
+            .annotate(
+                facets=models.Func(
+                    *counts,
+                    template="ARRAY[%(expressions)s]",
+                    output_field=ArrayField(models.IntegerField()),
+                )
+            )
+            .values_list("facets", flat=True)
+        )
+
+    def prepare_query(self, strategy: str, query: str) -> Optional[str]:
+        # every search path (pages, batches, exports) runs the query through
+        # here, before the caches and the database. `None` when it can't
+        # match anything.
+        query = self.normalize_query(query)
+        if not query or (
+            strategy in self.TEXT_SEARCH_STRATEGIES and not self.has_lexemes(query)
+        ):
+            return None
+
+        return query
+
+    async def get_search(self, strategy: str, query: str) -> models.QuerySet[Product]:
+        # the queryset of a search type, for the complete results.
+        query = self.prepare_query(strategy, query)
+        if query is None:
+            return Product.objects.none()
+
+        return await getattr(self, f"{strategy}_search")(query)
+
+    async def search_page(
+        self,
+        search: Callable[..., Awaitable[models.QuerySet[Product]]],
+        query: str,
+        **kwargs,
+    ) -> SearchResult:
+        # splits the page and filter options from the search ones.
+        page = self.pop_options(kwargs, self.PAGE_OPTIONS)
+        filters = self.pop_options(kwargs, self.FILTER_OPTIONS)
+        if page.get("count") and page["count"] not in self.COUNT_MODES:
+            raise ValueError("Invalid count.")
+
+        strategy = search.__name__.removesuffix("_search")
+        prepared_query = self.prepare_query(strategy, query)
+        if prepared_query is None:
+            # the columns (and their checks) of the page the search would give.
+            fields = self.get_fields(await search("", **kwargs), page.get("fields"))
+            return self.empty_page(page, filters, fields)
+
+        return await self.get_page(strategy, prepared_query, page, filters, kwargs)
+
+    @cached
+    async def get_page(
+        self,
+        strategy: str,
+        query: str,
+        page: Dict[str, Any],
+        filters: Dict[str, Any],
+        options: Dict[str, Any],
+    ) -> SearchResult:
+        # `query` went through `prepare_query`, the results are cached by it.
+        search = getattr(self, f"{strategy}_search")
+        if (
+            self.prepared is not None
+            and not self.shards
+            and self.is_plain_search(page, filters, options)
+        ):
+            return await self.prepared_page(search, query, **page)
+
+        queryset = await search(query, **options)
+
+        filters = dict(filters)
+        labels, facets = [], None
+        if filters.pop("facets", False):
+            labels, facets = self.get_price_facets(
+                queryset, filters.pop("price_bands", None)
+            )
+        filters.pop("price_bands", None)
+
+        paginate = self.sharded_page if self.shards else self.paginate
+        result = await paginate(
+            self.filter_price(queryset, **filters), facets=facets, **page
+        )
+        if result["facets"] is not None:
+            result["facets"] = dict(zip(labels, result["facets"]))
+
+        return result
+
+    @staticmethod
+    def is_plain_search(
+        page: Dict[str, Any], filters: Dict[str, Any], kwargs: Dict[str, Any]
+    ) -> bool:
+        # the shape of the prepared statements, the rest goes through the orm.
+        return (
+            not page.get("count")
+            and not page.get("fields")
+            and not filters.get("facets")
+            and filters.get("min_price") is None
+            and filters.get("max_price") is None
+            and all(value is None for value in kwargs.values())
+        )
+
+    def get_fields(
+        self, queryset: models.QuerySet[Product], fields: Optional[List[str]] = None
+    ) -> List[str]:
+        available = {f.attname for f in Product._meta.concrete_fields}
+        available.update(queryset.query.annotations)
+        if fields and any(
+            f not in available and f not in self.OPTIONAL_FIELDS for f in fields
+        ):
+            raise ValueError("Invalid fields.")
+
+        return [f for f in fields or self.DEFAULT_FIELDS if f in available]
+
+    async def count_matches(
+        self, queryset: models.QuerySet[Product], mode: str
+    ) -> int | str:
+        # only the keys are selected, the snippets aren't built for counting.
+        queryset = queryset.order_by().values("pk")
+        if mode == "exact":
+            return await queryset.acount()
+
+        count = await queryset[: self.COUNT_LIMIT + 1].acount()
+        return f"{self.COUNT_LIMIT}+" if count > self.COUNT_LIMIT else count
+
+    async def paginate(
+        self,
+        queryset: models.QuerySet[Product],
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        count: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        columnar: bool = False,
+        facets: Optional[models.QuerySet[Product]] = None,
+    ) -> SearchResult:
+        limit = min(limit or self.DEFAULT_LIMIT, self.MAX_LIMIT)
+        fields = self.get_fields(queryset, fields)
+        keys = self.get_page_keys(queryset)
+        total = await self.count_matches(queryset, count) if count else None
+
+        if cursor:
+            values = self.get_cursor_values(cursor, keys)
+            if len(keys) == 2:
+                rank, pk = values
+                queryset = queryset.filter(
+                    models.Q(rank__lt=rank) | models.Q(rank=rank, id__lt=pk)
+                )
+            else:
+                queryset = queryset.filter(id__lt=values[0])
+
+        # the keys are needed for the cursor even when they aren't asked for.
+        columns = fields + [key for key in keys if key not in fields]
+        if facets is not None:
+            # evaluated once along the page, in the same round trip.
+            queryset = queryset.annotate(price_facets=models.Subquery(facets))
+            columns.append("price_facets")
+
+        queryset = queryset.order_by(*[f"-{key}" for key in keys])
+        rows = await self.sync_to_async(queryset[: limit + 1], columns)
+        price_facets = None
+        if facets is not None:
+            # an aggregate is always one row, first() would order it by pk.
+            price_facets = (
+                rows[0][-1] if rows else [f async for f in facets.using(queryset.db)][0]
+            )
+
+        return self.make_page(
+            rows,
+            columns,
+            fields,
+            keys,
+            limit,
+            columnar,
+            count=total,
+            facets=price_facets,
+        )
+
+    async def scatter(
+        self, method: Callable[..., Awaitable[Any]], queryset, *args, **kwargs
+    ) -> List[Any]:
+        # `method` run with the queryset of every shard, concurrently as each
+        # shard is queried from its own thread and connection.
+        if not self.shards:
+            return [await method(queryset, *args, **kwargs)]
+
+        return await asyncio.gather(
+            *(
+                run_isolated(
+                    method, queryset.using(alias), *args, using=alias, **kwargs
+                )
+                for alias in self.shards
+            )
+        )
+
+    async def sharded_page(
+        self,
+        queryset: models.QuerySet[Product],
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        count: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        columnar: bool = False,
+        facets: Optional[models.QuerySet[Product]] = None,
+    ) -> SearchResult:
+        # every shard pages through its own matches in the global order, the
+        # ids are unique across the shards so a cursor is valid on all of them.
+        # the first `limit` rows of the merged pages are the page.
+        limit = min(limit or self.DEFAULT_LIMIT, self.MAX_LIMIT)
+        fields = self.get_fields(queryset, fields)
+        keys = self.get_page_keys(queryset)
+        columns = fields + [key for key in keys if key not in fields]
+        pages = await self.scatter(
+            self.paginate,
+            queryset,
+            limit=limit,
+            cursor=cursor,
+            count=count,
+            fields=columns,
+            columnar=True,
+            facets=facets,
+        )
+
+        rows = heapq.merge(
+            *(page["result"]["rows"] for page in pages),
+            key=lambda row: tuple(row[columns.index(key)] for key in keys),
+            reverse=True,
+        )
+        total = None
+        if count:
+            counts = [page["count"] for page in pages]
+            total = sum(c for c in counts if isinstance(c, int))
+            if any(isinstance(c, str) for c in counts) or (
+                count != "exact" and total > self.COUNT_LIMIT
+            ):
+                total = f"{self.COUNT_LIMIT}+"
+        price_facets = None
+        if facets is not None:
+            price_facets = [sum(band) for band in zip(*(p["facets"] for p in pages))]
+
+        return self.make_page(
+            list(islice(rows, limit + 1)),
+            columns,
+            fields,
+            keys,
+            limit,
+            columnar,
+            count=total,
+            facets=price_facets,
+            # a shard with more matches has them after its whole page.
+            has_next=any(page["next_cursor"] for page in pages),
+        )
+
+    def empty_page(
+        self, page: Dict[str, Any], filters: Dict[str, Any], fields: List[str]
+    ) -> SearchResult:
+        # the page of a query which can't match anything, no query is run.
+        result = self.make_page([], fields, fields, [], 0, page.get("columnar", False))
+        if page.get("count"):
+            result["count"] = 0
+        if filters.get("facets"):
+            labels, _ = self.get_price_facets(
+                Product.objects.none(), filters.get("price_bands")
+            )
+            result["facets"] = dict.fromkeys(labels, 0)
+
+        return result
+
+    async def prepared_page(
+        self,
+        search: Callable[..., Awaitable[models.QuerySet[Product]]],
+        query: str,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        columnar: bool = False,
+        **kwargs,
+    ) -> SearchResult:
+        # same page as `paginate` without building and compiling the queryset,
+        # the statement of a search is compiled on its first use.
+        limit = min(limit or self.DEFAULT_LIMIT, self.MAX_LIMIT)
+        strategy = search.__name__
+        statement = self.prepared.get(strategy, bool(cursor))
+        if statement is None:
+            queryset = await search(QUERY_PLACEHOLDER)
+            statement = await sync_to_async(self.prepared.add)(
+                strategy,
+                bool(cursor),
+                queryset,
+                self.get_fields(queryset),
+                self.get_page_keys(queryset),
+            )
+
+        params = [query]
+        if cursor:
+            params += self.get_cursor_values(cursor, statement.keys)
+        rows = await sync_to_async(statement.execute)(params + [limit + 1])
+
+        return self.make_page(
+            rows, statement.columns, statement.fields, statement.keys, limit, columnar
+        )
+
+    @staticmethod
+    def get_page_keys(queryset: models.QuerySet[Product]) -> List[str]:
+        # keyset pagination, ranked results are ordered by (rank, id) and the
+        # rest by id same as `Product.Meta.ordering`.
+        return ["rank", "id"] if "rank" in queryset.query.annotations else ["id"]
+
+    @staticmethod
+    def get_cursor_values(cursor: str, keys: List[str]) -> List[int | float]:
+        values = decode_cursor(cursor)
+        # booleans are ints to python, the ids are integers and the ranks
+        # finite numbers.
+        if len(values) != len(keys) or not all(
+            not isinstance(value, bool)
+            and isinstance(value, int if key == "id" else (int, float))
+            and math.isfinite(value)
+            for key, value in zip(keys, values)
+        ):
+            raise ValueError("Invalid cursor.")
+
+        return values
+
+    @staticmethod
+    def make_page(
+        rows: List[Tuple[Any, ...]],
+        columns: List[str],
+        fields: List[str],
+        keys: List[str],
+        limit: int,
+        columnar: bool = False,
+        count: Optional[int | str] = None,
+        facets: Optional[List[int]] = None,
+        has_next: bool = False,
+    ) -> SearchResult:
+        # `rows` holds up to `limit + 1` rows of `columns`, the extra one only
+        # tells there is a next page (or `has_next`).
+        next_cursor = None
+        if len(rows) > limit or (has_next and rows):
+            rows = rows[:limit]
+            next_cursor = encode_cursor([rows[-1][columns.index(k)] for k in keys])
+
+        if len(columns) > len(fields):
+            rows = [row[: len(fields)] for row in rows]
+
+        result = (
+            {"columns": fields, "rows": rows}
+            if columnar
+            else [dict(zip(fields, row)) for row in rows]
+        )
+        return {
+            "result": result,
+            "next_cursor": next_cursor,
+            "count": count,
+            "facets": facets,
+        }
+
+    async def abatch_search(self, items: List[Dict[str, Any]]) -> BatchSearchResult:
+        # `items` are {"id", "query", "type", "limit"}, the pages of all of them
+        # are read by a single UNION ALL query i.e. one round trip and one plan.
+        if not items or len(items) > self.MAX_BATCH_SIZE:
+            raise ValueError("Invalid batch.")
+        # the pages are returned by id, a repeated one would hide another.
+        ids = [str(item.get("id", i)) for i, item in enumerate(items)]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Invalid batch.")
+
+        pages: List[Tuple[str, List[str], List[str], int]] = []
+        querysets: List[models.QuerySet[Product]] = []
+        # pages of the `bm25` items, read from the in memory index.
+        engine_pages: Dict[int, SearchResult] = {}
+        for i, item in enumerate(items):
+            type = item.get("type", "ranking")
+            limit = item.get("limit") or self.DEFAULT_LIMIT
+            if type not in self.STRATEGIES:
+                raise ValueError("Invalid search type.")
+            if not isinstance(limit, int) or limit < 1:
+                raise ValueError("Invalid limit.")
+
+            query = self.prepare_query(type, str(item.get("query", "")))
+            limit = min(limit, self.MAX_LIMIT)
+            pages.append((ids[i], [], [], limit))
+            if query is None:
+                continue
+            if type == "bm25":
+                engine_pages[i] = await self.abm25_search(
+                    query, limit=limit, fields=[*self.BATCH_COLUMNS, "rank"]
+                )
+                continue
+
+            queryset = await getattr(self, f"{type}_search")(query)
+            keys = self.get_page_keys(queryset)
+            pages[i] = (pages[i][0], self.get_fields(queryset), keys, limit)
+            # every part of the union has the same columns, `batch_rank` is
+            # null for the unranked searches.
+            querysets.append(
+                queryset.annotate(
+                    batch_item=models.Value(i),
+                    batch_rank=(
+                        models.F("rank")
+                        if "rank" in keys
+                        # a bare NULL would be a text column to the union.
+                        else Cast(models.Value(None), models.FloatField())
+                    ),
+                )
+                .order_by(*[f"-{key}" for key in keys])
+                .values_list("batch_item", *self.BATCH_COLUMNS, "batch_rank")[
+                    : limit + 1
+                ]
+            )
+
+        rows: Dict[int, List[Tuple[Any, ...]]] = {i: [] for i in range(len(items))}
+        if querysets:
+            union = querysets[0].union(*querysets[1:], all=True)
+            # a union per shard, each one holds the first rows of its pages.
+            for part in await self.scatter(self.fetch_rows, union):
+                for item, *row in part:
+                    rows[item].append(tuple(row))
+
+        result: Dict[str, SearchResult] = {}
+        columns = [*self.BATCH_COLUMNS, "rank"]
+        for i, (id, fields, keys, limit) in enumerate(pages):
+            if i in engine_pages:
+                result[id] = engine_pages[i]
+                continue
+
+            # the order of a union isn't guaranteed, only the one of its parts.
+            page = sorted(
+                rows[i],
+                key=lambda row: tuple(row[columns.index(key)] for key in keys),
+                reverse=True,
+            )
+            result[id] = self.make_page(page, columns, fields, keys, limit)
+
+        return {"result": result}
+
+    async def suggest(self, prefix: str, limit: int = 10) -> List[Dict[str, Any]]:
+        if self.terms.terms is None:
+            await sync_to_async(self.terms.build, thread_sensitive=False)()
+        elif self.terms.needs_refresh():
+            self.terms.refresh_in_background()
+
+        return self.terms.suggest(prefix, limit)
+
+    async def engine_search(self, query: str) -> List[Tuple[float, int, Segment, int]]:
+        if self.engine.state is None:
+            await sync_to_async(self.engine.load, thread_sensitive=False)()
+        # e.g. right after mapping an old snapshot, it's served meanwhile.
+        if self.engine.needs_refresh():
+            self.engine.refresh_in_background()
+
+        return self.engine.search(query)
+
+    async def get_engine_rows(self, query: str) -> List[Tuple[Any, ...]]:
+        # every `bm25` match as a row of `ENGINE_COLUMNS`, by rank then id.
+        query = self.prepare_query("bm25", query)
+        if query is None:
+            return []
+
+        matches = await self.engine_search(query)
+        matches.sort(key=lambda match: match[:2], reverse=True)
+        return [self.engine.get_row(match) for match in matches]
+
+    async def abm25_search(self, query: str, **kwargs) -> SearchResult:
+        # BM25 over the in memory index, postgres is only read to build and
+        # refresh it. the query syntax is the websearch one of the others.
+        page = self.pop_options(kwargs, self.PAGE_OPTIONS)
+        filters = self.pop_options(kwargs, self.FILTER_OPTIONS)
+        # no snippets, an unset `highlight` is passed by the views.
+        if kwargs.pop("highlight", None) is not None or kwargs:
+            raise ValueError("Invalid options.")
+        if page.get("count") and page["count"] not in self.COUNT_MODES:
+            raise ValueError("Invalid count.")
+
+        fields = page.get("fields") or self.DEFAULT_FIELDS
+        if any(
+            f not in self.ENGINE_COLUMNS and f not in self.OPTIONAL_FIELDS
+            for f in fields
+        ):
+            raise ValueError("Invalid fields.")
+        fields = [f for f in fields if f in self.ENGINE_COLUMNS]
+        keys = ["rank", "id"]
+        limit = min(page.get("limit") or self.DEFAULT_LIMIT, self.MAX_LIMIT)
+
+        query = self.prepare_query("bm25", query)
+        if query is None:
+            return self.empty_page(page, filters, fields)
+
+        # (score, pk, segment, document number) of every match.
+        matches = await self.engine_search(query)
+
+        facets = None
+        if filters.get("facets"):
+            bands = self.get_price_bands(filters.get("price_bands"))
+            prices = [m[2].prices[m[3]] for m in matches]
+            facets = {
+                label: sum(1 for p in prices if p >= low and (high is None or p < high))
+                for label, low, high in bands
+            }
+
+        min_price, max_price = filters.get("min_price"), filters.get("max_price")
+        if min_price is not None or max_price is not None:
+            matches = [
+                m
+                for m in matches
+                if (min_price is None or m[2].prices[m[3]] >= min_price)
+                and (max_price is None or m[2].prices[m[3]] <= max_price)
+            ]
+
+        count = None
+        if page.get("count") == "exact":
+            count = len(matches)
+        elif page.get("count"):
+            count = (
+                f"{self.COUNT_LIMIT}+"
+                if len(matches) > self.COUNT_LIMIT
+                else len(matches)
+            )
+
+        if page.get("cursor"):
+            after = tuple(self.get_cursor_values(page["cursor"], keys))
+            matches = [m for m in matches if m[:2] < after]
+
+        rows = [
+            self.engine.get_row(match) for match in self.engine.top(matches, limit + 1)
+        ]
+        columns = fields + [key for key in keys if key not in fields]
+        rows = [
+            tuple(row[self.ENGINE_COLUMNS.index(c)] for c in columns) for row in rows
+        ]
+        result = self.make_page(
+            rows, columns, fields, keys, limit, page.get("columnar", False), count
+        )
+        result["facets"] = facets
+        return result
 
     async def get_products(self) -> models.QuerySet[Product]:
         return Product.objects.all()
 
+    async def get_indexed_products(
+        self, query: SearchQuery
+    ) -> models.QuerySet[Product]:
+        # the stored vector is matched through the GIN index, only the stale
+        # rows are vectorized on the fly.
+        stale = self.get_stale_filter()
+        return Product.objects.alias(
+            search=self.get_search_vector(config=self.CONFIG)
+        ).filter(
+            (~stale & models.Q(search_vector=query)) | (stale & models.Q(search=query))
+        )
+
     async def normal_search(self, query: str) -> models.QuerySet[Product]:
         filters = models.Q()
         for field in self.PRODUCT_SEARCH_FIELDS.keys():
@@ -41,16 +787,26 @@ class SearchService:
 
         return Product.objects.filter(filters)
 
-    async def anormal_search(self, query: str) -> List[Product]:
-        return await self.sync_to_async(await self.normal_search(query))
+    async def anormal_search(self, query: str, **kwargs) -> SearchResult:
+        return await self.search_page(self.normal_search, query, **kwargs)
+
+    async def vector_search(
+        self, query: str, use_index: Optional[bool] = None
+    ) -> models.QuerySet[Product]:
+        if use_index is None:
+            use_index = self.USE_SEARCH_INDEX
+
+        if use_index:
+            return await self.get_indexed_products(
+                SearchQuery(query, config=self.CONFIG)
+            )
 
-    async def vector_search(self, query: str) -> models.QuerySet[Product]:
         return Product.objects.annotate(
             search=SearchVector(*list(self.PRODUCT_SEARCH_FIELDS.keys()))
         ).filter(search=query)
 
-    async def avector_search(self, query: str) -> List[Product]:
-        return await self.sync_to_async(await self.vector_search(query))
+    async def avector_search(self, query: str, **kwargs) -> SearchResult:
+        return await self.search_page(self.vector_search, query, **kwargs)
 
     async def ranking_search(
         self,
@@ -58,25 +814,65 @@ class SearchService:
         min_rank: float = 0.01,
         search_type: str = "websearch",
         config: str = "english",
+        use_index: Optional[bool] = None,
+        highlight: Optional[Dict[str, Any]] = None,
     ) -> models.QuerySet[Product]:
-        vectors = [
-            SearchVector(field, weight=weight)
-            for field, weight in self.PRODUCT_SEARCH_FIELDS.items()
-        ]
+        if use_index is None:
+            use_index = self.USE_SEARCH_INDEX
+
         query = SearchQuery(query, search_type=search_type, config=config)
         weights = await self.get_weights()
 
-        return (
-            Product.objects.annotate(
-                rank=SearchRank(
-                    reduce(lambda v1, v2: v1 + v2, vectors),
-                    query,
-                    weights=weights,
+        if use_index:
+            products = await self.get_indexed_products(query)
+            vector = models.Case(
+                models.When(
+                    self.get_stale_filter(),
+                    then=self.get_search_vector(config=self.CONFIG),
+                ),
+                default=models.F("search_vector"),
+                output_field=SearchVectorField(),
+            )
+        else:
+            products = Product.objects.all()
+            vector = self.get_search_vector()
+
+        products = (
+            products.annotate(
+                # ts_rank is a real, as double precision it survives the
+                # round trip through the keyset cursors exactly.
+                rank=Cast(
+                    SearchRank(vector, query, weights=weights), models.FloatField()
                 ),
             )
             .filter(rank__gte=min_rank)
             .order_by("-rank")
         )
 
-    async def aranking_search(self, query: str) -> List[Product]:
-        return await self.sync_to_async(await self.ranking_search(query))
+        if highlight is not None:
+            products = products.annotate(
+                headline=self.get_headline(query, config, highlight)
+            )
+
+        return products
+
+    async def aranking_search(self, query: str, **kwargs) -> SearchResult:
+        return await self.search_page(self.ranking_search, query, **kwargs)
+
+    async def trigram_search(self, query: str) -> models.QuerySet[Product]:
+        # typo tolerant, `%>` matches when the query is similar enough to any
+        # word run of the document (`pg_trgm.word_similarity_threshold`) and
+        # is answered from the trigram GIN index on `search_document`.
+        return (
+            Product.objects.filter(search_document__trigram_word_similar=query)
+            .annotate(
+                rank=Cast(
+                    TrigramWordSimilarity(query, "search_document"),
+                    models.FloatField(),
+                )
+            )
+            .order_by("-rank")
+        )
+
+    async def atrigram_search(self, query: str, **kwargs) -> SearchResult:
+        return await self.search_page(self.trigram_search, query, **kwargs)
@@ -1,16 +1,50 @@
-from django.db.models.signals import pre_save
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from .cache import invalidate_search_cache
+from .engine import search_engine
 from .models import Product
+from .queue import search_index_queue
+from .services import SearchService
+from .suggest import term_index
 from .utils import prep_product_search_vector_index
 
 
 @receiver(pre_save, sender=Product)
 def product_pre_save_actions(sender, instance: Product, update_fields, **kwargs):
+    # the database trigger maintains the vector itself.
+    if getattr(settings, "SEARCH_VECTOR_TRIGGER", True):
+        return
+
     if not update_fields or (
         update_fields
-        and not any([f in update_fields for f in Product.SEARCH_VECTOR_FIELDS])
+        and not any([f in update_fields for f in SearchService.PRODUCT_SEARCH_FIELDS])
     ):
         return
 
     prep_product_search_vector_index(products=[instance], save=False)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed_actions(sender, instance: Product, **kwargs):
+    # cached search results may include the changed product, once the change
+    # is committed.
+    invalidate_search_cache(kwargs.get("using"))
+
+    term_index.mark_stale()
+    # read again into the in memory index, once the change is visible.
+    transaction.on_commit(partial(search_engine.mark_changed, instance.pk))
+
+    # the trigger only flagged the product, index it once it's committed.
+    if (
+        getattr(settings, "SEARCH_VECTOR_TRIGGER", True)
+        and getattr(settings, "SEARCH_INDEX_DEFERRED", False)
+        and getattr(settings, "SEARCH_INDEX_WORKER", False)
+        and not kwargs.get("raw", False)
+    ):
+        transaction.on_commit(search_index_queue.wake)
@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, List, Tuple
+
+from .engine import Segment, StringTable
+
+MAGIC = b"DSEARCHX"
+# bumped on any change of the layout, older snapshots are rejected.
+FORMAT_VERSION = 1
+# magic, format version, metadata length and metadata checksum.
+HEADER = struct.Struct("<8sIII")
+# sections start at multiples of it, the arrays are read in place.
+ALIGNMENT = 8
+# the buffers of a segment in file order, a dotted name is a string table
+# buffer.
+SECTIONS = [
+    "ids",
+    "names.data",
+    "names.offsets",
+    "slugs.data",
+    "slugs.offsets",
+    "prices",
+    "lengths",
+    "terms.data",
+    "terms.offsets",
+    "term_offsets",
+    "postings",
+    "posting_starts",
+    "frequencies",
+    "position_offsets",
+    "positions",
+    "words.data",
+    "words.offsets",
+    "word_lexemes.data",
+    "word_lexemes.offsets",
+]
+
+
+def get_buffer(segment: Segment, section: str) -> Tuple[str, memoryview]:
+    value = segment
+    for name in section.split("."):
+        value = getattr(value, name)
+    # an array, bytes or a view of a mapped snapshot.
+    view = memoryview(value)
+    return view.format, view.cast("B")
+
+
+def write_snapshot(path: str, segment: Segment, config: str) -> int:
+    # written next to the target and renamed over it, the workers which
+    # mapped the previous file keep reading it until they reload.
+    sections: List[Tuple[str, str, int, int]] = []
+    buffers: List[memoryview] = []
+    checksum = 0
+    offset = 0
+    for section in SECTIONS:
+        typecode, view = get_buffer(segment, section)
+        offset += -offset % ALIGNMENT
+        sections.append((section, typecode, offset, len(view)))
+        buffers.append(view)
+        offset += len(view)
+
+    for view in buffers:
+        checksum = zlib.crc32(view, checksum)
+    metadata = json.dumps(
+        {
+            "config": config,
+            "byteorder": sys.byteorder,
+            "created_at": time.time(),
+            "documents": len(segment),
+            "size": offset,
+            "checksum": checksum,
+            "sections": sections,
+        }
+    ).encode()
+    start = HEADER.size + len(metadata)
+    start += -start % ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(
+                HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata), zlib.crc32(metadata))
+            )
+            f.write(metadata)
+            for (_, _, section_offset, _), view in zip(sections, buffers):
+                f.write(b"\0" * (start + section_offset - f.tell()))
+                f.write(view)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return start + offset
+
+
+def read_snapshot(path: str, config: str) -> Tuple[Segment, Dict[str, Any]]:
+    # the arrays of the segment are views of the mapped file, nothing is
+    # copied so the page cache holds a single copy for all the workers.
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise ValueError("Invalid snapshot.")
+    magic, version, length, metadata_checksum = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("Invalid snapshot.")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}.")
+
+    metadata_bytes = view[HEADER.size : HEADER.size + length]
+    if zlib.crc32(metadata_bytes) != metadata_checksum:
+        raise ValueError("Corrupted snapshot.")
+    metadata = json.loads(bytes(metadata_bytes))
+    if metadata["byteorder"] != sys.byteorder:
+        raise ValueError("Snapshot written on a different byte order.")
+    if metadata["config"] != config:
+        raise ValueError("Snapshot of another text search configuration.")
+
+    start = HEADER.size + length
+    start += -start % ALIGNMENT
+    if len(view) != start + metadata["size"]:
+        raise ValueError("Corrupted snapshot.")
+
+    buffers: Dict[str, memoryview] = {}
+    checksum = 0
+    for section, typecode, offset, size in metadata["sections"]:
+        buffer = view[start + offset : start + offset + size]
+        checksum = zlib.crc32(buffer, checksum)
+        buffers[section] = buffer.cast(typecode)
+    if checksum != metadata["checksum"] or set(buffers) != set(SECTIONS):
+        raise ValueError("Corrupted snapshot.")
+
+    def table(name: str) -> StringTable:
+        return StringTable(buffers[f"{name}.data"], buffers[f"{name}.offsets"])
+
+    segment = Segment(
+        buffers["ids"],
+        table("names"),
+        table("slugs"),
+        buffers["prices"],
+        buffers["lengths"],
+        table("terms"),
+        buffers["term_offsets"],
+        buffers["postings"],
+        buffers["posting_starts"],
+        buffers["frequencies"],
+        buffers["position_offsets"],
+        buffers["positions"],
+        table("words"),
+        table("word_lexemes"),
+    )
+    return segment, metadata
@@ -0,0 +1,151 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, NamedTuple, Optional
+
+from django.db import connection, connections
+
+from core.routers import get_shards
+
+from .models import Product
+
+
+class Terms(NamedTuple):
+    # sorted terms and their document frequencies.
+    words: List[str]
+    frequencies: List[int]
+    # most frequent term positions for every short prefix.
+    top: Dict[str, List[int]]
+
+
+class TermIndex:
+    # seconds before the terms are rebuilt even without a local change, the
+    # products may have been changed by other processes.
+    REFRESH_INTERVAL = 300
+    # seconds between two rebuilds, ts_stat reads every document so a steady
+    # stream of writes doesn't rebuild the terms on every request.
+    MIN_REFRESH_INTERVAL = 30
+    # suggestions of prefixes up to this length are precomputed, the longer
+    # ones only span a few terms.
+    PRECOMPUTED_PREFIX_LENGTH = 2
+    MAX_SUGGESTIONS = 20
+
+    def __init__(self, config: str = "english") -> None:
+        self.config = config
+        self.terms: Optional[Terms] = None
+        self.built_at = 0.0
+        self.stale = False
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.refreshed_at = 0.0
+
+    def get_sql(self) -> str:
+        from .services import SearchService
+
+        # words of the plain `search_document`, the stemmed lexemes of
+        # `search_vector` aren't what the users type. stop words are skipped.
+        # the document of a dirty row isn't written until it's indexed, its
+        # words are read from the searched fields themselves.
+        quote_name = connection.ops.quote_name
+        table = quote_name(Product._meta.db_table)
+        fields = ", ".join(map(quote_name, SearchService.PRODUCT_SEARCH_FIELDS))
+        document = (
+            "CASE WHEN search_index_dirty OR search_vector IS NULL"
+            f" THEN concat_ws('' '', {fields}) ELSE search_document END"
+        )
+        return f"""
+            SELECT word, ndoc FROM ts_stat(
+                'SELECT to_tsvector(''simple'', {document}) FROM {table}'
+            )
+            WHERE numnode(plainto_tsquery(%s::regconfig, word)) > 0
+            ORDER BY word
+        """
+
+    def build(self) -> Terms:
+        # the document frequencies of every shard add up.
+        counts: Dict[str, int] = {}
+        try:
+            for using in get_shards() or [Product.objects.db]:
+                with connections[using].cursor() as cursor:
+                    cursor.execute(self.get_sql(), [self.config])
+                    for word, ndoc in cursor.fetchall():
+                        counts[word] = counts.get(word, 0) + ndoc
+        finally:
+            # may run from a background thread with its own connection.
+            connections.close_all()
+
+        words = sorted(counts)
+        frequencies = [counts[word] for word in words]
+        top: Dict[str, List[int]] = {}
+        for length in range(1, self.PRECOMPUTED_PREFIX_LENGTH + 1):
+            prefixes = sorted({word[:length] for word in words if len(word) >= length})
+            for prefix in prefixes:
+                top[prefix] = self.get_top(words, frequencies, prefix)
+
+        self.terms = Terms(words, frequencies, top)
+        self.built_at = time.monotonic()
+        return self.terms
+
+    def get_top(
+        self,
+        words: List[str],
+        frequencies: List[int],
+        prefix: str,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        start = bisect_left(words, prefix)
+        end = bisect_left(words, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo=start)
+        return heapq.nlargest(
+            limit or self.MAX_SUGGESTIONS,
+            range(start, end),
+            key=frequencies.__getitem__,
+        )
+
+    def mark_stale(self) -> None:
+        self.stale = True
+
+    def needs_refresh(self) -> bool:
+        now = time.monotonic()
+        if now - self.refreshed_at < self.MIN_REFRESH_INTERVAL:
+            return False
+        return self.stale or now - self.built_at > self.REFRESH_INTERVAL
+
+    def refresh_in_background(self) -> None:
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            self.refreshed_at = time.monotonic()
+            self.stale = False
+
+        def refresh():
+            try:
+                self.build()
+            except Exception:
+                self.stale = True
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[Dict[str, int | str]]:
+        # served from memory only, a rebuilt `Terms` is swapped in at once.
+        terms = self.terms
+        prefix = prefix.strip().lower()
+        if terms is None or not prefix:
+            return []
+
+        limit = min(limit, self.MAX_SUGGESTIONS)
+        if len(prefix) <= self.PRECOMPUTED_PREFIX_LENGTH:
+            positions = terms.top.get(prefix, [])[:limit]
+        else:
+            positions = self.get_top(terms.words, terms.frequencies, prefix, limit)
+
+        return [
+            {"term": terms.words[i], "frequency": terms.frequencies[i]}
+            for i in positions
+        ]
+
+
+term_index = TermIndex()
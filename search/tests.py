@@ -1,3 +1,1833 @@
-from django.test import TestCase
+import datetime
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import zlib
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import CommandError, call_command
+from django.db import DataError, OperationalError, connection, connections, transaction
+from django.http import FileResponse, JsonResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.text import slugify
+from django.utils.translation import gettext_lazy
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from core import response as core_response
+from core.backends.pooled.pool import ConnectionPool, get_pool
+from core.db import is_statement_timeout, run_isolated
+from core.metrics import Metrics, QueryRecorder, metrics
+from core.pagination import encode_cursor
+from core.response import make_response, make_success_response
+
+from .cache import MISSING, SearchCache, search_cache
+from .engine import (
+    Doc,
+    Group,
+    SearchEngine,
+    Segment,
+    decode_deltas,
+    decode_varints,
+    encode_deltas,
+    encode_varints,
+    parse_query,
+)
+from .models import Product
+from .prepared import QUERY_PLACEHOLDER, PreparedSearches
+from .queue import SearchIndexQueue
+from .services import SearchService
+from .snapshot import ALIGNMENT, HEADER
+from .suggest import TermIndex, term_index
+from .utils import (
+    create_search_vector_trigger,
+    get_index_backlog,
+    index_dirty_products,
+    index_product_range,
+    prep_product_search_vector_index,
+)
+from .views import SearchView
+
+
+class SearchTestMixin:
+    def setUp(self) -> None:
+        super().setUp()
+        # results cached by the other tests don't match these products.
+        if search_cache:
+            search_cache.bump_version()
+        self.service = SearchService()
+
+    def create_product(self, name: str, description: str = "", **kwargs) -> Product:
+        return Product.objects.create(name=name, description=description, **kwargs)
+
+    def get_ids(self, page) -> list:
+        rows = page["result"]
+        if isinstance(rows, dict):
+            return [row[rows["columns"].index("id")] for row in rows["rows"]]
+        return [row["id"] for row in rows]
+
+
+# the in process queue worker isn't started by the writes of the tests.
+@override_settings(SEARCH_INDEX_WORKER=False)
+class SearchTestCase(SearchTestMixin, TestCase):
+    pass
+
+
+# for the code running queries from other threads, they only see committed
+# rows.
+@override_settings(SEARCH_INDEX_WORKER=False)
+class SearchTransactionTestCase(SearchTestMixin, TransactionTestCase):
+    pass
+
+
+class IndexedSearchTests(SearchTestCase):
+    def test_indexed_products_are_matched_by_their_stored_vector(self):
+        product = self.create_product("Wireless Headphones", "Noise cancelling.")
+        index_dirty_products(100)
+        product.refresh_from_db()
+        self.assertIsNotNone(product.search_vector)
+
+        products = async_to_sync(self.service.vector_search)("headphones")
+        self.assertIn('"search_product"."search_vector" @@', str(products.query))
+        self.assertEqual(list(products.values_list("pk", flat=True)), [product.pk])
+
+    def test_stale_products_are_matched_through_built_vectors(self):
+        indexed = self.create_product("Studio Headphones")
+        index_dirty_products(100)
+        stale = self.create_product("Wireless Headphones")
+        Product.objects.filter(pk=stale.pk).update(
+            search_vector=None, search_index_dirty=True
+        )
+
+        products = async_to_sync(self.service.vector_search)("headphones")
+        self.assertCountEqual(
+            products.values_list("pk", flat=True), [indexed.pk, stale.pk]
+        )
+
+    def test_prep_fills_the_vector_and_document(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        Product.objects.filter(pk=product.pk).update(search_index_dirty=True)
+
+        prep_product_search_vector_index(Product.objects.filter(pk=product.pk))
+        product.refresh_from_db()
+        self.assertFalse(product.search_index_dirty)
+        self.assertEqual(product.search_document, "Garden Bench Solid oak.")
+        self.assertIn("'oak':", product.search_vector)
+
+
+@override_settings(SEARCH_INDEX_DEFERRED=False)
+class SearchVectorTriggerTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        with connection.schema_editor() as schema_editor:
+            create_search_vector_trigger(schema_editor)
+
+    def get_expected(self, product: Product) -> tuple:
+        # what the python side prep and index_products would store.
+        return (
+            Product.objects.annotate(
+                vector=SearchService.get_search_vector(config=SearchService.CONFIG),
+                document=SearchService.get_search_document(),
+            )
+            .values_list("vector", "document")
+            .get(pk=product.pk)
+        )
+
+    def assertIndexed(self, product: Product) -> None:
+        product.refresh_from_db()
+        self.assertFalse(product.search_index_dirty)
+        self.assertEqual(
+            (product.search_vector, product.search_document),
+            self.get_expected(product),
+        )
+
+    def test_inserts_are_indexed_like_get_search_vector(self):
+        self.assertIndexed(self.create_product("Garden Bench", "Solid oak, seats 3."))
+
+    def test_updates_of_the_search_fields_are_indexed(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        Product.objects.filter(pk=product.pk).update(description="Teak slats.")
+        self.assertIndexed(product)
+        self.assertIn("'teak':", product.search_vector)
+
+    def test_other_updates_keep_the_vector(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        Product.objects.filter(pk=product.pk).update(search_vector=None)
+        Product.objects.filter(pk=product.pk).update(price=10)
+        product.refresh_from_db()
+        self.assertIsNone(product.search_vector)
+
+    def test_command_follows_the_current_search_fields(self):
+        with patch.dict(SearchService.PRODUCT_SEARCH_FIELDS, {"name": "A"}, clear=True):
+            call_command("create_search_trigger", stdout=StringIO())
+            product = self.create_product("Garden Bench", "Solid oak.")
+            self.assertIndexed(product)
+
+        self.assertEqual(product.search_document, "Garden Bench")
+        self.assertNotIn("oak", product.search_vector)
+
+
+class IndexProductsTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, "index_products.checkpoint")
+        self.products = [
+            self.create_product(f"Garden Bench {i}", "Solid oak.") for i in range(5)
+        ]
+        Product.objects.update(search_index_dirty=True, search_vector=None)
+
+    def index_products(self, **options) -> None:
+        call_command(
+            "index_products",
+            batch_size=2,
+            workers=2,
+            checkpoint=self.checkpoint,
+            stdout=StringIO(),
+            **options,
+        )
+
+    def get_dirty_ids(self) -> list:
+        return sorted(
+            Product.objects.filter(SearchService.get_stale_filter()).values_list(
+                "pk", flat=True
+            )
+        )
+
+    def test_dirty_products_are_indexed_in_parallel_batches(self):
+        self.index_products()
+        self.assertEqual(self.get_dirty_ids(), [])
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(
+            set(Product.objects.values_list("search_document", flat=True)),
+            {f"{product.name} Solid oak." for product in self.products},
+        )
+
+    def test_an_interrupted_run_resumes_after_its_checkpoint(self):
+        with open(self.checkpoint, "w") as f:
+            json.dump({"full": False, "last_pk": self.products[2].pk}, f)
+
+        self.index_products()
+        self.assertEqual(self.get_dirty_ids(), [p.pk for p in self.products[:3]])
+
+    def test_a_checkpoint_of_another_mode_is_ignored(self):
+        with open(self.checkpoint, "w") as f:
+            json.dump({"full": True, "last_pk": self.products[2].pk}, f)
+
+        self.index_products()
+        self.assertEqual(self.get_dirty_ids(), [])
+
+    def test_indexed_products_are_no_longer_dirty_since(self):
+        Product.objects.update(search_index_dirty_since=timezone.now())
+        self.assertEqual(index_product_range(0, self.products[-1].pk), 5)
+        self.assertFalse(
+            Product.objects.filter(search_index_dirty_since__isnull=False).exists()
+        )
+
+    def test_full_runs_index_every_product(self):
+        Product.objects.update(search_index_dirty=False, search_document="")
+        self.index_products(full=True)
+        self.assertNotIn("", Product.objects.values_list("search_document", flat=True))
+
+
+class IngestProductsTests(SearchTestCase):
+    def ingest(self, records: list, **options) -> str:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "products.ndjson")
+        with open(path, "w") as f:
+            f.writelines(f"{json.dumps(record)}\n" for record in records)
+
+        stdout = StringIO()
+        call_command("ingest_products", path, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_products_are_upserted_by_id(self):
+        product = self.create_product("Garden Bench", "Solid oak.", price=10)
+        output = self.ingest(
+            [
+                {"id": product.pk, "name": "Garden Seat", "price": 12},
+                {"id": product.pk + 10, "name": "Kitchen Table"},
+                {"id": product.pk + 10, "name": "Kitchen Chair", "price": 5},
+                {"name": "Desk Lamp", "description": "Brass."},
+                {"model": "auth.user", "pk": 1, "fields": {"name": "Skipped"}},
+            ]
+        )
+        self.assertIn("4 Products ingested", output)
+        self.assertIn("2 inserted or updated by id, 1 inserted.", output)
+
+        self.assertEqual(
+            list(Product.objects.order_by("pk").values_list("name", "price")),
+            [("Garden Seat", 12), ("Desk Lamp", 1), ("Kitchen Chair", 5)],
+        )
+        # the next product doesn't collide with the ingested ids.
+        self.assertGreater(self.create_product("Desk").pk, product.pk + 10)
+
+    def test_ingested_products_are_slugged_and_indexed(self):
+        self.ingest(
+            [
+                {"name": "Garden  Bench -- XL!", "description": "Solid oak."},
+                {"name": "_Oak_Table (2 seats)"},
+                {"name": "Café Crème Mug", "description": "Stoneware."},
+            ]
+        )
+        for product in Product.objects.exclude(name__startswith="Caf"):
+            with self.subTest(product.name):
+                self.assertEqual(product.slug, slugify(product.name))
+                self.assertFalse(product.search_index_dirty)
+                self.assertIsNotNone(product.search_vector)
+
+        # accents are only folded by a UTF8 server of postgres 13 or later.
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW server_encoding")
+            unicode = cursor.fetchone()[0] == "UTF8" and connection.pg_version >= 130000
+        products = async_to_sync(self.service.vector_search)("stoneware")
+        self.assertEqual(
+            products.get().slug, "cafe-creme-mug" if unicode else "caf-crme-mug"
+        )
+
+    def test_older_servers_do_not_normalize(self):
+        with patch.object(connection, "pg_version", 120000), CaptureQueriesContext(
+            connection
+        ) as queries:
+            self.ingest([{"name": "Café Crème Mug"}])
+
+        self.assertFalse(any("normalize(" in q["sql"] for q in queries))
+        self.assertEqual(Product.objects.get().slug, "caf-crme-mug")
+
+    def test_the_shared_cache_version_is_bumped(self):
+        # what the serving processes see through a shared cache backend.
+        cache = search_cache.backend_cache
+        version = async_to_sync(search_cache.get_version)()
+        self.ingest([{"name": "Garden Bench"}])
+        self.assertGreater(cache.get(SearchCache.VERSION_KEY), version)
+
+    def test_invalid_input_leaves_the_products_alone(self):
+        with self.assertRaisesMessage(
+            CommandError, "Invalid product #2: Missing name."
+        ):
+            self.ingest([{"name": "Garden Bench"}, {"description": "Nameless."}])
+        self.assertFalse(Product.objects.exists())
+
+
+class KeysetPaginationTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        for i in range(7):
+            self.create_product(f"Garden Bench {i}", "Solid oak bench. " * (i % 3 + 1))
+
+    def walk(self, method, **options) -> list:
+        ids, cursor = [], None
+        while True:
+            page = async_to_sync(method)("bench", limit=3, cursor=cursor, **options)
+            self.assertLessEqual(len(self.get_ids(page)), 3)
+            ids += self.get_ids(page)
+            cursor = page["next_cursor"]
+            if not cursor:
+                return ids
+
+    def test_cursor_walks_return_every_match_once_in_order(self):
+        for method in (
+            self.service.anormal_search,
+            self.service.avector_search,
+            self.service.aranking_search,
+        ):
+            with self.subTest(method.__name__):
+                expected = self.get_ids(async_to_sync(method)("bench", limit=100))
+                self.assertEqual(len(expected), 7)
+                # the prepared statements and the orm pages.
+                self.assertEqual(self.walk(method), expected)
+                self.assertEqual(self.walk(method, count="exact"), expected)
+
+    def test_ranked_pages_are_ordered_by_rank_then_id(self):
+        page = async_to_sync(self.service.aranking_search)("bench", limit=100)
+        keys = [(row["rank"], row["id"]) for row in page["result"]]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_invalid_cursors_are_rejected(self):
+        for cursor, keys in (
+            ("not a cursor", ["id"]),
+            (encode_cursor({"id": 1}), ["id"]),
+            (encode_cursor([True]), ["id"]),
+            (encode_cursor(["1"]), ["id"]),
+            (encode_cursor([1.5]), ["id"]),
+            (encode_cursor([1, 2]), ["id"]),
+            (encode_cursor([0.5]), ["rank", "id"]),
+            (encode_cursor([False, 1]), ["rank", "id"]),
+            (encode_cursor([float("nan"), 1]), ["rank", "id"]),
+        ):
+            with self.subTest(cursor=cursor, keys=keys):
+                with self.assertRaisesMessage(ValueError, "Invalid cursor."):
+                    SearchService.get_cursor_values(cursor, keys)
+
+        self.assertEqual(
+            SearchService.get_cursor_values(encode_cursor([0.5, 3]), ["rank", "id"]),
+            [0.5, 3],
+        )
+
+
+class KeysetPaginationViewTests(SearchTransactionTestCase):
+    def test_invalid_cursors_are_bad_requests(self):
+        self.create_product("Garden Bench", "Solid oak.")
+        for type in ("vector", "ranking"):
+            for cursor in (
+                "not a cursor",
+                encode_cursor([True]),
+                encode_cursor([True, 1]),
+            ):
+                with self.subTest(type=type, cursor=cursor):
+                    response = self.client.get(
+                        f"/search/bench/{type}/", {"cursor": cursor}
+                    )
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(
+                        response.json()["errors"], {"detail": "Invalid cursor."}
+                    )
+
+
+class SearchViewTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.product = self.create_product("Garden Bench", "Solid oak.")
+
+    def test_every_strategy_is_returned(self):
+        response = self.client.get("/search/bench/")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()["data"]
+        for type in ("normal_search", "vector_search", "ranking_search"):
+            with self.subTest(type):
+                self.assertEqual(data[type]["type"], type)
+                self.assertFalse(data[type]["timed_out"])
+                self.assertEqual(data[type]["records"], 1)
+                self.assertEqual(self.get_ids(data[type]), [self.product.pk])
+
+    def test_a_slow_strategy_times_out_alone(self):
+        async def avector_search(service, query: str, **options):
+            def sleep():
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_sleep(5)")
+
+            await sync_to_async(sleep)()
+
+        with patch.object(SearchView, "TIMEOUT", 0.5), patch.object(
+            SearchService, "avector_search", avector_search
+        ):
+            start_time = time.perf_counter()
+            data = self.client.get("/search/bench/").json()["data"]
+
+        # the database gave up as well, the request didn't wait for the query.
+        self.assertLess(time.perf_counter() - start_time, 4)
+        self.assertTrue(data["vector_search"]["timed_out"])
+        self.assertEqual(data["vector_search"]["records"], 0)
+        for type in ("normal_search", "ranking_search"):
+            self.assertFalse(data[type]["timed_out"])
+            self.assertEqual(self.get_ids(data[type]), [self.product.pk])
+
+    def test_statement_timeouts_are_told_apart(self):
+        with self.assertRaises(OperationalError) as error, transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = 10")
+                cursor.execute("SELECT pg_sleep(1)")
+
+        self.assertTrue(is_statement_timeout(error.exception))
+        self.assertFalse(is_statement_timeout(OperationalError("connection lost")))
+
+    def test_other_database_errors_are_not_timeouts(self):
+        async def avector_search(service, query: str, **options):
+            raise OperationalError("server closed the connection unexpectedly")
+
+        def get_count(name: str) -> float:
+            return metrics.counters.get(name, {}).get((("strategy", "vector"),), 0)
+
+        errors, timeouts = map(
+            get_count, ("search_errors_total", "search_timeouts_total")
+        )
+        with patch.object(SearchService, "avector_search", avector_search):
+            with self.assertRaisesMessage(OperationalError, "server closed"):
+                self.client.get("/search/bench/vector/")
+
+        self.assertEqual(get_count("search_errors_total"), errors + 1)
+        self.assertEqual(get_count("search_timeouts_total"), timeouts)
+
+    def test_unknown_types_are_bad_requests(self):
+        for type in ("fuzzy", "batch"):
+            with self.subTest(type):
+                response = self.client.get(f"/search/bench/{type}/")
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json()["errors"], {"detail": "Invalid search type."}
+                )
+
+    def test_invalid_counts_are_bad_requests(self):
+        for url in ("/search/bench/", "/search/bench/vector/"):
+            with self.subTest(url):
+                response = self.client.get(url, {"count": "bogus"})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json()["errors"], {"detail": "Invalid count."}
+                )
+
+    def test_counts_are_exact_or_estimated(self):
+        self.create_product("Kitchen Bench", "Solid pine.")
+        for count in ("exact", "estimate", "true"):
+            with self.subTest(count):
+                response = self.client.get("/search/bench/vector/", {"count": count})
+                self.assertEqual(response.json()["data"]["count"], 2)
+
+        # the pages above are cached with their counts.
+        if search_cache:
+            search_cache.bump_version()
+        with patch.object(SearchService, "COUNT_LIMIT", 1):
+            data = self.client.get("/search/bench/vector/", {"count": "estimate"})
+            self.assertEqual(data.json()["data"]["count"], "1+")
+            data = self.client.get("/search/bench/vector/", {"count": "exact"})
+            self.assertEqual(data.json()["data"]["count"], 2)
+
+
+class ShardedSearchTests(SearchTransactionTestCase):
+    # two shards as two schemas of the test database, each one with its own
+    # products table.
+    SHARDS = ["shard_0", "shard_1"]
+
+    def setUp(self) -> None:
+        super().setUp()
+        with connection.cursor() as cursor:
+            for alias in self.SHARDS:
+                cursor.execute(f"CREATE SCHEMA {alias}")
+                cursor.execute(
+                    f"CREATE TABLE {alias}.search_product "
+                    "(LIKE public.search_product INCLUDING ALL)"
+                )
+        self.addCleanup(self.drop_shards)
+
+        for alias in self.SHARDS:
+            settings = connection.settings_dict
+            connections.settings[alias] = {
+                **settings,
+                "OPTIONS": {
+                    **settings["OPTIONS"],
+                    "options": f"-c search_path={alias},public",
+                },
+            }
+        patcher = patch.object(SearchService, "shards", self.SHARDS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # ids are unique across the shards.
+        self.ids = {"shard_0": [1, 3, 5], "shard_1": [2, 4]}
+        for alias, ids in self.ids.items():
+            for id in ids:
+                Product.objects.using(alias).create(
+                    id=id, name=f"Garden Bench {id}", description="Solid oak."
+                )
+
+    def drop_shards(self) -> None:
+        for alias in self.SHARDS:
+            connections[alias].close()
+            connections[alias].pool.close()
+            del connections[alias]
+            del connections.settings[alias]
+        with connection.cursor() as cursor:
+            for alias in self.SHARDS:
+                cursor.execute(f"DROP SCHEMA {alias} CASCADE")
+
+    def test_the_pages_of_the_shards_are_merged(self):
+        page = async_to_sync(self.service.avector_search)(
+            "bench", limit=2, count="exact"
+        )
+        self.assertEqual(self.get_ids(page), [5, 4])
+        self.assertEqual(page["count"], 5)
+
+        ids, cursor = [], None
+        while True:
+            page = async_to_sync(self.service.avector_search)(
+                "bench", limit=2, cursor=cursor
+            )
+            ids += self.get_ids(page)
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(ids, [5, 4, 3, 2, 1])
+
+        page = async_to_sync(self.service.aranking_search)("bench", limit=10)
+        keys = [(row["rank"], row["id"]) for row in page["result"]]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertCountEqual([id for _, id in keys], [1, 2, 3, 4, 5])
+
+    def test_the_shards_inherit_the_timeout_and_recorder(self):
+        async def get_timeout(queryset) -> str:
+            def get() -> str:
+                with connections[queryset.db].cursor() as cursor:
+                    cursor.execute("SHOW statement_timeout")
+                    return cursor.fetchone()[0]
+
+            return await sync_to_async(get)()
+
+        async def scatter():
+            return await self.service.scatter(get_timeout, Product.objects.all())
+
+        recorder = QueryRecorder()
+        timeouts = async_to_sync(run_isolated)(scatter, timeout=2, recorder=recorder)
+        self.assertEqual(timeouts, ["2s", "2s"])
+        # the query of every shard.
+        self.assertEqual(recorder.queries, 2)
+
+
+class SearchCacheTests(SearchTestCase):
+    def search(self, query: str = "bench") -> list:
+        return self.get_ids(async_to_sync(self.service.avector_search)(query))
+
+    def test_results_are_cached(self):
+        product = self.create_product("Garden Bench")
+        self.assertEqual(self.search(), [product.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search(), [product.pk])
+
+    def test_saves_and_deletes_invalidate_the_results(self):
+        product = self.create_product("Garden Bench")
+        self.assertEqual(self.search(), [product.pk])
+        version = async_to_sync(search_cache.get_version)()
+        with self.captureOnCommitCallbacks(execute=True):
+            other = self.create_product("Park Bench")
+            # a search before the commit would cache the old rows again.
+            self.assertEqual(async_to_sync(search_cache.get_version)(), version)
+        self.assertEqual(self.search(), [other.pk, product.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.search(), [other.pk])
+
+    def test_bulk_writes_invalidate_the_results(self):
+        product = self.create_product("Garden Bench")
+        self.assertEqual(self.search(), [product.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Product.objects.bulk_create([Product(name="Park Bench")])[0]
+        self.assertEqual(self.search(), [other.pk, product.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=other.pk).update(name="Park Chair")
+        self.assertEqual(self.search(), [product.pk])
+
+        product.name = "Garden Chair"
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.bulk_update([product], ["name"])
+        self.assertEqual(self.search(), [])
+        self.assertEqual(self.search("chair"), [other.pk, product.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=other.pk).delete()
+        self.assertEqual(self.search("chair"), [product.pk])
+
+    def test_rolled_back_writes_keep_the_results(self):
+        self.create_product("Garden Bench")
+        version = search_cache.version
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Product.objects.update(price=2)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(search_cache.version, version)
+
+    def test_the_queue_invalidates_the_indexed_results(self):
+        product = self.create_product("Garden Bench")
+        Product.objects.filter(pk=product.pk).update(search_index_dirty=True)
+        version = search_cache.version
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(SearchIndexQueue().process_batch(), 1)
+        self.assertGreater(search_cache.version, version)
+
+        version = search_cache.version
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.assertEqual(SearchIndexQueue().process_batch(), 0)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(search_cache.version, version)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SearchCache(maxsize=2, ttl=60, backend=None)
+        for key in ("a", "b"):
+            cache.set_local(key, key)
+        self.assertEqual(cache.get_local("a"), "a")
+        cache.set_local("c", "c")
+
+        self.assertIs(cache.get_local("b"), MISSING)
+        self.assertEqual(cache.get_local("a"), "a")
+        self.assertEqual(cache.get_local("c"), "c")
+        self.assertEqual(
+            cache.stats(),
+            {
+                "hits": 3,
+                "backend_hits": 0,
+                "misses": 0,
+                "evictions": 1,
+                "size": 2,
+                "maxsize": 2,
+            },
+        )
+
+    def test_entries_expire(self):
+        cache = SearchCache(maxsize=2, ttl=60, backend=None)
+        cache.set_local("a", "a")
+        with patch("search.cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIs(cache.get_local("a"), MISSING)
+
+    def test_the_counters_are_exact_across_threads(self):
+        cache = SearchCache(maxsize=1, ttl=60, backend=None)
+        calls = async_to_sync(cache.get_or_call)
+
+        async def call():
+            return 1
+
+        def run():
+            for i in range(200):
+                calls(str(i % 2), call)
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 800)
+        self.assertEqual(stats["evictions"], stats["misses"] - 1)
+
+
+class IndexProductsCacheTests(SearchTransactionTestCase):
+    def test_index_products_invalidates_the_results(self):
+        self.create_product("Garden Bench")
+        Product.objects.update(search_index_dirty=True)
+        version = search_cache.version
+        call_command(
+            "index_products",
+            checkpoint=os.path.join(tempfile.gettempdir(), "cache.checkpoint"),
+            stdout=StringIO(),
+        )
+        self.assertGreater(search_cache.version, version)
+
+
+class TrigramSearchTests(SearchTestCase):
+    def test_typos_are_tolerated(self):
+        product = self.create_product("Wireless Headphones", "Noise cancelling.")
+        self.create_product("Garden Bench", "Solid oak.")
+        index_dirty_products(100)
+
+        page = async_to_sync(self.service.atrigram_search)("headphnes")
+        self.assertEqual(self.get_ids(page), [product.pk])
+        self.assertGreater(page["result"][0]["rank"], 0)
+
+
+class SearchEngineTests(SimpleTestCase):
+    def make_segment(self, docs: dict) -> Segment:
+        # {pk: text}, every word is its own lexeme with the "A" weight.
+        words = {word for text in docs.values() for word in text.split()}
+        return Segment.build(
+            [
+                Doc(
+                    pk,
+                    text,
+                    text.replace(" ", "-"),
+                    1.0,
+                    [
+                        (word, positions, "A" * len(positions))
+                        for word in sorted(set(text.split()))
+                        for positions in [
+                            [i for i, w in enumerate(text.split(), 1) if w == word]
+                        ]
+                    ],
+                )
+                for pk, text in sorted(docs.items())
+            ],
+            {word: word for word in words},
+            SearchService.WEIGHTS,
+        )
+
+    def make_engine(self, docs: dict) -> SearchEngine:
+        engine = SearchEngine()
+        engine.set_state(self.make_segment(docs), None, frozenset())
+        return engine
+
+    def get_score(self, frequency, length, df, doc_count, average_length) -> float:
+        # BM25 of a single term, by hand.
+        k1, b = SearchEngine.K1, SearchEngine.B
+        idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+        norm = 1 - b + b * length / average_length
+        return idf * frequency * (k1 + 1) / (frequency + k1 * norm)
+
+    def search(self, engine: SearchEngine, query: str) -> list:
+        return [(pk, score) for score, pk, *_ in engine.top(engine.search(query), 10)]
+
+    def test_queries_are_parsed_into_or_groups(self):
+        self.assertEqual(
+            parse_query('Oak bench OR "garden seat" -pine'),
+            [
+                Group([[("oak", 0)], [("bench", 0)]], []),
+                Group([[("garden", 0), ("seat", 1)]], [[("pine", 0)]]),
+            ],
+        )
+        # punctuated words are phrases, groups without a clause are dropped.
+        self.assertEqual(
+            parse_query("or oak-bench or -pine or"),
+            [Group([[("oak", 0), ("bench", 1)]], [])],
+        )
+        self.assertEqual(parse_query('-oak ""'), [])
+
+    def test_varints_and_deltas_round_trip(self):
+        values = [0, 1, 127, 128, 300, 2**40]
+        data = encode_varints(values)
+        self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 6)
+        self.assertEqual(decode_varints(data, 0, len(data)), values)
+
+        values = [1, 2, 3, 200, 100000]
+        data = encode_deltas(values)
+        self.assertEqual(data[:3], bytes([1, 1, 1]))
+        self.assertEqual(decode_deltas(data, 0, len(data)), values)
+        self.assertEqual(decode_deltas(b"\x00" + data, 1, len(data) + 1), values)
+
+    def test_matches_are_scored_by_bm25(self):
+        engine = self.make_engine({1: "oak bench", 2: "oak table oak", 3: "pine table"})
+        a = SearchService.WEIGHTS["A"]
+        # lengths are the weighted frequencies of every lexeme.
+        lengths = {1: 2 * a, 2: 3 * a, 3: 2 * a}
+        average = sum(lengths.values()) / 3
+        oak = {
+            1: self.get_score(a, lengths[1], 2, 3, average),
+            2: self.get_score(2 * a, lengths[2], 2, 3, average),
+        }
+        table = {pk: self.get_score(a, lengths[pk], 2, 3, average) for pk in (2, 3)}
+
+        results = self.search(engine, "oak")
+        self.assertEqual([pk for pk, _ in results], [2, 1])
+        for pk, score in results:
+            self.assertAlmostEqual(score, oak[pk], places=5)
+
+        results = dict(self.search(engine, "oak or table"))
+        self.assertEqual(list(results), [2, 3, 1])
+        self.assertAlmostEqual(results[2], oak[2] + table[2], places=5)
+        self.assertEqual([pk for pk, _ in self.search(engine, "oak -table")], [1])
+
+    def test_deleted_and_edited_products_are_masked(self):
+        engine = self.make_engine(
+            {1: "oak bench", 2: "oak bench", 3: "oak bench", 4: "pine table"}
+        )
+        # 4 was edited and 3 deleted since the base was built.
+        delta = self.make_segment({4: "oak bench"})
+        with patch.object(engine, "build_segment", return_value=delta) as build:
+            engine.refresh({3, 4})
+        build.assert_called_once_with([3, 4])
+        self.assertEqual(engine.state.doc_count, 3)
+
+        results = self.search(engine, "oak")
+        self.assertCountEqual([pk for pk, _ in results], [1, 2, 4])
+        # the same document scores the same in the base and the delta.
+        self.assertEqual(len({round(score, 6) for _, score in results}), 1)
+        self.assertEqual(self.search(engine, "pine"), [])
+
+
+class SearchEngineSnapshotTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "search_engine.idx")
+        self.product = self.create_product("Garden Bench", "Solid oak.")
+        SearchEngine().save_snapshot(self.path)
+
+    def load(self, engine: SearchEngine) -> bool:
+        # whether the index was built from the database.
+        with patch.object(engine, "build", wraps=engine.build) as build:
+            engine.load()
+        return build.called
+
+    def search(self, engine: SearchEngine, query: str = "bench") -> list:
+        return sorted(match[1] for match in engine.search(query))
+
+    def rewrite(self, version: int = 0, **metadata) -> None:
+        with open(self.path, "rb") as f:
+            data = f.read()
+        magic, old_version, length, _ = HEADER.unpack_from(data)
+        start = HEADER.size + length
+        body = data[start + -start % ALIGNMENT :]
+        content = json.dumps(
+            {**json.loads(data[HEADER.size : start]), **metadata}
+        ).encode()
+        header = HEADER.pack(
+            magic, version or old_version, len(content), zlib.crc32(content)
+        )
+        start = HEADER.size + len(content)
+        with open(self.path, "wb") as f:
+            f.write(header + content + b"\0" * (-start % ALIGNMENT) + body)
+
+    def test_snapshots_are_mapped_instead_of_built(self):
+        engine = SearchEngine(snapshot=self.path)
+        self.assertFalse(self.load(engine))
+        self.assertEqual(self.search(engine), [self.product.pk])
+        self.assertEqual(
+            engine.get_row(engine.search("oak")[0])[:4],
+            (self.product.pk, "Garden Bench", self.product.slug, self.product.price),
+        )
+        self.assertFalse(engine.needs_refresh())
+
+    def test_invalid_snapshots_are_built_from_the_database(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        length = HEADER.unpack_from(data)[2]
+        metadata = json.loads(data[HEADER.size : HEADER.size + length])
+        sections = [
+            [name, None, offset, size] for name, _, offset, size in metadata["sections"]
+        ]
+        for name, options in (
+            ("version", {"version": 99}),
+            ("checksum", {"checksum": metadata["checksum"] + 1}),
+            ("sections", {"sections": sections}),
+        ):
+            with self.subTest(name):
+                SearchEngine().save_snapshot(self.path)
+                self.rewrite(**options)
+                engine = SearchEngine(snapshot=self.path)
+                self.assertTrue(self.load(engine))
+                self.assertEqual(self.search(engine), [self.product.pk])
+
+    def test_old_snapshots_are_built_again_on_refresh(self):
+        engine = SearchEngine(snapshot=self.path)
+        engine.load()
+        # written by another process, no local change is marked.
+        other = self.create_product("Kitchen Bench", "Solid pine.")
+
+        self.assertFalse(self.load(engine))
+        self.assertEqual(self.search(engine), [self.product.pk])
+
+        old = time.time() - SearchEngine.REFRESH_INTERVAL - 60
+        os.utime(self.path, (old, old))
+        self.assertTrue(self.load(engine))
+        self.assertEqual(self.search(engine), [self.product.pk, other.pk])
+
+    def test_old_snapshots_are_mapped_at_startup_then_refreshed(self):
+        old = time.time() - SearchEngine.REFRESH_INTERVAL - 60
+        os.utime(self.path, (old, old))
+        engine = SearchEngine(snapshot=self.path)
+        with patch.object(engine, "build") as build, patch.object(
+            engine, "refresh_in_background"
+        ) as refresh, patch.object(SearchService, "engine", engine):
+            page = async_to_sync(self.service.abm25_search)("bench")
+
+        # the first search is served by the snapshot, the index is built
+        # again in the background.
+        build.assert_not_called()
+        refresh.assert_called_once_with()
+        self.assertEqual(self.get_ids(page), [self.product.pk])
+
+
+class BatchSearchViewTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.product = self.create_product("Garden Bench", "Solid oak.")
+        self.create_product("Kitchen Table", "Solid pine.")
+        index_dirty_products(100)
+
+    def post(self, items):
+        return self.client.post(
+            "/batch-search/", json.dumps(items), content_type="application/json"
+        )
+
+    def test_every_strategy_is_batched(self):
+        items = [
+            {"id": type, "query": "bench", "type": type}
+            for type in SearchService.STRATEGIES
+        ]
+        with patch.object(SearchService, "engine", SearchEngine()):
+            response = self.post(items)
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["data"]["result"]
+        self.assertEqual(list(result), list(SearchService.STRATEGIES))
+        for type in SearchService.STRATEGIES:
+            with self.subTest(type):
+                self.assertEqual(self.get_ids(result[type]), [self.product.pk])
+
+        self.assertEqual(
+            list(result["bm25"]["result"][0]), ["id", "name", "slug", "price", "rank"]
+        )
+
+    def test_repeated_ids_are_bad_requests(self):
+        for items in (
+            [{"id": "a", "query": "bench"}, {"id": "a", "query": "table"}],
+            # the default id is the position of the item.
+            [{"query": "bench"}, {"id": "0", "query": "table"}],
+        ):
+            with self.subTest(items=items):
+                response = self.post(items)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json()["errors"], {"detail": "Invalid batch."}
+                )
+
+
+class SuggestTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # built again from the products of the test.
+        patcher = patch.object(term_index, "terms", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.create_product("Wireless Headphones", "Headphones for the garden.")
+        self.create_product("Studio Headphones", "Wired.")
+        self.create_product("Garden Bench", "Solid oak.")
+        index_dirty_products(100)
+
+    def test_terms_are_suggested_by_frequency(self):
+        response = self.client.get("/suggest/h/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["data"]["result"],
+            [{"term": "headphones", "frequency": 2}],
+        )
+        terms = self.client.get("/suggest/gar/", {"limit": 1}).json()["data"]
+        self.assertEqual(terms["result"], [{"term": "garden", "frequency": 2}])
+
+    def test_dirty_products_are_suggested(self):
+        # not indexed yet, the deferred indexing hasn't written its document.
+        self.create_product("Garden Lantern")
+        Product.objects.filter(name="Garden Lantern").update(
+            search_index_dirty=True, search_document=""
+        )
+        terms = self.client.get("/suggest/lan/").json()["data"]
+        self.assertEqual(terms["result"], [{"term": "lantern", "frequency": 1}])
+        terms = self.client.get("/suggest/gar/").json()["data"]
+        self.assertEqual(terms["result"], [{"term": "garden", "frequency": 3}])
+
+    def test_invalid_limits_are_bad_requests(self):
+        self.assertEqual(self.client.get("/suggest/h/?limit=0").status_code, 400)
+
+    def test_search_paths_are_queries(self):
+        # "suggest" and "batch-search" are searched like any other word.
+        self.create_product("Batch Suggest")
+        index_dirty_products(100)
+        for path in ("/search/suggest/", "/search/batch-search/"):
+            with self.subTest(path):
+                response = self.client.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn("normal_search", response.json()["data"])
+        # a search of the "ba" type, not the suggestions of "ba".
+        response = self.client.get("/search/suggest/ba/")
+        self.assertEqual(response.json()["errors"], {"detail": "Invalid search type."})
+
+    def test_rebuilds_are_debounced(self):
+        terms = TermIndex()
+        terms.build()
+        self.assertFalse(terms.needs_refresh())
+
+        terms.mark_stale()
+        self.assertTrue(terms.needs_refresh())
+        with patch.object(threading, "Thread"):
+            terms.refresh_in_background()
+        # written again while it was rebuilt.
+        terms.mark_stale()
+        self.assertFalse(terms.needs_refresh())
+
+        later = time.monotonic() + TermIndex.MIN_REFRESH_INTERVAL
+        with patch("search.suggest.time.monotonic", return_value=later):
+            self.assertTrue(terms.needs_refresh())
+
+
+class BenchmarkSearchTests(SearchTransactionTestCase):
+    def benchmark(self, **options) -> str:
+        stdout = StringIO()
+        options = {"iterations": 2, "strategies": "normal,vector", **options}
+        call_command("benchmark_search", stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_synthetic_products_are_generated_and_benchmarked(self):
+        output = self.benchmark(generate=5, batch_size=2, explain=True)
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertIn("5 / 5 Products generated.", output)
+        self.assertRegex(output, r"\nnormal +[\d.]+ +[\d.]+ +[\d.]+ +[\d.]+\n")
+        self.assertRegex(output, r"\nvector +[\d.]+ +[\d.]+ +[\d.]+ +[\d.]+\n")
+        self.assertIn("vector search:", output)
+        self.assertIn("Execution Time", output)
+
+    def test_the_benchmarked_page_is_explained(self):
+        self.create_product("Oak Table")
+        with self.settings(SEARCH_PREPARED_STATEMENTS=True):
+            output = self.benchmark(strategies="vector", explain=True)
+        # the prepared statement of the page, not a query built for it.
+        self.assertIn("EXECUTE ", output)
+        self.assertIn("Execution Time", output)
+
+    def test_clear_only_deletes_the_synthetic_products(self):
+        # real slugs may end or start with the words of the marker.
+        products = [
+            self.create_product("Garden Bench"),
+            self.create_product("Bench Vice"),
+            self.create_product("_Bench- Cover"),
+        ]
+        self.benchmark(generate=3)
+        self.assertEqual(Product.objects.count(), 6)
+
+        output = self.benchmark(clear=True)
+        self.assertIn("3 synthetic Products deleted.", output)
+        self.assertCountEqual(
+            Product.objects.values_list("pk", flat=True), [p.pk for p in products]
+        )
+
+    def test_unknown_strategies_are_refused(self):
+        for strategy in ("fuzzy", "batch"):
+            with self.subTest(strategy):
+                with self.assertRaisesMessage(
+                    CommandError, f"Unknown search strategy {strategy}."
+                ):
+                    self.benchmark(strategies=strategy)
+
+
+class ExportViewTests(SearchTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.products = [
+            self.create_product(f"Garden Bench {i}", "Solid oak.", price=i)
+            for i in range(3)
+        ]
+        index_dirty_products(100)
+
+    def test_csv_exports_are_streamed(self):
+        response = self.client.get("/search/bench/vector/export/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="results.csv"'
+        )
+        lines = response.getvalue().decode().splitlines()
+        self.assertEqual(lines[0], "id,name,slug,price,description")
+        self.assertEqual(
+            [int(line.split(",")[0]) for line in lines[1:]],
+            [product.pk for product in reversed(self.products)],
+        )
+
+    def test_ndjson_exports_carry_the_rank(self):
+        response = self.client.get(
+            "/search/bench/ranking/export/", {"format": "ndjson"}
+        )
+        rows = [json.loads(line) for line in response.getvalue().splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(
+            list(rows[0]), ["id", "name", "slug", "price", "rank", "description"]
+        )
+
+    def test_bm25_exports_are_read_from_the_index(self):
+        with patch.object(SearchService, "engine", SearchEngine()):
+            response = self.client.get("/search/bench/bm25/export/")
+
+        self.assertEqual(response.status_code, 200)
+        lines = response.getvalue().decode().splitlines()
+        self.assertEqual(lines[0], "id,name,slug,price,rank")
+        self.assertCountEqual(
+            [int(line.split(",")[0]) for line in lines[1:]],
+            [product.pk for product in self.products],
+        )
+
+    def test_asgi_exports_are_spooled_off_the_event_loop(self):
+        async def get():
+            return await self.async_client.get("/search/bench/vector/export/")
+
+        response = async_to_sync(get)()
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="results.csv"'
+        )
+        expected = self.client.get("/search/bench/vector/export/").getvalue()
+        self.assertEqual(response["Content-Length"], str(len(expected)))
+        self.assertEqual(response.getvalue(), expected)
+
+    def test_invalid_types_and_formats_are_bad_requests(self):
+        for path in (
+            "/search/bench/fuzzy/export/",
+            "/search/bench/vector/export/?format=xml",
+        ):
+            with self.subTest(path):
+                self.assertEqual(self.client.get(path).status_code, 400)
+
+
+class MakeResponseTests(SimpleTestCase):
+    def get_data(self) -> dict:
+        return {
+            "created": datetime.datetime(2022, 10, 28, 13, 20, 5, 123456),
+            "aware": datetime.datetime(
+                2022, 10, 28, 13, 20, tzinfo=datetime.timezone.utc
+            ),
+            "day": datetime.date(2022, 10, 28),
+            "time": datetime.time(13, 20, 5, 123456),
+            "price": Decimal("9.90"),
+            "label": gettext_lazy("Search"),
+            "rows": [[1, "Garden Bench", 2.5]],
+            "ids": {1: "one"},
+        }
+
+    def test_the_encoders_agree_with_json_response(self):
+        expected = JsonResponse(
+            make_success_response(self.get_data(), ""), safe=False
+        ).content
+        expected = json.loads(expected)
+        for orjson in (core_response.orjson, None):
+            with self.subTest(orjson=orjson):
+                with patch.object(core_response, "orjson", orjson):
+                    content = make_response(self.get_data()).content
+                self.assertEqual(json.loads(content), expected)
+
+        self.assertEqual(expected["data"]["aware"], "2022-10-28T13:20:00Z")
+        self.assertEqual(expected["data"]["created"], "2022-10-28T13:20:05.123")
+
+    def test_errors_are_bad_requests(self):
+        content = make_response(errors={"detail": "Invalid limit."}, status=400)
+        self.assertEqual(content.status_code, 400)
+        self.assertEqual(
+            json.loads(content.content),
+            {"errors": {"detail": "Invalid limit."}, "message": "Invalid Data."},
+        )
+
+
+class FieldProjectionTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.product = self.create_product("Garden Bench", "Solid oak.", price=120)
+
+    def test_rows_are_lean_by_default(self):
+        page = async_to_sync(self.service.aranking_search)("bench")
+        self.assertEqual(
+            list(page["result"][0]), ["id", "name", "slug", "price", "rank"]
+        )
+        page = async_to_sync(self.service.avector_search)("bench")
+        self.assertEqual(list(page["result"][0]), ["id", "name", "slug", "price"])
+
+    def test_fields_are_projected(self):
+        for method in (self.service.avector_search, self.service.aranking_search):
+            with self.subTest(method.__name__):
+                page = async_to_sync(method)("bench", fields=["name", "description"])
+                self.assertEqual(
+                    page["result"],
+                    [{"name": "Garden Bench", "description": "Solid oak."}],
+                )
+
+    def test_pages_are_columnar_on_demand(self):
+        page = async_to_sync(self.service.avector_search)(
+            "bench", fields=["id", "price"], columnar=True
+        )
+        self.assertEqual(
+            page["result"],
+            {"columns": ["id", "price"], "rows": [(self.product.pk, 120.0)]},
+        )
+
+    def test_unknown_fields_are_rejected(self):
+        for fields in (["bogus"], ["search_vector_x"], ["rank", "__class__"]):
+            with self.subTest(fields=fields):
+                with self.assertRaisesMessage(ValueError, "Invalid fields."):
+                    async_to_sync(self.service.avector_search)("bench", fields=fields)
+
+
+class FieldProjectionViewTests(SearchTransactionTestCase):
+    def test_unknown_fields_are_bad_requests(self):
+        self.create_product("Garden Bench", "Solid oak.")
+        for path in ("/search/bench/", "/search/bench/vector/"):
+            with self.subTest(path):
+                response = self.client.get(path, {"fields": "name,bogus"})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json()["errors"], {"detail": "Invalid fields."}
+                )
+
+    def test_columnar_pages_of_every_strategy(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        data = self.client.get(
+            "/search/bench/", {"fields": "id,description", "layout": "columns"}
+        ).json()["data"]
+        for type in ("normal_search", "vector_search", "ranking_search"):
+            with self.subTest(type):
+                self.assertEqual(
+                    data[type]["result"],
+                    {
+                        "columns": ["id", "description"],
+                        "rows": [[product.pk, "Solid oak."]],
+                    },
+                )
+                self.assertEqual(data[type]["records"], 1)
+
+
+class HighlightTests(SearchTestCase):
+    def test_snippets_are_highlighted(self):
+        self.create_product("Garden Bench", "A solid oak bench for the garden.")
+        page = async_to_sync(self.service.aranking_search)(
+            "oak", highlight={"start_sel": "[", "stop_sel": "]"}
+        )
+        self.assertIn("[oak]", page["result"][0]["headline"])
+
+    def test_headlines_are_only_added_on_demand(self):
+        self.create_product("Garden Bench", "A solid oak bench.")
+        page = async_to_sync(self.service.aranking_search)("oak")
+        self.assertNotIn("headline", page["result"][0])
+
+    def test_invalid_word_counts_are_rejected(self):
+        for highlight in (
+            {"max_words": 0},
+            {"min_words": 0},
+            {"min_words": 50},
+            {"min_words": 10, "max_words": 10},
+            {"color": "red"},
+        ):
+            with self.subTest(highlight=highlight):
+                with self.assertRaisesMessage(ValueError, "Invalid highlight options."):
+                    async_to_sync(self.service.aranking_search)(
+                        "oak", highlight=highlight
+                    )
+
+
+class HighlightViewTests(SearchTransactionTestCase):
+    def test_invalid_word_counts_are_bad_requests(self):
+        self.create_product("Garden Bench", "A solid oak bench.")
+        for path in ("/search/oak/", "/search/oak/ranking/"):
+            for params in (
+                {"min_words": "50"},
+                {"max_words": "0"},
+                {"max_words": "abc"},
+            ):
+                with self.subTest(path=path, params=params):
+                    response = self.client.get(path, {"highlight": "true", **params})
+                    self.assertEqual(response.status_code, 400)
+
+    def test_snippets_of_the_ranking_search(self):
+        self.create_product("Garden Bench", "A solid oak bench.")
+        data = self.client.get(
+            "/search/oak/", {"highlight": "true", "min_words": "1", "max_words": "3"}
+        ).json()["data"]
+        self.assertIn("<b>oak</b>", data["ranking_search"]["result"][0]["headline"])
+        self.assertNotIn("headline", data["vector_search"]["result"][0])
+
+    def test_the_bm25_search_refuses_snippets(self):
+        self.create_product("Garden Bench", "A solid oak bench.")
+        with patch.object(SearchService, "engine", SearchEngine()):
+            response = self.client.get("/search/oak/bm25/", {"highlight": "true"})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["errors"], {"detail": "Invalid options."})
+
+            response = self.client.get("/search/oak/bm25/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["data"]["records"], 1)
+
+
+class PriceFilterTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.products = [
+            self.create_product(f"Garden Bench {price}", "Solid oak.", price=price)
+            for price in (5, 10, 30, 600)
+        ]
+
+    def test_matches_are_narrowed_by_price(self):
+        page = async_to_sync(self.service.avector_search)(
+            "bench", min_price=10, max_price=30
+        )
+        self.assertEqual(self.get_ids(page), [self.products[2].pk, self.products[1].pk])
+
+    def test_facets_count_every_match_per_band(self):
+        page = async_to_sync(self.service.aranking_search)(
+            "bench", facets=True, max_price=5, limit=1
+        )
+        self.assertEqual(self.get_ids(page), [self.products[0].pk])
+        # the price filters don't apply to the facets.
+        self.assertEqual(
+            page["facets"],
+            {
+                "0-10": 1,
+                "10-25": 1,
+                "25-50": 1,
+                "50-100": 0,
+                "100-250": 0,
+                "250-500": 0,
+                "500+": 1,
+            },
+        )
+
+    def test_custom_price_bands(self):
+        page = async_to_sync(self.service.anormal_search)(
+            "bench", facets=True, price_bands=[100, 0]
+        )
+        self.assertEqual(page["facets"], {"0-100": 3, "100+": 1})
+
+    def test_facets_without_matches(self):
+        page = async_to_sync(self.service.avector_search)(
+            "chair", facets=True, price_bands=[0, 10]
+        )
+        self.assertEqual(page["result"], [])
+        self.assertEqual(page["facets"], {"0-10": 0, "10+": 0})
+
+
+class PriceFilterViewTests(SearchTransactionTestCase):
+    def test_filters_and_facets_of_the_query_string(self):
+        cheap = self.create_product("Garden Bench", "Solid oak.", price=5)
+        self.create_product("Park Bench", "Solid oak.", price=50)
+        data = self.client.get(
+            "/search/bench/vector/",
+            {"max_price": "10", "facets": "true", "price_bands": "0,10"},
+        ).json()["data"]
+        self.assertEqual(self.get_ids(data), [cheap.pk])
+        self.assertEqual(data["facets"], {"0-10": 1, "10+": 1})
+
+    def test_invalid_filters_are_bad_requests(self):
+        for params in ({"min_price": "cheap"}, {"price_bands": "0,x"}):
+            with self.subTest(params=params):
+                response = self.client.get("/search/bench/", params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json()["errors"], {"detail": "Invalid price filters."}
+                )
+
+
+class PreparedSearchTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.service.cache = None
+        self.service.prepared = PreparedSearches()
+        self.products = [
+            self.create_product(f"Garden Bench {i}", "Solid oak.") for i in range(3)
+        ]
+
+    def get_prepared(self) -> list:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM pg_prepared_statements")
+            return [name for name, in cursor.fetchall()]
+
+    def test_plain_pages_are_read_through_prepared_statements(self):
+        for method in (
+            self.service.anormal_search,
+            self.service.avector_search,
+            self.service.aranking_search,
+        ):
+            with self.subTest(method.__name__):
+                page = async_to_sync(method)("bench", limit=2)
+                statement = self.service.prepared.get(method.__name__[1:], False)
+                self.assertIn(statement.name, self.get_prepared())
+
+                after = async_to_sync(method)(
+                    "bench", limit=2, cursor=page["next_cursor"]
+                )
+                # the same pages as the orm.
+                self.service.prepared = None
+                self.assertEqual(
+                    async_to_sync(method)("bench", limit=2)["result"], page["result"]
+                )
+                self.assertEqual(
+                    async_to_sync(method)("bench", limit=2, cursor=page["next_cursor"])[
+                        "result"
+                    ],
+                    after["result"],
+                )
+                self.service.prepared = PreparedSearches()
+
+    def test_other_pages_go_through_the_orm(self):
+        async_to_sync(self.service.avector_search)("bench", count="exact")
+        async_to_sync(self.service.avector_search)("bench", fields=["name"])
+        async_to_sync(self.service.avector_search)("bench", min_price=1)
+        self.assertIsNone(self.service.prepared.get("vector_search", False))
+
+    def test_a_failed_execute_keeps_the_statement_usable(self):
+        queryset = async_to_sync(self.service.vector_search)(QUERY_PLACEHOLDER)
+        statement = self.service.prepared.add(
+            "vector_search",
+            False,
+            queryset,
+            self.service.get_fields(queryset),
+            self.service.get_page_keys(queryset),
+        )
+        # prepared, then executed with a bad limit.
+        with self.assertRaises(DataError), transaction.atomic():
+            statement.execute(["bench", "many"])
+
+        rows = statement.execute(["bench", 10])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(self.get_prepared().count(statement.name), 1)
+
+
+class FakeConnection:
+    def __init__(self, transaction_status: int = TRANSACTION_STATUS_IDLE) -> None:
+        self.closed = 0
+        self.info = SimpleNamespace(transaction_status=transaction_status)
+        self.rolled_back = False
+
+    def rollback(self) -> None:
+        self.rolled_back = True
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self) -> None:
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(max_size=2)
+        conn = pool.getconn(FakeConnection)
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(FakeConnection), conn)
+        stats = pool.stats()
+        self.assertEqual((stats["opened"], stats["checkouts"]), (1, 2))
+        self.assertEqual((stats["size"], stats["in_use"], stats["idle"]), (1, 1, 0))
+
+    def test_checkouts_time_out_when_every_connection_is_used(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05)
+        pool.getconn(FakeConnection)
+        with self.assertRaisesMessage(OperationalError, "No database connection"):
+            pool.getconn(FakeConnection)
+        self.assertEqual(pool.stats()["timeouts"], 1)
+
+    def test_waiters_get_the_returned_connections(self):
+        pool = ConnectionPool(max_size=1, timeout=5)
+        conn = pool.getconn(FakeConnection)
+        timer = threading.Timer(0.05, pool.putconn, [conn])
+        timer.start()
+        self.assertIs(pool.getconn(FakeConnection), conn)
+        timer.join()
+        stats = pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertGreater(stats["max_wait_time"], 0)
+
+    def test_open_transactions_are_rolled_back(self):
+        pool = ConnectionPool()
+        conn = pool.getconn(lambda: FakeConnection(TRANSACTION_STATUS_INTRANS))
+        pool.putconn(conn)
+        self.assertTrue(conn.rolled_back)
+        self.assertIs(pool.getconn(FakeConnection), conn)
+
+    def test_closed_and_expired_connections_are_replaced(self):
+        pool = ConnectionPool(max_age=60)
+        closed = pool.getconn(FakeConnection)
+        pool.putconn(closed)
+        closed.close()
+        conn = pool.getconn(FakeConnection)
+        self.assertIsNot(conn, closed)
+        pool.putconn(conn)
+
+        later = time.monotonic() + 61
+        with patch("core.backends.pooled.pool.time.monotonic", return_value=later):
+            self.assertIsNot(pool.getconn(FakeConnection), conn)
+        self.assertTrue(conn.closed)
+        stats = pool.stats()
+        self.assertEqual((stats["discarded"], stats["size"]), (2, 1))
+
+    def test_failed_connects_free_their_slot(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05)
+
+        def connect():
+            raise OperationalError("refused")
+
+        with self.assertRaisesMessage(OperationalError, "refused"):
+            pool.getconn(connect)
+        self.assertIsInstance(pool.getconn(FakeConnection), FakeConnection)
+
+    def test_close_only_closes_the_idle_connections(self):
+        pool = ConnectionPool()
+        idle, used = pool.getconn(FakeConnection), pool.getconn(FakeConnection)
+        pool.putconn(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+        self.assertFalse(used.closed)
+        self.assertEqual(pool.stats()["size"], 1)
+
+
+class PooledBackendTests(TransactionTestCase):
+    def test_closed_connections_go_back_to_their_pool(self):
+        pool = connection.pool
+        self.assertIs(pool, get_pool("default", connection.settings_dict["NAME"], {}))
+        connection.ensure_connection()
+        session = connection.connection
+        opened = pool.stats()["opened"]
+        connection.close()
+
+        connection.ensure_connection()
+        self.assertIs(connection.connection, session)
+        self.assertEqual(pool.stats()["opened"], opened)
+
+    def test_the_pools_are_told_apart_by_database(self):
+        self.assertIsNot(
+            get_pool("default", "search_a", {}), get_pool("default", "search_b", {})
+        )
+
+
+class QueryNormalizationTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.product = self.create_product("Garden Bench", "Solid oak.")
+
+    def test_queries_are_normalized_before_the_cache_and_the_database(self):
+        self.assertEqual(
+            SearchService.normalize_query("  Ｇarden\tBENCH "), "garden bench"
+        )
+        page = async_to_sync(self.service.avector_search)("Garden  BENCH")
+        self.assertEqual(self.get_ids(page), [self.product.pk])
+        with self.assertNumQueries(0):
+            async_to_sync(self.service.avector_search)(" ｇａｒｄｅｎ bench")
+
+    def test_prepared_statements_get_the_normalized_query(self):
+        self.service.cache = None
+        self.service.prepared = PreparedSearches()
+        page = async_to_sync(self.service.anormal_search)("ＢＥＮＣＨ")
+        self.assertIsNotNone(self.service.prepared.get("normal_search", False))
+        self.assertEqual(self.get_ids(page), [self.product.pk])
+
+    def test_stop_words_return_an_empty_page_without_queries(self):
+        for method in (
+            self.service.anormal_search,
+            self.service.avector_search,
+            self.service.aranking_search,
+        ):
+            with self.subTest(method.__name__), self.assertNumQueries(0):
+                page = async_to_sync(method)(
+                    "The and", count="exact", facets=True, price_bands=[0, 10]
+                )
+                self.assertEqual(page["result"], [])
+                self.assertEqual(page["count"], 0)
+                self.assertEqual(page["facets"], {"0-10": 0, "10+": 0})
+
+    def test_empty_columnar_pages_keep_their_columns(self):
+        for method, options, columns in (
+            (self.service.avector_search, {}, ["id", "name", "slug", "price"]),
+            (
+                self.service.aranking_search,
+                {},
+                ["id", "name", "slug", "price", "rank"],
+            ),
+            (self.service.aranking_search, {"fields": ["id", "rank"]}, ["id", "rank"]),
+            (self.service.atrigram_search, {"fields": ["name"]}, ["name"]),
+        ):
+            with self.subTest(method.__name__, **options):
+                page = async_to_sync(method)(" ", columnar=True, **options)
+                self.assertEqual(page["result"], {"columns": columns, "rows": []})
+
+    def test_fields_of_empty_pages_are_checked(self):
+        with self.assertRaisesMessage(ValueError, "Invalid fields."):
+            async_to_sync(self.service.avector_search)("the", fields=["bogus"])
+
+    def test_batches_normalize_their_queries(self):
+        result = async_to_sync(self.service.abatch_search)(
+            [
+                {"id": "a", "query": "  GARDEN Bench", "type": "vector"},
+                {"id": "b", "query": "the", "type": "vector"},
+            ]
+        )["result"]
+        self.assertEqual(self.get_ids(result["a"]), [self.product.pk])
+        self.assertEqual(result["b"]["result"], [])
+
+    def test_complete_results_normalize_their_queries(self):
+        queryset = async_to_sync(self.service.get_search)("vector", "ＢＥＮＣＨ")
+        self.assertEqual(list(queryset.values_list("pk", flat=True)), [self.product.pk])
+        queryset = async_to_sync(self.service.get_search)("ranking", "the of")
+        self.assertFalse(queryset.exists())
+
+
+class QueryNormalizationViewTests(SearchTransactionTestCase):
+    def test_exports_normalize_their_queries(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        index_dirty_products(100)
+        content = self.client.get("/search/ＢＥＮＣＨ/vector/export/").getvalue()
+        self.assertEqual(
+            [line.split(",")[0] for line in content.decode().splitlines()[1:]],
+            [str(product.pk)],
+        )
+        content = self.client.get("/search/the/vector/export/").getvalue()
+        self.assertEqual(
+            content.decode().splitlines(), ["id,name,slug,price,description"]
+        )
+
+    def test_empty_columnar_pages_of_the_view(self):
+        data = self.client.get("/search/the/", {"layout": "columns"}).json()["data"]
+        self.assertEqual(
+            data["ranking_search"]["result"],
+            {"columns": ["id", "name", "slug", "price", "rank"], "rows": []},
+        )
+        self.assertEqual(data["ranking_search"]["records"], 0)
+
+
+class MetricsTests(SearchTransactionTestCase):
+    def get_sample(self, text: str, name: str) -> float:
+        for line in text.splitlines():
+            if line.startswith(name + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def test_search_responses_carry_server_timing(self):
+        self.create_product("Garden Bench", "Solid oak.")
+        response = self.client.get("/search/bench/vector/")
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=[\d.]+;desc="[1-9]\d* queries, 1 rows", '
+            r"orm;dur=[\d.]+, encode;dur=[\d.]+$",
+        )
+
+    def test_the_searches_are_counted_and_timed(self):
+        self.create_product("Garden Bench", "Solid oak.")
+        requests = 'search_requests_total{strategy="vector"}'
+        durations = 'search_duration_seconds_count{strategy="vector"}'
+        before = self.client.get("/metrics").content.decode()
+        self.client.get("/search/bench/")
+        self.client.get("/search/bench/vector/")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(
+            response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8"
+        )
+        text = response.content.decode()
+        self.assertEqual(
+            self.get_sample(text, requests), self.get_sample(before, requests) + 2
+        )
+        self.assertEqual(
+            self.get_sample(text, durations), self.get_sample(before, durations) + 2
+        )
+        self.assertIn("# TYPE search_duration_seconds histogram", text)
+        self.assertIn(
+            'search_duration_seconds_bucket{strategy="vector",le="+Inf"}', text
+        )
+        self.assertIn(
+            'search_duration_seconds_recent{strategy="vector",quantile="0.99"}', text
+        )
+        self.assertIn("search_cache_hits_total", text)
+        self.assertIn('db_pool_checkouts_total{database="default"}', text)
+
+
+class MetricsRegistryTests(SimpleTestCase):
+    def test_counters_and_histograms_are_rendered(self):
+        registry = Metrics()
+        registry.describe("jobs_total", "Jobs run.")
+        registry.inc("jobs_total", kind="a")
+        registry.inc("jobs_total", 2, kind="a")
+        for value in (0.002, 0.2, 3):
+            registry.observe("job_seconds", value)
+
+        lines = registry.render().splitlines()
+        self.assertIn("# HELP jobs_total Jobs run.", lines)
+        self.assertIn('jobs_total{kind="a"} 3', lines)
+        self.assertIn('job_seconds_bucket{le="0.0025"} 1', lines)
+        self.assertIn('job_seconds_bucket{le="0.25"} 2', lines)
+        self.assertIn('job_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("job_seconds_count 3", lines)
+        self.assertIn('job_seconds_recent{quantile="0.5"} 0.2', lines)
+
+    def test_large_values_keep_every_digit(self):
+        registry = Metrics()
+        registry.inc("rows_total", 1234567)
+        registry.inc("seconds_total", 1234567.25)
+        registry.inc("other_total", float("inf"))
+
+        lines = registry.render().splitlines()
+        self.assertIn("rows_total 1234567", lines)
+        self.assertIn("seconds_total 1234567.25", lines)
+        self.assertIn("other_total +Inf", lines)
+
+    def test_query_recorders_are_shared_across_threads(self):
+        recorder = QueryRecorder()
+        cursor = SimpleNamespace(rowcount=2)
+
+        def record():
+            for _ in range(1000):
+                recorder(
+                    lambda *args: None, "SELECT 1", None, False, {"cursor": cursor}
+                )
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((recorder.queries, recorder.rows), (4000, 8000))
+
+
+@override_settings(SEARCH_INDEX_DEFERRED=True)
+class DeferredIndexingTests(SearchTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        with connection.schema_editor() as schema_editor:
+            create_search_vector_trigger(schema_editor, deferred=True)
+
+    def get_dirty(self, product: Product) -> tuple:
+        product.refresh_from_db()
+        return product.search_index_dirty, product.search_index_dirty_since
+
+    def test_writes_flag_the_products_since_their_first_change(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        dirty, since = self.get_dirty(product)
+        self.assertTrue(dirty)
+        self.assertIsNotNone(since)
+        self.assertIsNone(product.search_vector)
+
+        Product.objects.filter(pk=product.pk).update(name="Park Bench")
+        self.assertEqual(self.get_dirty(product), (True, since))
+
+    def test_every_indexing_path_clears_the_flags(self):
+        for index in (
+            lambda product: index_dirty_products(100),
+            lambda product: prep_product_search_vector_index(
+                Product.objects.filter(pk=product.pk)
+            ),
+        ):
+            product = self.create_product("Garden Bench", "Solid oak.")
+            with self.subTest(index=index):
+                index(product)
+                self.assertEqual(self.get_dirty(product), (False, None))
+                self.assertIn("'oak':", product.search_vector)
+
+    def test_the_queue_reports_how_long_the_products_waited(self):
+        self.create_product("Garden Bench", "Solid oak.")
+        self.assertEqual(get_index_backlog()[0], 1)
+        lags = index_dirty_products(100)
+        self.assertEqual(len(lags), 1)
+        self.assertGreaterEqual(lags[0], 0)
+        self.assertEqual(get_index_backlog(), (0, None))
+
+    def test_dirty_products_are_still_found(self):
+        product = self.create_product("Garden Bench", "Solid oak.")
+        page = async_to_sync(self.service.aranking_search)("oak")
+        self.assertEqual(self.get_ids(page), [product.pk])
+
+
+class DirtySinceMigrationTests(TransactionTestCase):
+    def migrate(self, target: str) -> None:
+        call_command("migrate", "search", target, verbosity=0)
+
+    def insert(self) -> tuple:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO search_product (name, slug, description, price,
+                    search_document, search_index_dirty)
+                VALUES ('Garden Bench', '', 'Solid oak.', 1, '', true)
+                RETURNING search_vector IS NOT NULL, search_index_dirty
+                """
+            )
+            return cursor.fetchone()
+
+    def get_dirty_since(self) -> list:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT search_index_dirty_since IS NOT NULL FROM search_product "
+                "ORDER BY id DESC LIMIT 1"
+            )
+            return cursor.fetchone()[0]
+
+    def test_the_migration_round_trips(self):
+        self.addCleanup(self.migrate, "0009")
+        self.migrate("0008")
+        # the function of 0007 is back, it indexes the writes.
+        self.assertEqual(self.insert(), (True, False))
+
+        with override_settings(SEARCH_INDEX_DEFERRED=False):
+            self.migrate("0009")
+        self.assertEqual(self.insert(), (True, False))
+        self.assertFalse(self.get_dirty_since())
+
+        self.migrate("0008")
+        with override_settings(SEARCH_INDEX_DEFERRED=True):
+            self.migrate("0009")
+        self.assertEqual(self.insert(), (False, True))
+        self.assertTrue(self.get_dirty_since())
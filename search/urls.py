@@ -1,8 +1,21 @@
 from django.urls import path
 
-from .views import SearchView, SearchWithTypeView
+from .views import (
+    BatchSearchView,
+    ExportView,
+    SearchView,
+    SearchWithTypeView,
+    SuggestView,
+)
 
 urlpatterns = [
     path("<str:query>/", view=SearchView.as_view()),
     path("<str:query>/<str:type>/", view=SearchWithTypeView.as_view()),
+    path("<str:query>/<str:type>/export/", view=ExportView.as_view()),
+]
+
+# routed outside of `search/`, every path under it is a query.
+root_urlpatterns = [
+    path("suggest/<str:prefix>/", view=SuggestView.as_view()),
+    path("batch-search/", view=BatchSearchView.as_view()),
 ]
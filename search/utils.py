@@ -1,20 +1,217 @@
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
-from django.contrib.postgres.search import SearchVector
-from django.db import models
+from django.db import connection, connections, models, router
+
+from core.routers import get_shards
 
 from .models import Product
+from .services import SearchService
+
+SEARCH_VECTOR_TRIGGER = "search_product_search_vector_update"
+SEARCH_VECTOR_FUNCTION = "search_product_search_vector"
 
 
 def prep_product_search_vector_index(
     products: models.QuerySet[Product] | List[Product],
     save: bool = True,
 ):
+    # weights are baked into the stored vector so ranking can read it as is.
     for product in products:
-        product.search_vector = SearchVector(*Product.SEARCH_VECTOR_FIELDS)
+        product.search_vector = SearchService.get_search_vector(
+            config=SearchService.CONFIG
+        )
+        product.search_document = SearchService.get_search_document()
         product.search_index_dirty = False
+        product.search_index_dirty_since = None
 
     if save:
-        Product.objects.bulk_update(products, ["search_vector", "search_index_dirty"])
+        Product.objects.bulk_update(
+            products,
+            [
+                "search_vector",
+                "search_document",
+                "search_index_dirty",
+                "search_index_dirty_since",
+            ],
+        )
 
     return products
+
+
+def get_products_to_index(full: bool = False) -> models.QuerySet[Product]:
+    # read from the primary, a replica may lag behind the rows to index.
+    products = Product.objects.using(router.db_for_write(Product))
+    if not full:
+        products = products.filter(SearchService.get_stale_filter())
+
+    return products
+
+
+def get_product_databases(write: bool = False) -> List[str]:
+    # every shard, or the single database of the products.
+    if get_shards():
+        return get_shards()
+    return [router.db_for_write(Product) if write else Product.objects.db]
+
+
+def get_pk_ranges(
+    products: models.QuerySet[Product], batch_size: int, start: int = 0
+) -> Iterator[Tuple[int, int]]:
+    # keyset walk over the primary keys, never loads more than a batch of ids.
+    last = start
+    while True:
+        pks = list(
+            products.filter(pk__gt=last)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:batch_size]
+        )
+        if not pks:
+            return
+
+        yield pks[0], pks[-1]
+        last = pks[-1]
+
+
+def index_product_range(start: int, end: int, full: bool = False) -> int:
+    # a single set based UPDATE instead of a bulk_update CASE per row.
+    try:
+        return (
+            get_products_to_index(full)
+            .filter(pk__gte=start, pk__lte=end)
+            .update(
+                search_vector=SearchService.get_search_vector(
+                    config=SearchService.CONFIG
+                ),
+                search_document=SearchService.get_search_document(),
+                search_index_dirty=False,
+                search_index_dirty_since=None,
+            )
+        )
+    finally:
+        # runs in worker threads, each one holds its own connection.
+        connections.close_all()
+
+
+def get_search_vector_sql(alias: str) -> str:
+    # same weighted vector as `SearchService.get_search_vector` in plain sql,
+    # `alias` is the row the fields are read from e.g. NEW in a trigger.
+    qn = connection.ops.quote_name
+    return " || ".join(
+        f"setweight(to_tsvector('{SearchService.CONFIG}', "
+        f"COALESCE({alias}.{qn(field)}, '')), '{weight}')"
+        for field, weight in SearchService.PRODUCT_SEARCH_FIELDS.items()
+    )
+
+
+def get_search_document_sql(alias: str) -> str:
+    qn = connection.ops.quote_name
+    fields = ", ".join(
+        f"{alias}.{qn(field)}" for field in SearchService.PRODUCT_SEARCH_FIELDS
+    )
+    return f"concat_ws(' ', {fields})"
+
+
+def index_dirty_products(
+    batch_size: int, using: Optional[str] = None
+) -> List[Optional[float]]:
+    # claims a batch of stale products and indexes them with a single UPDATE,
+    # concurrent workers skip the rows claimed by each other. returns the
+    # seconds every indexed product has been waiting for.
+    connection = connections[using or router.db_for_write(Product)]
+    qn = connection.ops.quote_name
+    table = qn(Product._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH batch AS (
+                SELECT id, search_index_dirty_since FROM {table}
+                WHERE search_index_dirty OR search_vector IS NULL
+                ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {table} AS product SET
+                search_vector = {get_search_vector_sql("product")},
+                search_document = {get_search_document_sql("product")},
+                search_index_dirty = false,
+                search_index_dirty_since = NULL
+            FROM batch WHERE product.id = batch.id
+            RETURNING EXTRACT(
+                EPOCH FROM clock_timestamp() - batch.search_index_dirty_since
+            )::float
+            """,
+            [batch_size],
+        )
+        return [lag for lag, in cursor.fetchall()]
+
+
+def get_index_backlog(using: Optional[str] = None) -> Tuple[int, Optional[float]]:
+    # number of stale products and the seconds the oldest one has waited.
+    connection = connections[using or router.db_for_write(Product)]
+    table = connection.ops.quote_name(Product._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT COUNT(*), EXTRACT(
+                EPOCH FROM clock_timestamp() - MIN(search_index_dirty_since)
+            )::float
+            FROM {table} WHERE search_index_dirty OR search_vector IS NULL
+            """
+        )
+        return cursor.fetchone()
+
+
+def create_search_vector_trigger(schema_editor, deferred: bool = False) -> None:
+    # postgres keeps `search_vector` and `search_document` in sync for every
+    # write path (save, bulk_create, update and loaddata), no python side
+    # prep is needed. `deferred` triggers only flag the changed products, a
+    # worker indexes them later (see search/queue.py). the migrations install
+    # the trigger of their time, this one follows the current search fields,
+    # weights and settings (see the create_search_trigger command).
+    qn = schema_editor.quote_name
+    table = qn(Product._meta.db_table)
+    fields = list(SearchService.PRODUCT_SEARCH_FIELDS)
+    changed = " OR ".join(
+        f"NEW.{qn(field)} IS DISTINCT FROM OLD.{qn(field)}" for field in fields
+    )
+
+    if deferred:
+        index = """
+            NEW.search_index_dirty := true;
+            NEW.search_index_dirty_since := CASE
+                WHEN TG_OP = 'UPDATE' AND OLD.search_index_dirty
+                THEN OLD.search_index_dirty_since ELSE clock_timestamp()
+            END;
+        """
+    else:
+        index = f"""
+            NEW.search_vector := {get_search_vector_sql("NEW")};
+            NEW.search_document := {get_search_document_sql("NEW")};
+            NEW.search_index_dirty := false;
+            NEW.search_index_dirty_since := NULL;
+        """
+
+    schema_editor.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION {SEARCH_VECTOR_FUNCTION}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' OR {changed} THEN
+                {index}
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    schema_editor.execute(f"DROP TRIGGER IF EXISTS {SEARCH_VECTOR_TRIGGER} ON {table}")
+    schema_editor.execute(
+        f"""
+        CREATE TRIGGER {SEARCH_VECTOR_TRIGGER}
+        BEFORE INSERT OR UPDATE OF {", ".join(qn(f) for f in fields)} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {SEARCH_VECTOR_FUNCTION}()
+        """
+    )
+
+
+def drop_search_vector_trigger(schema_editor) -> None:
+    table = schema_editor.quote_name(Product._meta.db_table)
+    schema_editor.execute(f"DROP TRIGGER IF EXISTS {SEARCH_VECTOR_TRIGGER} ON {table}")
+    schema_editor.execute(f"DROP FUNCTION IF EXISTS {SEARCH_VECTOR_FUNCTION}()")
@@ -1,47 +1,387 @@
-from datetime import datetime
+import asyncio
+import json
+import time
+from functools import partial
+from http import HTTPStatus
+from itertools import chain
+from typing import Any, Dict, Iterator, List, Optional, Sequence
 
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import OperationalError, models
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.http.request import HttpRequest
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 
+from core.db import is_statement_timeout, iterate_in_thread, run_isolated
+from core.metrics import QueryRecorder, metrics
 from core.response import make_response
 from core.views import BaseAsyncView
 
-from .services import SearchService
+from .export import (
+    EXPORT_FORMATS,
+    get_export_columns,
+    iter_row_chunks,
+    merge_rows,
+    spool_export,
+)
+from .models import Product
+from .services import SearchResult, SearchService
+
+metrics.describe("search_requests_total", "Searches run per strategy.")
+metrics.describe("search_timeouts_total", "Searches which timed out per strategy.")
+metrics.describe(
+    "search_errors_total", "Searches failed by a database error per strategy."
+)
+metrics.describe("search_queries_total", "SQL queries run by the searches.")
+metrics.describe("search_rows_total", "Rows returned by the database to the searches.")
+metrics.describe("search_duration_seconds", "Time taken by a search strategy.")
+metrics.describe(
+    "search_phase_seconds",
+    "Time of a search spent in the database (db) and in the orm and python (orm).",
+)
+metrics.describe("search_encode_seconds", "Time taken to encode a search response.")
 
 
 class SearchView(BaseAsyncView):
+    # seconds each search strategy is allowed to take.
+    TIMEOUT = 5.0
+
+    def setup(self, request: HttpRequest, *args, **kwargs) -> None:
+        super().setup(request, *args, **kwargs)
+        # phases of the request in nanoseconds, summed over the strategies.
+        self.db_ns = 0
+        self.orm_ns = 0
+        self.queries = 0
+        self.rows = 0
+
+    def get_flag(self, request: HttpRequest, name: str) -> bool:
+        return request.GET.get(name, "").lower() in ("1", "true")
+
+    def get_highlight_options(self, request: HttpRequest) -> Optional[Dict[str, Any]]:
+        if not self.get_flag(request, "highlight"):
+            return None
+
+        options: Dict[str, Any] = {}
+        for key in ("max_words", "min_words"):
+            value = request.GET.get(key, "")
+            if value:
+                if not value.isnumeric():
+                    raise ValueError(f"Invalid {key}.")
+                options[key] = int(value)
+
+        for key in ("start_sel", "stop_sel"):
+            if key in request.GET:
+                options[key] = request.GET[key]
+
+        return options
+
+    def get_page_options(self, request: HttpRequest) -> Dict[str, Any]:
+        limit = request.GET.get("limit", "")
+        if limit and (not limit.isnumeric() or int(limit) < 1):
+            raise ValueError("Invalid limit.")
+
+        # `count=true` is kept for an estimated count.
+        count = request.GET.get("count", "").lower()
+        count = "estimate" if count in ("1", "true") else count
+        if count not in ("", "none", *SearchService.COUNT_MODES):
+            raise ValueError("Invalid count.")
+        fields = request.GET.get("fields", "")
+        return {
+            "limit": int(limit) if limit else None,
+            "count": None if count in ("", "none") else count,
+            "fields": [f.strip() for f in fields.split(",") if f.strip()] or None,
+            "columnar": request.GET.get("layout", "") == "columns",
+        }
+
+    def get_filter_options(self, request: HttpRequest) -> Dict[str, Any]:
+        options: Dict[str, Any] = {"facets": self.get_flag(request, "facets")}
+        try:
+            for key in ("min_price", "max_price"):
+                if request.GET.get(key):
+                    options[key] = float(request.GET[key])
+
+            if request.GET.get("price_bands"):
+                options["price_bands"] = [
+                    float(band) for band in request.GET["price_bands"].split(",")
+                ]
+        except ValueError as e:
+            raise ValueError("Invalid price filters.") from e
+
+        return options
+
     async def with_time(self, method, *args, **kwargs):
-        start_time = datetime.now()
-        result = []
+        start_time = time.perf_counter_ns()
+        recorder = QueryRecorder()
+        result: SearchResult = {
+            "result": [],
+            "next_cursor": None,
+            "count": None,
+            "facets": None,
+        }
         type = ""
+        timed_out = False
         if callable(method):
-            result = await method(*args, **kwargs)
             type = method.__name__[1:]
+            try:
+                result = await asyncio.wait_for(
+                    run_isolated(
+                        method,
+                        *args,
+                        timeout=self.TIMEOUT,
+                        using=Product.objects.db,
+                        recorder=recorder,
+                        **kwargs,
+                    ),
+                    timeout=self.TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                # a slow strategy doesn't hold up the others.
+                timed_out = True
+            except OperationalError as e:
+                if not is_statement_timeout(e):
+                    metrics.inc(
+                        "search_errors_total", strategy=type.removesuffix("_search")
+                    )
+                    raise
+                timed_out = True
+
+        elapsed = time.perf_counter_ns() - start_time
+        if type:
+            self.record(type, elapsed, recorder, timed_out)
 
         return {
-            "time_taken": f"{(datetime.now()-start_time).total_seconds():.4f} secs.",
-            "records": len(result),
+            "time_taken": f"{elapsed / 1e9:.4f} secs.",
+            "records": self.get_records(result["result"]),
             "type": type,
-            "result": result,
+            "timed_out": timed_out,
+            **result,
         }
 
+    def get_records(self, rows: List[Any] | Dict[str, Any]) -> int:
+        return len(rows["rows"] if isinstance(rows, dict) else rows)
+
+    def record(
+        self, type: str, elapsed: int, recorder: QueryRecorder, timed_out: bool
+    ) -> None:
+        strategy = type.removesuffix("_search")
+        self.db_ns += recorder.db_ns
+        self.orm_ns += elapsed - recorder.db_ns
+        self.queries += recorder.queries
+        self.rows += recorder.rows
+
+        metrics.inc("search_requests_total", strategy=strategy)
+        if timed_out:
+            metrics.inc("search_timeouts_total", strategy=strategy)
+        metrics.inc("search_queries_total", recorder.queries, strategy=strategy)
+        metrics.inc("search_rows_total", recorder.rows, strategy=strategy)
+        metrics.observe("search_duration_seconds", elapsed / 1e9, strategy=strategy)
+        metrics.observe(
+            "search_phase_seconds", recorder.db_ns / 1e9, strategy=strategy, phase="db"
+        )
+        metrics.observe(
+            "search_phase_seconds",
+            (elapsed - recorder.db_ns) / 1e9,
+            strategy=strategy,
+            phase="orm",
+        )
+
+    def make_response(self, data: Dict[str, Any]) -> HttpResponse:
+        start_time = time.perf_counter_ns()
+        response = make_response(data)
+        encode_ns = time.perf_counter_ns() - start_time
+        metrics.observe("search_encode_seconds", encode_ns / 1e9)
+
+        # phases of the request for the browser dev tools and the proxies.
+        response["Server-Timing"] = ", ".join(
+            [
+                f'db;dur={self.db_ns / 1e6:.3f};desc="{self.queries} queries, '
+                f'{self.rows} rows"',
+                f"orm;dur={self.orm_ns / 1e6:.3f}",
+                f"encode;dur={encode_ns / 1e6:.3f}",
+            ]
+        )
+        return response
+
     async def get(self, request: HttpRequest, query: str = ""):
         service = SearchService()
-        return make_response(
+        try:
+            options = {
+                **self.get_page_options(request),
+                **self.get_filter_options(request),
+            }
+            highlight = self.get_highlight_options(request)
+        except ValueError as e:
+            return make_response(
+                errors={"detail": str(e)}, status=HTTPStatus.BAD_REQUEST
+            )
+
+        start_time = time.perf_counter_ns()
+        # the strategies are independent, run them concurrently. each one is
+        # awaited to its end even when another one fails.
+        results = await asyncio.gather(
+            self.with_time(service.anormal_search, query, **options),
+            self.with_time(service.avector_search, query, **options),
+            self.with_time(
+                service.aranking_search, query, highlight=highlight, **options
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            # options only the searches check e.g. unknown fields.
+            if isinstance(result, ValueError):
+                return make_response(
+                    errors={"detail": str(result)}, status=HTTPStatus.BAD_REQUEST
+                )
+            if isinstance(result, BaseException):
+                raise result
+        normal_search, vector_search, ranking_search = results
+
+        return self.make_response(
             {
-                "normal_search": await self.with_time(service.anormal_search, query),
-                "vector_search": await self.with_time(service.avector_search, query),
-                "ranking_search": await self.with_time(service.aranking_search, query),
+                "normal_search": normal_search,
+                "vector_search": vector_search,
+                "ranking_search": ranking_search,
+                "time_taken": (
+                    f"{(time.perf_counter_ns() - start_time) / 1e9:.4f} secs."
+                ),
             }
         )
 
 
 class SearchWithTypeView(SearchView):
+    def get_page_options(self, request: HttpRequest) -> Dict[str, Any]:
+        return {
+            **super().get_page_options(request),
+            "cursor": request.GET.get("cursor") or None,
+        }
+
+    async def get(self, request: HttpRequest, query: str = "", type: str = ""):
+        service = SearchService()
+        # e.g. `abatch_search` isn't a search type.
+        if type not in service.STRATEGIES:
+            return make_response(
+                errors={"detail": "Invalid search type."},
+                status=HTTPStatus.BAD_REQUEST,
+            )
+
+        try:
+            options = {
+                **self.get_page_options(request),
+                **self.get_filter_options(request),
+            }
+            # snippets are only supported by the ranking search, the bm25
+            # one refuses them.
+            if type in ("ranking", "bm25"):
+                options["highlight"] = self.get_highlight_options(request)
+
+            result = await self.with_time(
+                getattr(service, f"a{type}_search"), query, **options
+            )
+        except ValueError as e:
+            return make_response(
+                errors={"detail": str(e)}, status=HTTPStatus.BAD_REQUEST
+            )
+
+        return self.make_response(result)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class BatchSearchView(SearchView):
+    def get_records(self, rows: List[Any] | Dict[str, Any]) -> int:
+        # rows of all the pages of the batch.
+        if isinstance(rows, dict):
+            return sum(len(page["result"]) for page in rows.values())
+        return len(rows)
+
+    def get_items(self, request: HttpRequest) -> List[Dict[str, Any]]:
+        try:
+            items = json.loads(request.body)
+        except ValueError as e:
+            raise ValueError("Invalid batch.") from e
+
+        if not isinstance(items, list) or not all(
+            isinstance(item, dict) for item in items
+        ):
+            raise ValueError("Invalid batch.")
+
+        return items
+
+    async def post(self, request: HttpRequest):
+        try:
+            items = self.get_items(request)
+            result = await self.with_time(SearchService().abatch_search, items)
+        except ValueError as e:
+            return make_response(
+                errors={"detail": str(e)}, status=HTTPStatus.BAD_REQUEST
+            )
+
+        return self.make_response(result)
+
+
+class SuggestView(BaseAsyncView):
+    async def get(self, request: HttpRequest, prefix: str = ""):
+        limit = request.GET.get("limit", "10")
+        if not limit.isnumeric() or int(limit) < 1:
+            return make_response(
+                errors={"detail": "Invalid limit."}, status=HTTPStatus.BAD_REQUEST
+            )
+
+        result = await SearchService().suggest(prefix, int(limit))
+        return make_response({"records": len(result), "result": result})
+
+
+class ExportView(BaseAsyncView):
+    def get_rows(
+        self,
+        service: SearchService,
+        queryset: models.QuerySet[Product],
+        columns: List[str],
+    ) -> Iterator[Sequence[Any]]:
+        # rows are read from worker threads, one per shard.
+        querysets = [queryset.using(alias) for alias in service.shards] or [queryset]
+        return merge_rows(
+            [
+                chain.from_iterable(
+                    iterate_in_thread(partial(iter_row_chunks, shard, columns))
+                )
+                for shard in querysets
+            ],
+            columns,
+        )
+
     async def get(self, request: HttpRequest, query: str = "", type: str = ""):
         service = SearchService()
-        method = getattr(service, f"a{type}_search", None)
-        result = await self.with_time(None)
+        format = request.GET.get("format", "csv")
+        if type not in service.STRATEGIES or format not in EXPORT_FORMATS:
+            return make_response(
+                errors={"detail": "Invalid search type or format."},
+                status=HTTPStatus.BAD_REQUEST,
+            )
+
+        if type == "bm25":
+            # the matches are held by the in memory index, ranked already.
+            columns = service.ENGINE_COLUMNS
+            rows = iter(await service.get_engine_rows(query))
+        else:
+            queryset = await service.get_search(type, query)
+            columns = get_export_columns(queryset)
+            rows = self.get_rows(service, queryset, columns)
 
-        if method and callable(method):
-            result = await self.with_time(method, query)
+        content_type, write = EXPORT_FORMATS[format]
+        filename = f"results.{format}"
+        chunks = write(rows, columns)
+        if isinstance(request, ASGIRequest):
+            # django 4.1 iterates the streaming responses synchronously on the
+            # event loop under ASGI, waiting on the rows would block it. the
+            # export is written to a temporary file from a worker thread and
+            # served from there.
+            file = await sync_to_async(spool_export, thread_sensitive=False)(chunks)
+            return FileResponse(
+                file, as_attachment=True, filename=filename, content_type=content_type
+            )
 
-        return make_response(result)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response